@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Compares migrating a batch of requests one at a time with the columnar bulk mode of
+:py:class:`.MigrationHandler`.
+
+Every param of the synthetic requests has a declarative specification that strips, changes
+the case, casts or multiplies its value. Run it from the repository root: ::
+
+    python benchmarks/bench_columnar.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connect_migration  # noqa: E402
+from synthetic import make_request  # noqa: E402
+
+SCALES = [
+    # (requests, params)
+    (100, 10),
+    (1000, 10),
+    (1000, 50),
+]
+
+SPECS = [
+    {'cast': 'int', 'multiply': 10},
+    {'strip': True, 'case': 'upper'},
+    {'case': 'lower'},
+    {'cast': 'float', 'multiply': 1.5},
+]
+
+
+def make_batch(num_requests, num_params):
+    """ Build a batch of requests of the same product, and the transformations of its params.
+
+    :rtype: tuple[list[Fulfillment], dict]
+    """
+    payload = {'param_{}'.format(i): ' {} Legacy Value '.format(i) if i % 2 else str(i)
+               for i in range(num_params)}
+    requests = [make_request(num_params=num_params, payload=payload,
+                             request_id='PR-0000-0000-{:04d}'.format(i))
+                for i in range(num_requests)]
+    transformations = {}
+    for i in range(num_params):
+        spec = dict(SPECS[(i % 2) + (2 if i % 4 > 1 else 0)], source='param_{}'.format(i))
+        if i % 2:
+            spec.pop('cast', None)
+            spec.pop('multiply', None)
+            spec.setdefault('case', 'upper')
+        transformations['param_{}'.format(i)] = spec
+    return requests, transformations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    print('{:>9} {:>8} {:>18} {:>18} {:>8}'.format(
+        'requests', 'params', 'one by one (ms)', 'columnar (ms)', 'speedup'))
+    for num_requests, num_params in SCALES:
+        requests, transformations = make_batch(num_requests, num_params)
+        handler = connect_migration.MigrationHandler(transformations, copy_on_write=True)
+        timings = []
+        for migrate in (lambda: handler.migrate_many(requests, executor=None),
+                        lambda: handler.migrate_columnar(requests)):
+            timings.append(min(timeit.repeat(migrate, repeat=args.repeat, number=1)) * 1000)
+        print('{:>9} {:>8} {:>18.1f} {:>18.1f} {:>7.1f}x'.format(
+            num_requests, num_params, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
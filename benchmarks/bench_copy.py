@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Compares the deep copy and copy-on-write modes of :py:class:`.MigrationHandler`.
+
+Run it from the repository root: ::
+
+    python benchmarks/bench_copy.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connect_migration  # noqa: E402
+from synthetic import make_request  # noqa: E402
+
+SCALES = [
+    # (params, items)
+    (10, 10),
+    (100, 100),
+    (500, 1000),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    print('{:>8} {:>8} {:>14} {:>14} {:>8}'.format(
+        'params', 'items', 'deepcopy (ms)', 'cow (ms)', 'speedup'))
+    for num_params, num_items in SCALES:
+        request = make_request(num_params=num_params, num_items=num_items)
+        timings = []
+        for copy_on_write in (False, True):
+            handler = connect_migration.MigrationHandler(copy_on_write=copy_on_write)
+            best = min(timeit.repeat(lambda: handler.migrate(request),
+                                     repeat=args.repeat, number=args.number))
+            timings.append(best / args.number * 1000)
+        print('{:>8} {:>8} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(
+            num_params, num_items, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
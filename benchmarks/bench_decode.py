@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Compares the full and partial decoding modes of :py:class:`.MigrationHandler`.
+
+The migration data of the synthetic requests contains a ``history`` key that no param uses,
+which partial decoding scans without materializing it. Both the time and the peak memory of
+one migration are reported. Run it from the repository root: ::
+
+    python benchmarks/bench_decode.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connect_migration  # noqa: E402
+from synthetic import make_payload, make_request  # noqa: E402
+
+SCALES = [
+    # (params, payload size)
+    (10, 1024),
+    (10, 64 * 1024),
+    (10, 1024 * 1024),
+    (500, 1024 * 1024),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    print('{:>8} {:>10} {:>12} {:>14} {:>12} {:>14}'.format(
+        'params', 'payload', 'full (ms)', 'partial (ms)', 'full (KB)', 'partial (KB)'))
+    for num_params, payload_size in SCALES:
+        request = make_request(num_params=num_params,
+                               payload=make_payload(num_params, payload_size))
+        timings = []
+        peaks = []
+        for partial_decode in (False, True):
+            handler = connect_migration.MigrationHandler(copy_on_write=True,
+                                                         partial_decode=partial_decode)
+            best = min(timeit.repeat(lambda: handler.migrate(request),
+                                     repeat=args.repeat, number=args.number))
+            timings.append(best / args.number * 1000)
+
+            tracemalloc.start()
+            handler.migrate(request)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+            tracemalloc.stop()
+        print('{:>8} {:>10} {:>12.3f} {:>14.3f} {:>12.1f} {:>14.1f}'.format(
+            num_params, payload_size, timings[0], timings[1], peaks[0], peaks[1]))
+
+
+if __name__ == '__main__':
+    main()
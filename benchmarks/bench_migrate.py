@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Measures the throughput and peak memory of :py:meth:`.MigrationHandler.migrate`.
+
+Synthetic requests are generated for every combination of number of params, size of the
+migration data, serialization and number of transformations. Run it from the repository
+root: ::
+
+    python benchmarks/bench_migrate.py --save benchmarks/baseline.json
+    python benchmarks/bench_migrate.py --compare benchmarks/baseline.json
+
+When comparing, cases whose throughput drops or whose peak memory grows more than
+``--threshold`` percent are reported as regressions, and the exit status is 1.
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connect_migration  # noqa: E402
+from synthetic import make_payload, make_request  # noqa: E402
+
+PARAMS = [10, 100, 500, 2000]
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+SERIALIZE = [False, True]
+TRANSFORMED = [0.0, 0.5]
+
+QUICK_PARAMS = [10, 500]
+QUICK_PAYLOAD_SIZES = [1024, 1024 * 1024]
+
+
+def _transformation(data, request_id):
+    return request_id
+
+
+def run_case(num_params, payload_size, serialize, transformed, min_time):
+    """ Measures one combination of parameters.
+
+    :return: Throughput in requests per second and peak memory in bytes of one migration.
+    :rtype: dict
+    """
+    payload = make_payload(num_params, payload_size, nested=serialize)
+    request = make_request(num_params=num_params, payload=payload)
+    transformations = {'param_{}'.format(i): _transformation
+                       for i in range(int(num_params * transformed))}
+    handler = connect_migration.MigrationHandler(transformations, serialize=serialize)
+
+    def migrate():
+        handler.migrate(request)
+
+    # Warm up (compiles the migration plan), then find a number of runs that takes min_time
+    migrate()
+    timer = timeit.Timer(migrate)
+    number, elapsed = timer.autorange() if hasattr(timer, 'autorange') else (1, timer.timeit(1))
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    elapsed = min(timer.repeat(repeat=5, number=number))
+
+    gc.collect()
+    tracemalloc.start()
+    migrate()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'params': num_params,
+        'payload': len(request.asset.get_param_by_id('migration_info').value),
+        'serialize': serialize,
+        'transformations': len(transformations),
+        'throughput': number / elapsed,
+        'peak_memory': peak,
+    }
+
+
+def _case_key(case):
+    return '{params}/{payload_size}/{serialize}/{transformed}'.format(**case)
+
+
+def run(quick=False, min_time=0.2):
+    cases = itertools.product(
+        QUICK_PARAMS if quick else PARAMS,
+        QUICK_PAYLOAD_SIZES if quick else PAYLOAD_SIZES,
+        SERIALIZE,
+        TRANSFORMED)
+    results = {}
+    for num_params, payload_size, serialize, transformed in cases:
+        case = {'params': num_params, 'payload_size': payload_size, 'serialize': serialize,
+                'transformed': transformed}
+        result = run_case(num_params, payload_size, serialize, transformed, min_time)
+        results[_case_key(case)] = result
+        sys.stderr.write('.')
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def report(current, baseline=None, threshold=10.0):
+    """ Prints the results, compared with the baseline if given.
+
+    :return: Number of regressions.
+    :rtype: int
+    """
+    header = '{:>6} {:>9} {:>5} {:>6} {:>12} {:>12}'.format(
+        'params', 'payload', 'ser', 'trans', 'req/s', 'peak KiB')
+    if baseline:
+        header += ' {:>9} {:>9}'.format('req/s %', 'memory %')
+    print(header)
+
+    regressions = 0
+    for key, result in sorted(current['results'].items(),
+                              key=lambda item: (item[1]['params'], item[1]['payload'],
+                                                item[1]['serialize'],
+                                                item[1]['transformations'])):
+        line = '{:>6} {:>9} {:>5} {:>6} {:>12.1f} {:>12.1f}'.format(
+            result['params'], result['payload'], 'yes' if result['serialize'] else 'no',
+            result['transformations'], result['throughput'], result['peak_memory'] / 1024.0)
+        previous = (baseline or {}).get('results', {}).get(key)
+        if previous:
+            throughput = (result['throughput'] / previous['throughput'] - 1) * 100
+            memory = (float(result['peak_memory']) / max(previous['peak_memory'], 1) - 1) * 100
+            line += ' {:>+9.1f} {:>+9.1f}'.format(throughput, memory)
+            if throughput < -threshold or memory > threshold:
+                line += '  REGRESSION'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Run a reduced set of cases.')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum time in seconds of each timed run.')
+    parser.add_argument('--save', help='Store the results in this JSON file.')
+    parser.add_argument('--compare', help='Compare the results with this JSON file.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Percentage of change considered a regression.')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    current = run(args.quick, args.min_time)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file_handle:
+            baseline = json.load(file_handle)
+    regressions = report(current, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, 'w') as file_handle:
+            json.dump(current, file_handle, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
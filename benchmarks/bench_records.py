@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Compares the memory used by the results of :py:meth:`.MigrationHandler.migrate` and
+:py:meth:`.MigrationHandler.migrate_records` while a batch of migrated requests is kept.
+
+The peak memory allocated while migrating the batch is divided by the number of requests, so
+it is the memory per in-flight request. Run it from the repository root: ::
+
+    python benchmarks/bench_records.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connect_migration  # noqa: E402
+from synthetic import make_request  # noqa: E402
+
+SCALES = [10, 100, 500]
+
+MODES = [
+    # (name, copy_on_write, method)
+    ('deep copy', False, 'migrate'),
+    ('copy on write', True, 'migrate'),
+    ('records', False, 'migrate_records'),
+]
+
+
+def _peak_per_request(handler, method, requests):
+    tracemalloc.start()
+    results = [getattr(handler, method)(request) for request in requests]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del results
+    return peak / 1024.0 / len(requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    print('{:>8} '.format('params') + ' '.join('{:>16}'.format(name + ' (KB)')
+                                                for name, _, _ in MODES))
+    for num_params in SCALES:
+        requests = [make_request(num_params=num_params, request_id='PR-0000-0000-{:04}'.format(i))
+                    for i in range(args.requests)]
+        peaks = []
+        for _, copy_on_write, method in MODES:
+            handler = connect_migration.MigrationHandler(copy_on_write=copy_on_write)
+            peaks.append(_peak_per_request(handler, method, requests))
+        print('{:>8} '.format(num_params) + ' '.join('{:>16.1f}'.format(peak)
+                                                     for peak in peaks))
+
+
+if __name__ == '__main__':
+    main()
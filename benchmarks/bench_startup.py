@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Measures the cold start of :py:class:`.MigrationHandler` in new interpreters.
+
+Every run starts a new Python process that imports the module, creates a handler, optionally
+calls :py:meth:`.MigrationHandler.warmup`, and migrates two requests. The reported times are
+the medians of all runs. The request is built before the first migration, so the Connect SDK
+is already imported by then, as it is in a real worker. Run it from the repository root: ::
+
+    python benchmarks/bench_startup.py
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLUMNS = ['import', 'handler', 'warmup', 'first migrate', 'second migrate']
+
+
+def child(use_warmup, num_params):
+    timings = {}
+    start = timeit.default_timer()
+    import connect_migration
+    timings['import'] = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    transformations = {'param_{}'.format(i): {'source': 'param_{}'.format(i), 'case': 'upper'}
+                       for i in range(0, num_params, 2)}
+    handler = connect_migration.MigrationHandler(transformations)
+    timings['handler'] = timeit.default_timer() - start
+
+    # A real worker builds its requests with the SDK, so it is always imported at this point
+    import logging
+    from synthetic import make_request
+    request = make_request(num_params=num_params)
+    logging.disable(logging.CRITICAL)
+
+    start = timeit.default_timer()
+    if use_warmup:
+        handler.warmup({request.asset.product.id: request.asset.params})
+    timings['warmup'] = timeit.default_timer() - start
+
+    for name in ('first migrate', 'second migrate'):
+        start = timeit.default_timer()
+        handler.migrate(request)
+        timings[name] = timeit.default_timer() - start
+    print(json.dumps(timings))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--params', type=int, default=100)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warmup', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        child(args.warmup, args.params)
+        return
+
+    print('{:>8} '.format('warmup') + ' '.join('{:>16}'.format(name + ' (ms)')
+                                                for name in COLUMNS))
+    for use_warmup in (False, True):
+        command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child',
+                   '--params', str(args.params)] + (['--warmup'] if use_warmup else [])
+        runs = [json.loads(subprocess.check_output(command, cwd=ROOT).decode('utf-8'))
+                for _ in range(args.runs)]
+        print('{:>8} '.format('yes' if use_warmup else 'no') + ' '.join(
+            '{:>16.3f}'.format(statistics.median(run[name] for run in runs) * 1000)
+            for name in COLUMNS))
+
+
+if __name__ == '__main__':
+    main()
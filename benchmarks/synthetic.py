@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" Generation of synthetic fulfillment requests used by the benchmarks. """
+
+import json
+
+from connect.models import Fulfillment
+
+
+def make_payload(num_params, payload_size=0, nested=False):
+    """ Build the legacy data for a request.
+
+    :param int num_params: Number of ``param_N`` keys to generate.
+    :param int payload_size: Approximate size in bytes of the extra ``history`` key.
+    :param bool nested: Whether the values are lists instead of strings, so they must be
+      serialized.
+    :rtype: dict
+    """
+    payload = {'param_{}'.format(i): ['legacy value {}'.format(i)] if nested
+               else 'legacy value {}'.format(i)
+               for i in range(num_params)}
+    if payload_size:
+        entry = {'event': 'renewal', 'date': '2019-01-01T00:00:00', 'amount': '10.00'}
+        entry_size = len(json.dumps(entry)) + 1
+        payload['history'] = [dict(entry, seq=i) for i in range(payload_size // entry_size)]
+    return payload
+
+
+def make_request_json(num_params=10, num_items=10, payload=None,
+                      request_id='PR-0000-0000-0000', migration_key='migration_info'):
+    """ Build the JSON representation of a fulfillment request.
+
+    :param int num_params: Number of asset params, not counting the migration param.
+    :param int num_items: Number of asset items.
+    :param dict payload: Legacy data stored in the migration param. Defaults to a payload with
+      a value for every param.
+    :param str request_id: Id of the request.
+    :param str migration_key: Id of the migration param.
+    :rtype: dict
+    """
+    if payload is None:
+        payload = make_payload(num_params)
+    params = [_make_param('param_{}'.format(i), '') for i in range(num_params)]
+    params.append(_make_param(migration_key, json.dumps(payload)))
+    company = {'id': 'PA-000-000', 'name': 'Synthetic Provider'}
+    contact_info = {
+        'address_line1': 'Street 1',
+        'address_line2': '',
+        'city': 'Barcelona',
+        'country': 'es',
+        'postal_code': '08001',
+        'state': 'Barcelona',
+        'contact': {
+            'email': 'contact@example.com',
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'phone_number': {'country_code': '+34', 'area_code': '', 'phone_number': '000000000',
+                             'extension': ''},
+        },
+    }
+    return {
+        'id': request_id,
+        'type': 'purchase',
+        'status': 'pending',
+        'created': '2019-01-01T00:00:00+00:00',
+        'updated': '2019-01-01T00:00:00+00:00',
+        'activation_key': '',
+        'marketplace': {'id': 'MP-00000', 'name': 'Synthetic Marketplace'},
+        'contract': {'id': 'CRD-00000-00000-00000', 'name': 'Synthetic Contract'},
+        'asset': {
+            'id': 'AS-000-000-000-0',
+            'external_id': '1000000',
+            'external_uid': '00000000-0000-0000-0000-000000000000',
+            'product': {'id': 'PRD-000-000-000', 'name': 'Synthetic Product'},
+            'connection': {
+                'id': 'CT-0000-0000',
+                'type': 'test',
+                'provider': company,
+                'vendor': {'id': 'VA-000-000', 'name': 'Synthetic Vendor'},
+            },
+            'tiers': {
+                'customer': {'id': 'TA-0000-0000-0000', 'name': 'Customer',
+                             'contact_info': contact_info},
+                'tier1': {'id': 'TA-0000-0000-0001', 'name': 'Reseller',
+                          'contact_info': contact_info},
+            },
+            'items': [
+                {'id': 'ITEM_{}'.format(i), 'mpn': 'MPN-{}'.format(i), 'quantity': '1',
+                 'old_quantity': '0', 'renewal': None}
+                for i in range(num_items)
+            ],
+            'params': params,
+        },
+    }
+
+
+def make_request(*args, **kwargs):
+    """ Same as :py:func:`make_request_json`, but returns a deserialized request.
+
+    :rtype: Fulfillment
+    """
+    return Fulfillment.deserialize_json(make_request_json(*args, **kwargs))
+
+
+def _make_param(param_id, value):
+    return {
+        'id': param_id,
+        'name': param_id,
+        'title': None,
+        'description': 'Synthetic parameter {}.'.format(param_id),
+        'scope': None,
+        'value': value,
+        'value_error': None,
+        'type': 'text',
+        'constraints': {'hidden': False, 'required': False, 'unique': False},
+        'value_choices': [],
+    }
@@ -30,69 +30,1624 @@ We can use an instance of this class into our request processor, like this: ::
 
 """
 
+import collections
+import contextlib
 import copy
+import hashlib
+import inspect
 import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+import timeit
 
 import six
-from typing import List
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple,
+                    TYPE_CHECKING)
 
-from connect.exceptions import SkipRequest
-from connect.logger import logger
-from connect.models import Fulfillment
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+if TYPE_CHECKING:  # pragma: no cover
+    import sqlite3
+    from connect.models import Fulfillment, Param
+
+# The Connect SDK is imported the first time it is needed, since importing any of its modules
+# imports all of them, which takes most of the startup time of short-lived processes.
+
+
+class _LazyLogger(object):
+    """ Proxy of the Connect SDK logger, which imports it when it is first used. """
+
+    _logger = None
+
+    def __getattr__(self, name):
+        # Only called for the attributes of the SDK logger, which is resolved once
+        if self._logger is None:
+            from connect.logger import logger as sdk_logger
+            self._logger = sdk_logger
+        return getattr(self._logger, name)
+
+
+logger = _LazyLogger()
 
 
 class MigrationAbortError(Exception):
-    pass
+    """ Raised when the migration of a request cannot be completed.
+
+    :param str message: Exception message.
+    :param list[ParamError] errors: The errors of the params that failed, if any.
+    """
+
+    def __init__(self, message='', errors=()):
+        super(MigrationAbortError, self).__init__(message)
+        self.errors = tuple(errors)  # type: Tuple[ParamError, ...]
 
 
 class MigrationParamError(Exception):
     pass
 
 
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+""" Statistics of a cache, with the same fields as the one returned by
+:py:func:`functools.lru_cache`. """
+
+
+class _LRUCache(object):
+    """ Thread-safe mapping that keeps up to ``maxsize`` items, discarding the least recently
+    used ones, and optionally the ones stored more than ``ttl`` seconds ago. """
+
+    def __init__(self, maxsize, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            if expires is not None and expires <= timeit.default_timer():
+                self._misses += 1
+                return default
+            self._items[key] = (value, expires)
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = timeit.default_timer() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            if len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._items))
+
+    def __getstate__(self):
+        # Locks cannot be pickled, and cached items are not worth sending to other processes
+        return {'_maxsize': self._maxsize, '_ttl': self._ttl}
+
+    def __setstate__(self, state):
+        self.__init__(state['_maxsize'], state.get('_ttl'))
+
+
+def pure(*keys):
+    """ Decorator that marks a transformation function as pure, so its results can be cached
+    by a :py:class:`MigrationHandler` created with ``transformation_cache_size``.
+
+    A pure transformation returns the same value for the same values of the given top-level
+    keys of the migration data, does not use the other keys, and does not use the request id,
+    nor has side effects. Results are cached by param and the values of these keys. ::
+
+        @pure('teamId')
+        def team_id(data, request_id):
+            return team_lookup(data['teamId'])
+
+    Transformations compiled from specifications are always pure.
+
+    :param str keys: The top-level keys of the migration data that the function reads.
+    :return: The decorator.
+    :rtype: callable
+    """
+    if not keys:
+        raise ValueError('A pure transformation must declare the keys it reads.')
+
+    def decorator(func):
+        func.keys = keys
+        func.pure = True
+        return func
+    return decorator
+
+
+def reads(*keys):
+    """ Decorator that declares the top-level keys of the migration data that a transformation
+    function reads, so a :py:class:`MigrationHandler` created with ``partial_decode`` only
+    decodes these keys. Functions without declared keys receive the whole migration data. ::
+
+        @reads('teamId', 'teamName')
+        def team(data, request_id):
+            return '{} ({})'.format(data['teamName'], data['teamId'])
+
+    Keys declared with :py:func:`pure` and the keys of specifications are used too.
+
+    :param str keys: The top-level keys of the migration data that the function reads.
+    :return: The decorator.
+    :rtype: callable
+    """
+    def decorator(func):
+        func.keys = keys
+        return func
+    return decorator
+
+
+def depends(*names):
+    """ Decorator that declares the derived fields that a transformation function, or another
+    derived field, needs. Derived fields are intermediate values given to the handler in
+    ``derived``, which are computed once per request and passed to the functions that depend
+    on them as keyword arguments: ::
+
+        @reads('teamId')
+        def team(data, request_id):
+            return team_directory.lookup(data['teamId'].strip().lower())
+
+        @depends('team')
+        def team_name(data, request_id, team):
+            return team['name']
+
+        handler = MigrationHandler({'team_name': team_name}, derived={'team': team})
+
+    :param str names: The names of the derived fields.
+    :return: The decorator.
+    :rtype: callable
+    """
+    def decorator(func):
+        func.depends = names
+        return func
+    return decorator
+
+
+def _declared_depends(func):
+    # type: (Callable) -> Tuple[str, ...]
+    names = getattr(func, 'depends', None)
+    return tuple(names) if isinstance(names, (tuple, list)) else ()
+
+
+def _declared_keys(transformation):
+    # type: (Callable) -> Optional[Tuple[str, ...]]
+    keys = getattr(transformation, 'keys', None)
+    return tuple(keys) if isinstance(keys, (tuple, list, set, frozenset)) else None
+
+
+# Returned when processing a param that has neither a transformation nor migration data
+_SKIPPED = object()
+
+# Outcome of a step that was not run, because the validation policy stopped the migration
+_NOT_RUN = object()
+
+# Default value for lookups where None is a valid value
+_MISSING = object()
+
+# Errors of a spec operation that come from the value it is applied to
+_OPERATION_ERRORS = (ValueError, TypeError, AttributeError, ArithmeticError)
+
+
+MigrationStep = collections.namedtuple('MigrationStep',
+                                       ['index', 'param_id', 'action', 'transformation'])
+""" Action to perform on one param, as part of a :py:class:`MigrationPlan`. ``index`` is the
+position of the param in the asset params, and ``transformation`` is the transformation
+function when ``action`` is :py:attr:`MigrationPlan.TRANSFORM`, or ``None`` otherwise. """
+
+
+class MigrationPlan(object):
+    """ Precomputed actions for the params of the requests of a product. It is compiled by
+    :py:meth:`MigrationHandler.compile_plan` the first time that a product with a certain
+    list of params is migrated, and reused for the following requests.
+
+    :param str product_id: Id of the product.
+    :param tuple[str] param_ids: Ids of the asset params, in the order they appear in the asset.
+    :param tuple[MigrationStep] steps: Actions to perform, in the order of the params. The
+      migration param is not included.
+    """
+
+    TRANSFORM = 'transform'
+    """ The value is produced by a transformation function. """
+
+    ASSIGN = 'assign'
+    """ The value is assigned from the migration data, which must be a string. The param is
+    skipped if the migration data does not contain it. """
+
+    SERIALIZE = 'serialize'
+    """ Same as :py:attr:`ASSIGN`, but non-string values are serialized. """
+
+    def __init__(self, product_id, param_ids, steps):
+        self.product_id = product_id  # type: str
+        self.param_ids = param_ids  # type: Tuple[str, ...]
+        self.steps = steps  # type: Tuple[MigrationStep, ...]
+        self.keys = self._compute_keys(steps)  # type: Optional[frozenset]
+        """ Top-level keys of the migration data that the steps read, or ``None`` if a
+        transformation does not declare its keys, so it needs the whole migration data. """
+
+    @staticmethod
+    def _compute_keys(steps):
+        # type: (Tuple[MigrationStep, ...]) -> Optional[frozenset]
+        keys = set()
+        for step in steps:
+            if step.action != MigrationPlan.TRANSFORM:
+                keys.add(step.param_id)
+                continue
+            step_keys = _declared_keys(step.transformation)
+            if step_keys is None:
+                return None
+            keys.update(step_keys)
+        return frozenset(keys)
+
+
+ParamError = collections.namedtuple('ParamError', ['param_id', 'stage', 'message'])
+""" Error of a param whose migration failed. ``stage`` is ``validation`` if it was detected by
+the validation done before running any transformation, or ``processing`` otherwise. """
+
+
+class _MigrationReport(object):
+    """ Keeps track of the processing status of the params of a request. """
+
+    def __init__(self):
+        self.processed = []  # type: List[str]
+        self.succeeded = []  # type: List[str]
+        self.failed = []  # type: List[str]
+        self.skipped = []  # type: List[str]
+        self.errors = []  # type: List[ParamError]
+
+
+def _to_bool(value):
+    # type: (Any) -> bool
+    if isinstance(value, six.string_types):
+        if value.strip().lower() in ('1', 'true', 'yes', 'y', 'on'):
+            return True
+        if value.strip().lower() in ('', '0', 'false', 'no', 'n', 'off'):
+            return False
+        raise ValueError('invalid boolean literal: {!r}'.format(value))
+    return bool(value)
+
+
+class TransformationSpec(object):
+    """ Transformation function compiled from a declarative specification. Instances can be used
+    wherever a transformation function is expected, and dicts passed as transformations to
+    :py:class:`MigrationHandler` are compiled automatically.
+
+    The specification is a dict with the following keys, of which only ``source`` is required.
+    The value is read from ``source`` and then the rest of operations are applied in the
+    order below:
+
+    - **source** (str|list[str]): Path of the value in the migration data, with the keys
+      separated by dots, like ``team.admin.email``. Numeric keys are used as list indexes when
+      the value is a list, like ``resellerId.0``. If it is a list of paths, the value is the
+      list of values of all of them.
+    - **default** (Any): Value to use, as is, when a source is not found. If it is not given,
+      a missing source makes the param fail.
+    - **join** (str): If the value is a list, its items are converted to string and joined
+      with this separator.
+    - **strip** (bool): Whether to strip whitespace from both ends of the value.
+    - **case** (str): One of ``upper``, ``lower``, ``title`` or ``capitalize``.
+    - **map** (dict): Replaces the value with the one with that key in the dict, if any.
+    - **cast** (str): One of ``str``, ``int``, ``float``, ``bool`` or ``json``, which
+      serializes the value.
+    - **multiply** (int|float): Multiplies the value by this number.
+
+    Any failure reading the source or applying an operation is raised as a
+    :py:class:`MigrationParamError`. ::
+
+        {
+            'team_id': {'source': 'teamId', 'case': 'upper'},
+            'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+            'reseller_id': {'source': 'resellerId', 'join': ','},
+        }
+
+    :param dict spec: The specification.
+    :raises ValueError: Raised if the specification is not valid.
+    """
+
+    pure = True
+    """ Specifications only depend on their :py:attr:`keys`, so their results can be cached
+    (see :py:func:`pure`). """
+
+    CASES = {
+        'upper': lambda value: value.upper(),
+        'lower': lambda value: value.lower(),
+        'title': lambda value: value.title(),
+        'capitalize': lambda value: value.capitalize(),
+    }
+
+    CASTS = {
+        'str': six.text_type,
+        'int': int,
+        'float': float,
+        'bool': _to_bool,
+        'json': json.dumps,
+    }
+
+    OPTIONS = ('source', 'default', 'join', 'strip', 'case', 'map', 'cast', 'multiply')
+
+    def __init__(self, spec):
+        unknown = sorted(set(spec) - set(self.OPTIONS))
+        if unknown:
+            raise ValueError('Unknown transformation options: {}.'.format(', '.join(unknown)))
+        if not spec.get('source'):
+            raise ValueError('Transformation `source` is required.')
+        if spec.get('case') is not None and spec['case'] not in self.CASES:
+            raise ValueError('Unknown transformation case `{}`.'.format(spec['case']))
+        if spec.get('cast') is not None and spec['cast'] not in self.CASTS:
+            raise ValueError('Unknown transformation cast `{}`.'.format(spec['cast']))
+
+        self._spec = dict(spec)
+        self._multiple = not isinstance(spec['source'], six.string_types)
+        sources = spec['source'] if self._multiple else [spec['source']]
+        self._paths = tuple(self._compile_path(source) for source in sources)
+        self._has_default = 'default' in spec
+        self._default = spec.get('default')
+        self._operations = tuple(self._compile_operations(spec))
+
+    @property
+    def spec(self):
+        """
+        :return: The specification the transformation was compiled from.
+        :rtype: dict
+        """
+        return self._spec
+
+    @property
+    def keys(self):
+        """
+        :return: The top-level keys of the migration data that the transformation reads.
+        :rtype: tuple[str]
+        """
+        return tuple(path[0][0] for path in self._paths)
+
+    def __call__(self, data, request_id=None):
+        value = self._read_source(data)
+        if value is _MISSING:
+            return self._default
+        try:
+            for operation, _ in self._operations:
+                value = operation(value)
+        except _OPERATION_ERRORS as ex:
+            raise self._operation_error(ex)
+        return value
+
+    def apply_column(self, data_list):
+        """ Applies the transformation to the migration data of several requests at once.
+
+        Each operation is applied to the whole column of values in a single batch, vectorized
+        with NumPy when it is installed and the operation allows it. If the batch fails, the
+        operation is applied to each value separately, so a failure only affects its request.
+
+        :param list[dict] data_list: The migration data of every request.
+        :return: A ``(value, error)`` tuple for each request, in the same order, where
+          ``error`` is a :py:class:`MigrationParamError` or ``None``.
+        :rtype: list[tuple]
+        """
+        outcomes = [None] * len(data_list)  # type: List[Any]
+        rows, column = self._read_column(data_list)
+        if column is None:
+            rows, column = self._read_column_separately(data_list, outcomes)
+
+        for operation, column_operation in self._operations:
+            try:
+                column = column_operation(column)
+            except _OPERATION_ERRORS:
+                # Find out which values fail, and leave them out of the following operations
+                rows, column = self._apply_separately(operation, rows, column, outcomes)
+
+        for row, value in zip(rows, column):
+            outcomes[row] = (value, None)
+        return outcomes
+
+    def _read_column(self, data_list):
+        # type: (List[dict]) -> Tuple[Any, Optional[List[Any]]]
+        # Fast path for the common case of a single top-level key found in every request
+        if self._multiple or len(self._paths[0]) != 1:
+            return None, None
+        key = self._paths[0][0][0]
+        try:
+            column = [data[key] for data in data_list]
+        except (KeyError, IndexError, TypeError):
+            return None, None
+        return range(len(column)), column
+
+    def _read_column_separately(self, data_list, outcomes):
+        # type: (List[dict], List[Any]) -> Tuple[List[int], List[Any]]
+        rows = []  # type: List[int]
+        column = []  # type: List[Any]
+        for row, data in enumerate(data_list):
+            try:
+                value = self._read_source(data)
+            except MigrationParamError as ex:
+                outcomes[row] = (None, ex)
+                continue
+            if value is _MISSING:
+                outcomes[row] = (self._default, None)
+            else:
+                rows.append(row)
+                column.append(value)
+        return rows, column
+
+    def validate(self, data):
+        """ Checks that the sources of the transformation are found in the migration data,
+        or that it has a default value, without applying any operation.
+
+        :param dict data: The migration data.
+        :raises MigrationParamError: Raised if a source is not found.
+        """
+        self._read_source(data)
+
+    def _read_source(self, data):
+        # type: (dict) -> Any
+        # Returns _MISSING if the source is not found and there is a default value
+        values = []
+        for path in self._paths:
+            value = data
+            try:
+                for key, index in path:
+                    value = value[index] if index is not None and isinstance(value, list) \
+                        else value[key]
+            except (KeyError, IndexError, TypeError):
+                if self._has_default:
+                    return _MISSING
+                raise MigrationParamError('Value `{}` not found in migration data.'
+                                          .format('.'.join(key for key, _ in path)))
+            values.append(value)
+        return values if self._multiple else values[0]
+
+    def _apply_separately(self, operation, rows, column, outcomes):
+        # type: (Callable, List[int], List[Any], List[Any]) -> Tuple[List[int], List[Any]]
+        valid_rows = []
+        valid_column = []
+        for row, value in zip(rows, column):
+            try:
+                valid_column.append(operation(value))
+            except _OPERATION_ERRORS as ex:
+                outcomes[row] = (None, self._operation_error(ex))
+            else:
+                valid_rows.append(row)
+        return valid_rows, valid_column
+
+    def _operation_error(self, ex):
+        # type: (Exception) -> MigrationParamError
+        return MigrationParamError('Transformation of `{}` failed: {}'
+                                   .format(self._spec['source'], ex))
+
+    def __reduce__(self):
+        # Compiled operations are closures, so the specification is pickled instead
+        return TransformationSpec, (self._spec,)
+
+    def __repr__(self):
+        return 'TransformationSpec({!r})'.format(self._spec)
+
+    @staticmethod
+    def _compile_path(source):
+        # type: (str) -> Tuple[Tuple[str, Optional[int]], ...]
+        return tuple((key, int(key) if key.isdigit() else None) for key in source.split('.'))
+
+    def _compile_operations(self, spec):
+        # type: (dict) -> Iterator[Tuple[Callable[[Any], Any], Callable[[list], list]]]
+        # Every operation is a pair of functions, for one value and for a column of values
+        if spec.get('join') is not None:
+            separator = spec['join']
+
+            def join(value):
+                return separator.join(six.text_type(item) for item in value) \
+                    if isinstance(value, (list, tuple)) else value
+            yield join, lambda column: [join(value) for value in column]
+        if spec.get('strip'):
+            yield (lambda value: value.strip(),
+                   lambda column: list(map(six.text_type.strip, column)))
+        if spec.get('case') is not None:
+            case = getattr(six.text_type, spec['case'])
+            yield self.CASES[spec['case']], lambda column: list(map(case, column))
+        if spec.get('map') is not None:
+            mapping = spec['map']
+            yield (lambda value: mapping.get(value, value),
+                   lambda column: [mapping.get(value, value) for value in column])
+        if spec.get('cast') is not None:
+            cast = self.CASTS[spec['cast']]
+            yield cast, lambda column: list(map(cast, column))
+        if spec.get('multiply') is not None:
+            factor = spec['multiply']
+
+            def multiply(value):
+                if isinstance(value, bool) or not isinstance(value, _NUMBER_TYPES):
+                    raise TypeError('cannot multiply a value of type {}'
+                                    .format(type(value).__name__))
+                return value * factor
+            yield multiply, lambda column: _multiply_column(column, factor)
+
+
+_NUMBER_TYPES = six.integer_types + (float,)
+
+# Types of the values that are serialized without checking their size as they are encoded
+_JSON_SCALAR_TYPES = _NUMBER_TYPES + (bool, type(None))
+
+# Columns shorter than this are multiplied in Python, as converting them to arrays costs more
+_NUMPY_MIN_SIZE = 64
+
+_INT64_MAX = 2 ** 63 - 1
+
+_numpy = None  # type: Any
+
+
+def _load_numpy():
+    # type: () -> Any
+    # NumPy is optional and slow to import, so it is only imported for the first column
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def _multiply_column(column, factor):
+    # type: (List[Any], Any) -> List[Any]
+    types = set(map(type, column))
+    if bool in types or not types.issubset(_NUMBER_TYPES):
+        for value in column:
+            if isinstance(value, bool) or not isinstance(value, _NUMBER_TYPES):
+                raise TypeError('cannot multiply a value of type {}'
+                                .format(type(value).__name__))
+
+    numpy = _load_numpy() if len(column) >= _NUMPY_MIN_SIZE and len(types) == 1 else None
+    if numpy is not None and types.issubset(_NUMBER_TYPES):
+        # Only homogeneous columns, where NumPy gives the same results as Python
+        if float in types or isinstance(factor, float):
+            return (numpy.array(column, dtype=float) * factor).tolist()
+        largest = max(max(column), -min(column))
+        if largest * abs(factor) <= _INT64_MAX:
+            return (numpy.array(column, dtype=numpy.int64) * factor).tolist()
+    return [value * factor for value in column]
+
+
+def load_transformations(filename):
+    """ Loads transformation specifications from a file, to be passed to
+    :py:class:`MigrationHandler`.
+
+    The file must contain an object with the param ids as keys, and the specification of their
+    transformation as values (see :py:class:`TransformationSpec`). JSON files are supported,
+    and YAML files too (``.yml`` or ``.yaml`` extension) if PyYAML is installed.
+
+    :param str filename: Path of the file.
+    :return: The compiled transformations.
+    :rtype: dict[str, TransformationSpec]
+    :raises ValueError: Raised if the file contents are not valid.
+    """
+    with open(filename) as file_handle:
+        if filename.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('PyYAML must be installed to load `{}`.'.format(filename))
+            specs = yaml.safe_load(file_handle)
+        else:
+            specs = json.load(file_handle)
+    if not isinstance(specs, dict):
+        raise ValueError('Transformations file `{}` must contain an object.'.format(filename))
+    return {param_id: TransformationSpec(spec) for param_id, spec in specs.items()}
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_DECODER = json.JSONDecoder()
+
+# Decodes values without building their objects, so skipping a large value takes little memory
+_JSON_SKIPPER = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+
+
+def _decode_object_keys(raw_data, keys):
+    # type: (str, frozenset) -> Optional[dict]
+    """ Decodes only the given top-level keys of a JSON object. The values of the rest of keys
+    are validated but discarded as they are scanned, instead of being materialized. Returns
+    ``None`` if the document is not an object, so it must be fully decoded instead.
+
+    :raises ValueError: Raised if the document is not valid JSON.
+    """
+    whitespace = _JSON_WHITESPACE.match
+    index = whitespace(raw_data, 0).end()
+    if raw_data[index:index + 1] != '{':
+        return None
+
+    result = {}
+    index = whitespace(raw_data, index + 1).end()
+    if raw_data[index:index + 1] == '}':
+        index += 1
+    else:
+        while True:
+            if raw_data[index:index + 1] != '"':
+                raise ValueError('Expecting property name at char {}'.format(index))
+            key, index = json.decoder.scanstring(raw_data, index + 1)
+            index = whitespace(raw_data, index).end()
+            if raw_data[index:index + 1] != ':':
+                raise ValueError('Expecting \':\' delimiter at char {}'.format(index))
+            index = whitespace(raw_data, index + 1).end()
+
+            if key in keys:
+                result[key], index = _JSON_DECODER.raw_decode(raw_data, index)
+            else:
+                _, index = _JSON_SKIPPER.raw_decode(raw_data, index)
+
+            index = whitespace(raw_data, index).end()
+            delimiter = raw_data[index:index + 1]
+            index = whitespace(raw_data, index + 1).end()
+            if delimiter == '}':
+                break
+            if delimiter != ',':
+                raise ValueError('Expecting \',\' delimiter at char {}'.format(index))
+
+    if whitespace(raw_data, index).end() != len(raw_data):
+        raise ValueError('Extra data at char {}'.format(index))
+    return result
+
+
+class MigrationObserver(object):
+    """ Base class for objects that receive measurements of the migrations performed by a
+    :py:class:`MigrationHandler`. Subclasses override the methods they are interested in.
+
+    Timings are reported with these names:
+
+    - ``copy``: Copy of the request.
+    - ``parse``: Parse of the migration data.
+    - ``transformation.<param_id>``: Run of the transformation of a param.
+    - ``column.<param_id>``: Run of the transformation of a param for a whole batch of
+      requests in :py:meth:`MigrationHandler.migrate_columnar`. Its request id is ``None``.
+    - ``derived.<name>``: Computation of a derived field (see :py:func:`depends`).
+    - ``total``: Whole migration of a request that needs migration.
+
+    Counts are reported with these names:
+
+    - ``params.succeeded``, ``params.failed`` and ``params.skipped``: Number of params with
+      each status in a request.
+    - ``requests.migrated``, ``requests.failed`` and ``requests.not_needed``: Outcome of the
+      migration of a request.
+    - ``requests.restored``: A request whose result was restored from a checkpoint store.
+    """
+
+    def timing(self, request_id, name, seconds):
+        """ Called when a measured operation finishes.
+
+        :param str|None request_id: The id of the request being migrated, or ``None`` if the
+          operation is performed for a batch of requests.
+        :param str name: Name of the operation.
+        :param float seconds: Wall time spent in the operation.
+        """
+
+    def count(self, request_id, name, value):
+        """ Called to increment a counter.
+
+        :param str request_id: The id of the request being migrated.
+        :param str name: Name of the counter.
+        :param int value: Amount to increment.
+        """
+
+
+class MigrationMetrics(MigrationObserver):
+    """ Observer that aggregates measurements in memory. It is thread-safe, so it can be shared
+    by handlers migrating requests concurrently.
+
+    :param int max_samples: Maximum number of most recent timings kept for each operation to
+      calculate percentiles. Default value is ``10000``.
+    """
+
+    def __init__(self, max_samples=10000):
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {}  # type: Dict[str, collections.deque]
+        self._totals = collections.Counter()  # type: collections.Counter
+        self._calls = collections.Counter()  # type: collections.Counter
+        self._counters = collections.Counter()  # type: collections.Counter
+
+    def timing(self, request_id, name, seconds):
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = collections.deque(maxlen=self._max_samples)
+            self._samples[name].append(seconds)
+            self._totals[name] += seconds
+            self._calls[name] += 1
+
+    def count(self, request_id, name, value):
+        with self._lock:
+            self._counters[name] += value
+
+    @property
+    def counters(self):
+        """
+        :return: The value of every counter.
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def percentile(self, name, percent):
+        """
+        :param str name: Name of the operation.
+        :param float percent: Percentile to calculate, between 0 and 100.
+        :return: The given percentile of the timings of the operation, or ``None`` if it has not
+          been measured.
+        :rtype: float|None
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        return self._percentile(samples, percent)
+
+    def summary(self):
+        """
+        :return: For every operation, its number of calls (``count``), ``total`` and ``mean``
+          time, and the ``min``, ``max``, ``p50``, ``p90`` and ``p99`` of the recent timings.
+        :rtype: dict[str, dict[str, float]]
+        """
+        with self._lock:
+            names = list(self._samples)
+            samples = {name: sorted(self._samples[name]) for name in names}
+            totals = dict(self._totals)
+            calls = dict(self._calls)
+
+        return {
+            name: {
+                'count': calls[name],
+                'total': totals[name],
+                'mean': totals[name] / calls[name],
+                'min': samples[name][0],
+                'max': samples[name][-1],
+                'p50': self._percentile(samples[name], 50),
+                'p90': self._percentile(samples[name], 90),
+                'p99': self._percentile(samples[name], 99),
+            }
+            for name in names
+        }
+
+    def reset(self):
+        """ Discards all measurements. """
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._calls.clear()
+            self._counters.clear()
+
+    def __getstate__(self):
+        # Locks cannot be pickled, so only the measurements are sent to other processes
+        with self._lock:
+            return {
+                '_max_samples': self._max_samples,
+                '_samples': {name: list(samples) for name, samples in self._samples.items()},
+                '_totals': dict(self._totals),
+                '_calls': dict(self._calls),
+                '_counters': dict(self._counters),
+            }
+
+    def __setstate__(self, state):
+        self.__init__(state['_max_samples'])
+        for name, samples in state['_samples'].items():
+            self._samples[name] = collections.deque(samples, maxlen=self._max_samples)
+        self._totals.update(state['_totals'])
+        self._calls.update(state['_calls'])
+        self._counters.update(state['_counters'])
+
+    @staticmethod
+    def _percentile(samples, percent):
+        # type: (List[float], float) -> Optional[float]
+        if not samples:
+            return None
+        # Nearest-rank method
+        rank = int(math.ceil(percent / 100.0 * len(samples)))
+        return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+class _Timer(object):
+    """ Context manager that reports the time spent in its block to an observer. """
+
+    __slots__ = ('_observer', '_request_id', '_name', '_started')
+
+    def __init__(self, observer, request_id, name):
+        self._observer = observer
+        self._request_id = request_id
+        self._name = name
+        self._started = None
+
+    def __enter__(self):
+        self._started = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self._observer.timing(self._request_id, self._name,
+                              timeit.default_timer() - self._started)
+
+
+class _NullTimer(object):
+    """ Context manager used instead of :py:class:`_Timer` when there is no observer. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class MigrationBatchItem(object):
+    """ Outcome of the migration of one request in a batch.
+
+    :param Fulfillment request: The request that was migrated.
+    :param Fulfillment|None result: The request returned by :py:meth:`MigrationHandler.migrate`,
+      or ``None`` if the migration failed.
+    :param Exception|None error: The ``SkipRequest`` or :py:class:`MigrationAbortError` raised
+      by the migration, any other exception raised by a transformation, or ``None`` if it
+      succeeded.
+    """
+
+    def __init__(self, request, result=None, error=None):
+        self.request = request  # type: Fulfillment
+        self.result = result  # type: Optional[Fulfillment]
+        self.error = error  # type: Optional[Exception]
+
+    @property
+    def succeeded(self):
+        """
+        :return: Whether the request was migrated, or did not need migration.
+        :rtype: bool
+        """
+        return self.error is None
+
+    @property
+    def errors(self):
+        """
+        :return: The errors of the params that failed, if any.
+        :rtype: tuple[ParamError]
+        """
+        return tuple(getattr(self.error, 'obj', None) or ())
+
+
+class MigrationBatchResult(object):
+    """ Outcome of :py:meth:`MigrationHandler.migrate_many`. It can be iterated to get the
+    :py:class:`MigrationBatchItem` objects in the same order as the requests were given.
+
+    :param list[MigrationBatchItem] items: The outcome of every request.
+    """
+
+    def __init__(self, items):
+        self._items = items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    @property
+    def items(self):
+        """
+        :return: The outcome of every request, in order.
+        :rtype: list[MigrationBatchItem]
+        """
+        return self._items
+
+    @property
+    def results(self):
+        """
+        :return: The migrated requests in order, with ``None`` for the ones that failed.
+        :rtype: list[Fulfillment|None]
+        """
+        return [item.result for item in self._items]
+
+    @property
+    def succeeded(self):
+        """
+        :return: The outcome of the requests that were migrated successfully.
+        :rtype: list[MigrationBatchItem]
+        """
+        return [item for item in self._items if item.succeeded]
+
+    @property
+    def failed(self):
+        """
+        :return: The outcome of the requests whose migration failed.
+        :rtype: list[MigrationBatchItem]
+        """
+        return [item for item in self._items if not item.succeeded]
+
+
+ParamChange = collections.namedtuple('ParamChange', ['id', 'old', 'new'])
+""" A param whose value is changed by a migration. """
+
+
+class MigrationDiff(object):
+    """ Outcome of :py:meth:`MigrationHandler.migrate_diff`.
+
+    :param str request_id: Id of the migrated request.
+    :param list[ParamChange] changes: The params whose value changed, in order.
+    :param _MigrationReport report: The outcome of every param.
+    """
+
+    def __init__(self, request_id, changes, report):
+        self.request_id = request_id  # type: str
+        self.changes = changes  # type: List[ParamChange]
+        self.processed = tuple(report.processed)  # type: Tuple[str, ...]
+        self.succeeded = tuple(report.succeeded)  # type: Tuple[str, ...]
+        self.failed = tuple(report.failed)  # type: Tuple[str, ...]
+        self.skipped = tuple(report.skipped)  # type: Tuple[str, ...]
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    @property
+    def params(self):
+        """
+        :return: New ``Param`` objects with the id and new value of the changed params, which
+          can be passed to ``update_parameters``.
+        :rtype: list[Param]
+        """
+        from connect.models import Param
+        return [Param(id=change.id, value=change.new) for change in self.changes]
+
+    def as_dict(self):
+        """
+        :return: The new value of every changed param, by param id.
+        :rtype: collections.OrderedDict
+        """
+        return collections.OrderedDict((change.id, change.new) for change in self.changes)
+
+
+class ParamRecord(object):
+    """ Lightweight record of an asset param in a :py:class:`MigratedRequest`, which keeps
+    its id, its migrated value and the original ``Param`` object, instead of a full copy of it.
+
+    :param str id: Id of the param.
+    :param Any value: Value of the param after the migration.
+    :param Param param: The original param, which is not modified.
+    """
+
+    __slots__ = ('id', 'value', 'param')
+
+    def __init__(self, id, value, param):
+        self.id = id  # type: str
+        self.value = value  # type: Any
+        self.param = param  # type: Param
+
+    def __repr__(self):
+        return 'ParamRecord(id={!r}, value={!r})'.format(self.id, self.value)
+
+    @property
+    def changed(self):
+        """
+        :return: Whether the migrated value is different from the original one.
+        :rtype: bool
+        """
+        return self.value != self.param.value
+
+    def to_param(self):
+        """
+        :return: A copy of the original param with the migrated value.
+        :rtype: Param
+        """
+        param = _shallow_copy(self.param)
+        param.value = self.value
+        return param
+
+
+class MigratedRequest(object):
+    """ Outcome of :py:meth:`MigrationHandler.migrate_records`. It can be iterated to get the
+    :py:class:`ParamRecord` of every asset param, in order.
+
+    :param Fulfillment request: The original request, which is not modified.
+    :param list[tuple[int,Any]] values: The migrated value of the params, by index.
+    :param bool copy_on_write: Whether :py:meth:`to_request` shares the objects that are not
+      modified with the original request, instead of doing a deep copy.
+    """
+
+    __slots__ = ('request', 'records', 'copy_on_write')
+
+    def __init__(self, request, values, copy_on_write=False):
+        params = request.asset.params
+        records = [ParamRecord(param.id, param.value, param) for param in params]
+        for index, value in values:
+            records[index].value = value
+        self.request = request  # type: Fulfillment
+        self.records = tuple(records)  # type: Tuple[ParamRecord, ...]
+        self.copy_on_write = copy_on_write  # type: bool
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    @property
+    def changes(self):
+        """
+        :return: The params whose value changed, in order.
+        :rtype: list[ParamChange]
+        """
+        return [ParamChange(record.id, record.param.value, record.value)
+                for record in self.records if record.changed]
+
+    @property
+    def params(self):
+        """
+        :return: Copies of the changed params with their new value, which can be passed to
+          ``update_parameters``.
+        :rtype: list[Param]
+        """
+        return [record.to_param() for record in self.records if record.changed]
+
+    def to_request(self):
+        """
+        :return: A new request object with the parameter values updated, like the one
+          returned by :py:meth:`MigrationHandler.migrate`.
+        :rtype: Fulfillment
+        """
+        values = [(index, record.value) for index, record in enumerate(self.records)
+                  if record.changed]
+        return _copy_with_values(self.request, values, self.copy_on_write)
+
+
+class MigrationCheckpointStore(object):
+    """ Base class of the stores used by a :py:class:`MigrationHandler` to keep the result of
+    the migrated requests, so they are not migrated again when the migration is resumed.
+
+    Results are keyed by request id and a hash of the migration data, so a request whose data
+    has changed is migrated again. This class stores nothing. Subclasses override
+    :py:meth:`get` and :py:meth:`put`, which can be called concurrently from several threads,
+    and from several processes if the store is used with a process pool.
+    """
+
+    def get(self, request_id, payload_hash):
+        """ Returns the stored result of a migration.
+
+        :param str request_id: Id of the request.
+        :param str payload_hash: SHA-1 hex digest of the migration data.
+        :return: Value of every migrated param, by param id, or ``None`` if there is no
+          result for the request and data.
+        :rtype: dict|None
+        """
+        return None
+
+    def put(self, request_id, payload_hash, values):
+        """ Stores the result of a migration.
+
+        :param str request_id: Id of the request.
+        :param str payload_hash: SHA-1 hex digest of the migration data.
+        :param dict values: Value of every migrated param, by param id. Values must be
+          serializable to JSON.
+        """
+        pass
+
+
+class SQLiteCheckpointStore(MigrationCheckpointStore):
+    """ Checkpoint store backed by a SQLite database, which can be shared by several threads
+    and processes.
+
+    :param str filename: Path of the database file, which is created if it does not exist.
+    :param float timeout: Seconds to wait for other writers to release the database.
+      Default value is ``30``.
+    """
+
+    def __init__(self, filename, timeout=30.0):
+        self._filename = filename
+        self._timeout = timeout
+        self._local = threading.local()
+
+        # Prepared once here, since changing the journal mode needs exclusive access
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints (request_id TEXT NOT NULL, '
+                'payload_hash TEXT NOT NULL, params TEXT NOT NULL, '
+                'PRIMARY KEY (request_id, payload_hash))')
+
+    @property
+    def filename(self):
+        """
+        :return: Path of the database file.
+        :rtype: str
+        """
+        return self._filename
+
+    def get(self, request_id, payload_hash):
+        row = self._connection().execute(
+            'SELECT params FROM checkpoints WHERE request_id = ? AND payload_hash = ?',
+            (request_id, payload_hash)).fetchone()
+        return json.loads(row[0], object_pairs_hook=collections.OrderedDict) if row else None
+
+    def put(self, request_id, payload_hash, values):
+        params = json.dumps(values)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO checkpoints (request_id, payload_hash, params) '
+                'VALUES (?, ?, ?)', (request_id, payload_hash, params))
+
+    def close(self):
+        """ Closes the connection of the current thread, if any. """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _connection(self):
+        # type: () -> sqlite3.Connection
+        # SQLite connections cannot be shared by threads, nor survive a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self._filename, timeout=self._timeout)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def __getstate__(self):
+        return {'_filename': self._filename, '_timeout': self._timeout}
+
+    def __setstate__(self, state):
+        # The database was already prepared by the original object
+        self._filename = state['_filename']
+        self._timeout = state['_timeout']
+        self._local = threading.local()
+
+
+class FileCheckpointStore(MigrationCheckpointStore):
+    """ Checkpoint store backed by an append-only JSON Lines file, which can be shared by
+    several threads and processes. Each result is written as a single line, under an exclusive
+    lock of the file where the platform supports it, and the lines written by other processes
+    are read when looking up a result that is not known yet.
+
+    :param str filename: Path of the file, which is created if it does not exist.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._results = {}  # type: Dict[Tuple[str, str], dict]
+        self._offset = 0
+        self._pending = b''
+
+    @property
+    def filename(self):
+        """
+        :return: Path of the file.
+        :rtype: str
+        """
+        return self._filename
+
+    def get(self, request_id, payload_hash):
+        key = (request_id, payload_hash)
+        with self._lock:
+            if key not in self._results:
+                self._read_new_lines()
+            return self._results.get(key)
+
+    def put(self, request_id, payload_hash, values):
+        line = json.dumps({'request_id': request_id, 'payload_hash': payload_hash,
+                           'params': values}) + '\n'
+        with self._lock:
+            with open(self._filename, 'ab') as file_handle:
+                if fcntl is not None:
+                    fcntl.flock(file_handle.fileno(), fcntl.LOCK_EX)
+                try:
+                    file_handle.write(line.encode('utf-8'))
+                    file_handle.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(file_handle.fileno(), fcntl.LOCK_UN)
+            self._results[(request_id, payload_hash)] = values
+
+    def _read_new_lines(self):
+        # type: () -> None
+        try:
+            with open(self._filename, 'rb') as file_handle:
+                file_handle.seek(self._offset)
+                data = self._pending + file_handle.read()
+                self._offset = file_handle.tell()
+        except IOError:
+            return
+
+        # The last line may still be being written by another process
+        lines = data.split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line.decode('utf-8'),
+                                    object_pairs_hook=collections.OrderedDict)
+                self._results[(record['request_id'], record['payload_hash'])] = \
+                    record['params']
+            except (ValueError, KeyError, TypeError) as ex:
+                # A process killed while writing may leave a truncated line
+                logger.warning('[MIGRATION] Ignoring invalid checkpoint in `%s`: %s',
+                               self._filename, ex)
+
+    def __getstate__(self):
+        return {'_filename': self._filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['_filename'])
+
+
+def _checkpoint_store_errors():
+    # type: () -> Tuple[type, ...]
+    # Errors of the store that do not make a migration fail. sqlite3 is only loaded if a
+    # SQLiteCheckpointStore was used
+    sqlite3 = sys.modules.get('sqlite3')
+    sqlite_errors = (sqlite3.Error,) if sqlite3 is not None else ()
+    return (TypeError, ValueError, EnvironmentError) + sqlite_errors
+
+
 class MigrationHandler(object):
     """ This class helps migrating data from a legacy service into Connect.
 
-    :param dict[str,callable] transformations: Contains the param id as keys, and the function that
-      produces the value of the parameter. This function will receive two arguments:
+    :param dict[str,callable|dict] transformations: Contains the param id as keys, and the
+      function that produces the value of the parameter. This function will receive two
+      arguments:
+
+      - **transform_data** (dict[str, Any]): Contains the entire transformation information as a
+        JSON object, parsed from the param with ``migration_key`` id (or merged from all of
+        them, if there are several).
+      - **request_id** (str): The id of the request being processed.
+
+      Instead of a function, a dict with a declarative specification can be given, which is
+      compiled into a :py:class:`TransformationSpec`.
+    :param str|list[str] migration_key: The name of the Connect parameter that stores the
+      legacy data in json format, or a list of them if the data is split across several
+      params. All of them are parsed and merged into a single object that is passed to the
+      transformations, according to ``merge_policy``, and none of them is migrated. Default
+      value is ``migration_info``.
+    :param str merge_policy: What to do when a top-level key is found in the migration data
+      of several params: with ``first`` the value of the first param in ``migration_key``
+      is used, with ``last`` the value of the last one is used, and with ``strict`` the
+      migration fails. Default value is ``first``.
+    :param bool serialize: If ``True``, it will automatically serialize any non-string value
+      in the migration data on direct assignation flow. Default value is ``False``.
+    :param bool copy_on_write: If ``True``, the returned request shares every object with the
+      original one except the asset, its list of params and the params whose value changes,
+      instead of being a deep copy of the original. The original request is never modified
+      in any case. Default value is ``False``.
+    :param callable decoder: Function used to parse the migration data, like ``orjson.loads``
+      or ``ujson.loads``. It receives the JSON string and must raise ``ValueError`` if it is not
+      valid. Default value is ``json.loads``.
+    :param int parse_cache_size: If greater than zero, up to this number of parsed migration
+      data objects are kept in memory, so migrating again a request whose migration data has not
+      changed does not parse it again. Cached objects are shared between migrations, so
+      transformations must not modify the data they receive. Default value is ``0``.
+    :param str log_payload: How the migration data is written in the debug log: ``full``
+      writes it as is, ``truncate`` writes up to ``log_payload_limit`` characters, and ``hash``
+      writes its SHA-1 hash and length. Default value is ``full``.
+    :param int log_payload_limit: Maximum number of characters of the migration data written
+      in the debug log when ``log_payload`` is ``truncate``. Default value is ``1024``.
+    :param logging.Logger param_logger: Logger for the messages about individual params, like
+      the ones written when running a transformation. Default value is the Connect SDK logger.
+    :param MigrationObserver observer: Object that receives timings and counts of the
+      migrations, like a :py:class:`MigrationMetrics`. Default value is ``None``.
+    :param int transformation_cache_size: If greater than zero, up to this number of results
+      of pure transformations (see :py:func:`pure`) are kept in memory, keyed by param and the
+      values of the keys that the transformation reads, so other requests with the same values
+      do not run the transformation again. Default value is ``0``.
+    :param float transformation_cache_ttl: If given, cached results of pure transformations
+      expire after this number of seconds. Default value is ``None``.
+    :param MigrationCheckpointStore checkpoint_store: Store where the result of every migrated
+      request is saved, keyed by request id and a hash of the migration data. Migrating a
+      request whose result is in the store returns it without running the migration again.
+      Default value is ``None``.
+    :param str validation: What to do when a param fails: ``collect_all`` processes all
+      params and reports the errors of all of them, and ``fail_fast`` stops at the first
+      error without running the rest of transformations. In both cases, the migration data
+      is validated before running any transformation: it must be an object, params without
+      transformation must be strings (unless ``serialize`` is given), and the sources of
+      specifications must be found. Default value is ``collect_all``.
+    :param bool partial_decode: If ``True``, only the top-level keys of the migration data
+      that the params need are decoded: the ids of the params without transformation, and the
+      keys declared by the transformations (see :py:func:`reads`). If any transformation does
+      not declare its keys, the whole migration data is decoded. It cannot be used with a
+      custom ``decoder``, nor with the ``strict`` merge policy and several migration params.
+      Default value is ``False``.
+    :param callable encoder: Function used to serialize the non-string values when
+      ``serialize`` is given, like ``orjson.dumps``. It receives the value and returns the JSON
+      string, as ``str`` or UTF-8 encoded ``bytes``. Default value is ``json.dumps``.
+    :param bool compact_serialization: If ``True``, values are serialized without spaces
+      after the separators. It cannot be used with a custom ``encoder``. Default value is
+      ``False``.
+    :param int max_serialized_size: If given, serializing a value into more than this number
+      of characters makes its param fail. The default encoder stops as soon as the limit is
+      exceeded, so the whole string is never built. To do so, it encodes lists and dicts with
+      the pure Python version of ``json``, which is several times slower than without a limit.
+      Default value is ``None``.
+    :param dict[str,callable] derived: Derived fields, by name. They are functions that receive
+      the same arguments as transformations, and compute intermediate values shared by
+      several transformations (see :py:func:`depends`). Every derived field needed by the
+      params of a request is computed once for that request, after the derived fields it
+      depends on. Default value is ``None``.
+    :param concurrent.futures.Executor derived_executor: If given, the derived fields that do
+      not depend on each other are computed concurrently in this executor. Otherwise, they are
+      computed in order the first time they are needed, which is also the case in the copies
+      of the handler sent to a process pool. Default value is ``None``.
+    :raises ValueError: Raised if a derived field is unknown, or derived fields depend on each
+      other in a cycle.
+    """
+
+    COLLECT_ALL = 'collect_all'
+    """ Validation policy that processes every param and reports all errors. """
+
+    FAIL_FAST = 'fail_fast'
+    """ Validation policy that stops at the first error. """
+
+    MERGE_FIRST = 'first'
+    """ Merge policy where the first migration param with a key takes precedence. """
+
+    MERGE_LAST = 'last'
+    """ Merge policy where the last migration param with a key takes precedence. """
+
+    MERGE_STRICT = 'strict'
+    """ Merge policy where a key found in several migration params makes the migration fail. """
+
+    def __init__(self, transformations=None, migration_key='migration_info', serialize=False,
+                 copy_on_write=False, decoder=None, parse_cache_size=0, log_payload='full',
+                 log_payload_limit=1024, param_logger=None, observer=None,
+                 transformation_cache_size=0, transformation_cache_ttl=None,
+                 checkpoint_store=None, partial_decode=False, validation='collect_all',
+                 encoder=None, compact_serialization=False, max_serialized_size=None,
+                 merge_policy='first', derived=None, derived_executor=None):
+        if log_payload not in ('full', 'truncate', 'hash'):
+            raise ValueError('Unknown log_payload `{}`, it must be `full`, `truncate` or `hash`.'
+                             .format(log_payload))
+        if partial_decode and decoder is not None:
+            raise ValueError('partial_decode cannot be used with a custom decoder.')
+        if compact_serialization and encoder is not None:
+            raise ValueError('compact_serialization cannot be used with a custom encoder.')
+        migration_keys = (migration_key,) if isinstance(migration_key, six.string_types) \
+            else tuple(migration_key)
+        if not migration_keys:
+            raise ValueError('At least one migration_key is required.')
+        if merge_policy not in (self.MERGE_FIRST, self.MERGE_LAST, self.MERGE_STRICT):
+            raise ValueError('Unknown merge_policy `{}`, it must be `{}`, `{}` or `{}`.'
+                             .format(merge_policy, self.MERGE_FIRST, self.MERGE_LAST,
+                                     self.MERGE_STRICT))
+        if partial_decode and merge_policy == self.MERGE_STRICT and len(migration_keys) > 1:
+            # Keys that are not decoded could not be checked, changing the outcome
+            raise ValueError('partial_decode cannot be used with the `strict` merge_policy.')
+        if validation not in (self.COLLECT_ALL, self.FAIL_FAST):
+            raise ValueError('Unknown validation `{}`, it must be `{}` or `{}`.'
+                             .format(validation, self.COLLECT_ALL, self.FAIL_FAST))
+        self._transformations = {
+            param_id: TransformationSpec(transformation) if isinstance(transformation, dict)
+            else transformation
+            for param_id, transformation in (transformations or {}).items()
+        }
+        self._migration_keys = migration_keys
+        self._merge_policy = merge_policy
+        self._serialize = serialize
+        self._copy_on_write = copy_on_write
+        self._decoder = decoder or json.loads
+        self._parse_cache = _LRUCache(parse_cache_size) if parse_cache_size > 0 else None
+        self._log_payload = log_payload
+        self._log_payload_limit = log_payload_limit
+        self._param_logger = param_logger
+        self._observer = observer
+        self._transformation_cache = \
+            _LRUCache(transformation_cache_size, transformation_cache_ttl) \
+            if transformation_cache_size > 0 else None
+        self._derived = dict(derived or {})
+        self._derived_executor = derived_executor
+        self._derived_depends = _derived_graph(self._derived, self._transformations)
+        # Functions depending on derived fields receive more than the keys they read
+        self._pure_keys = {
+            param_id: tuple(transformation.keys)
+            for param_id, transformation in self._transformations.items()
+            if getattr(transformation, 'pure', False) is True
+            and getattr(transformation, 'keys', None)
+            and not _declared_depends(transformation)
+        }
+        self._checkpoint_store = checkpoint_store
+        self._partial_decode = partial_decode
+        self._validation = validation
+        self._encoder = encoder
+        self._json_encoder = json.JSONEncoder(
+            separators=(',', ':') if compact_serialization else None)
+        self._max_serialized_size = max_serialized_size
+        self._plans = {}  # type: Dict[Tuple[Optional[str], Tuple[str, ...]], MigrationPlan]
+
+    @property
+    def transformations(self):
+        """
+        :return: The transformations defined for the handler, with specifications compiled.
+        :rtype: dict[str, callable]
+        """
+        return self._transformations
+
+    @property
+    def derived(self):
+        """
+        :return: The derived fields defined for the handler, by name.
+        :rtype: dict[str, callable]
+        """
+        return self._derived
+
+    @property
+    def migration_key(self):
+        """
+        :return: The id of the parameter that contains the migration data, or the first one if
+          there are several.
+        :rtype: str
+        """
+        return self._migration_keys[0]
+
+    @property
+    def migration_keys(self):
+        """
+        :return: The ids of all the parameters that contain migration data.
+        :rtype: tuple[str]
+        """
+        return self._migration_keys
+
+    @property
+    def merge_policy(self):
+        """
+        :return: Merge policy of the migration data of several params, :py:attr:`MERGE_FIRST`,
+          :py:attr:`MERGE_LAST` or :py:attr:`MERGE_STRICT`.
+        :rtype: str
+        """
+        return self._merge_policy
+
+    @property
+    def serialize(self):
+        """
+        :return: Whether the migration data is serialized automatically when it does not have
+          a transformation function and the data is not a string.
+        :rtype: bool
+        """
+        return self._serialize
+
+    @property
+    def copy_on_write(self):
+        """
+        :return: Whether the returned request only clones the objects that change during the
+          migration, sharing the rest with the original request.
+        :rtype: bool
+        """
+        return self._copy_on_write
+
+    @property
+    def decoder(self):
+        """
+        :return: The function used to parse the migration data.
+        :rtype: callable
+        """
+        return self._decoder
+
+    @property
+    def log_payload(self):
+        """
+        :return: How the migration data is written in the debug log (``full``, ``truncate``
+          or ``hash``).
+        :rtype: str
+        """
+        return self._log_payload
+
+    @property
+    def log_payload_limit(self):
+        """
+        :return: Maximum number of characters of the migration data written in the debug log
+          when ``log_payload`` is ``truncate``.
+        :rtype: int
+        """
+        return self._log_payload_limit
+
+    @property
+    def param_logger(self):
+        """
+        :return: The logger for the messages about individual params.
+        :rtype: logging.Logger
+        """
+        return self._param_logger or logger
+
+    @property
+    def observer(self):
+        """
+        :return: The object that receives timings and counts of the migrations, if any.
+        :rtype: MigrationObserver|None
+        """
+        return self._observer
 
-      - **transform_data** (dict[str, Any]): Contains the entire transformation information as a
-        JSON object, parsed from the param with ``migration_key`` id.
-      - **request_id** (str): The id of the request being processed.
-    :param str migration_key: The name of the Connect parameter that stores the legacy data
-      in json format. Default value is ``migration_info``.
-    :param bool serialize: If ``True``, it will automatically serialize any non-string value
-      in the migration data on direct assignation flow. Default value is ``False``.
-    """
+    @property
+    def validation(self):
+        """
+        :return: Validation policy, :py:attr:`COLLECT_ALL` or :py:attr:`FAIL_FAST`.
+        :rtype: str
+        """
+        return self._validation
 
-    def __init__(self, transformations=None, migration_key='migration_info', serialize=False):
-        self._transformations = transformations or {}
-        self._migration_key = migration_key
-        self._serialize = serialize
+    @property
+    def partial_decode(self):
+        """
+        :return: Whether only the keys of the migration data needed by the params are decoded.
+        :rtype: bool
+        """
+        return self._partial_decode
 
     @property
-    def transformations(self):
+    def encoder(self):
         """
-        :return: The transformations defined for the handler.
-        :rtype: dict[str, callable]
+        :return: Function used to serialize the non-string values, or ``None`` if the default
+          JSON encoder is used.
+        :rtype: callable|None
         """
-        return self._transformations
+        return self._encoder
 
     @property
-    def migration_key(self):
+    def max_serialized_size(self):
         """
-        :return: The id of the parameter that contains the migration data.
-        :rtype: str
+        :return: Maximum number of characters of a serialized value, if any.
+        :rtype: int|None
         """
-        return self._migration_key
+        return self._max_serialized_size
 
     @property
-    def serialize(self):
+    def checkpoint_store(self):
         """
-        :return: Whether the migration data is serialized automatically when it does not have
-          a transformation function and the data is not a string.
+        :return: Store of the results of migrated requests, if any.
+        :rtype: MigrationCheckpointStore|None
+        """
+        return self._checkpoint_store
+
+    def transformation_cache_info(self):
+        """
+        :return: Statistics of the cache of results of pure transformations, or ``None`` if it
+          is disabled.
+        :rtype: CacheInfo|None
+        """
+        return self._transformation_cache.info() \
+            if self._transformation_cache is not None else None
+
+    def parse_cache_info(self):
+        """
+        :return: Statistics of the parsed migration data cache, or ``None`` if it is disabled.
+        :rtype: CacheInfo|None
+        """
+        return self._parse_cache.info() if self._parse_cache is not None else None
+
+    def __getstate__(self):
+        # Executors cannot be pickled, so the copies sent to worker processes compute the
+        # derived fields in order
+        state = self.__dict__.copy()
+        state['_derived_executor'] = None
+        return state
+
+    def needs_migration(self, request):
+        """
+        :param Fulfillment request: The request to check.
+        :return: Whether any of the migration params of the request has a value.
         :rtype: bool
         """
-        return self._serialize
+        return any(request.needs_migration(key) for key in self._migration_keys)
 
     def migrate(self, request):
         """ Call this function to perform migration of one request.
@@ -103,91 +1658,1332 @@ class MigrationHandler(object):
         :raises SkipRequest: Raised if migration fails for some reason.
         :raises MigrationParamError: Raised if the value for a parameter is not a string.
         """
-        if request.needs_migration(self.migration_key):
-            logger.info('[MIGRATION::{}] Running migration operations for request {}'
-                        .format(request.id, request.id))
-            request_copy = copy.deepcopy(request)
+        if self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                        request.id, request.id)
+            with self._time(request.id, 'total'):
+                return self._migrate(request)
+        else:
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return request
+
+    def migrate_diff(self, request):
+        """ Call this function to perform migration of one request, getting only the params
+        whose values change instead of a copy of the request. ::
+
+            diff = self.migration_handler.migrate_diff(request)
+            self.update_parameters(request.id, diff.params)
+
+        :param Fulfillment request: The request to migrate.
+        :return: The changed params and the outcome of every param. It has no changes if the
+          request does not need migration.
+        :rtype: MigrationDiff
+        :raises SkipRequest: Raised if migration fails for some reason.
+        """
+        if self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                        request.id, request.id)
+            with self._time(request.id, 'total'):
+                values, report = self._migrate_values(request)
+            return self._build_diff(request, values, report)
+        else:
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return MigrationDiff(request.id, [], _MigrationReport())
+
+    def migrate_records(self, request):
+        """ Call this function to perform migration of one request without copying it. The
+        result keeps a lightweight :py:class:`ParamRecord` for every asset param, and the
+        request or its params are only copied when they are asked for: ::
+
+            migrated = self.migration_handler.migrate_records(request)
+            self.update_parameters(request.id, migrated.params)
+
+        This uses much less memory than :py:meth:`migrate` while many migrated requests are
+        kept, like in large batches.
+
+        :param Fulfillment request: The request to migrate.
+        :return: The migrated values. It has no changes if the request does not need
+          migration.
+        :rtype: MigratedRequest
+        :raises SkipRequest: Raised if migration fails for some reason.
+        """
+        if self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                        request.id, request.id)
+            with self._time(request.id, 'total'):
+                values, _ = self._migrate_values(request)
+            return MigratedRequest(request, values, self.copy_on_write)
+        else:
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return MigratedRequest(request, [], self.copy_on_write)
+
+    def _migrate(self, request):
+        # type: (Fulfillment) -> Fulfillment
+        values, _ = self._migrate_values(request)
+        return self._apply_values(request, values)
+
+    def _apply_values(self, request, values):
+        # type: (Fulfillment, List[Tuple[int, Any]]) -> Fulfillment
+        with self._time(request.id, 'copy'):
+            return _copy_with_values(request, values, self.copy_on_write)
+
+    def _migrate_values(self, request):
+        # type: (Fulfillment) -> Tuple[List[Tuple[int, Any]], _MigrationReport]
+        # Returns the new value of every migrated param by its index, without modifying them
+        checkpoint = self._checkpoint_key(request)
+        if checkpoint is not None:
+            restored = self._restore_checkpoint(checkpoint, request)
+            if restored is not None:
+                return restored
+
+        try:
+            plan = self._get_plan(request)
+            parsed_data = self._parse_migration_data(request, plan)
+            invalid = self._validate(plan, parsed_data)
+            steps = self._steps_to_run(plan, invalid)
+
+            # Steps are run lazily, so a fail-fast policy stops running them on the first error
+            outcomes = self._run_steps(steps, parsed_data, request.id, invalid)
+            values, report = self._collect_outcomes(request, steps, outcomes, invalid)
+        except MigrationAbortError as ex:
+            raise self._abort_migration(request, ex)
 
-            raw_data = request.asset.get_param_by_id(self.migration_key).value
-            logger.debug('[MIGRATION::{}] Migration data `{}`: {}'
-                         .format(request.id, self.migration_key, raw_data))
+        self._migration_succeeded(request, checkpoint, values)
+        return values, report
 
+    def _run_steps(self, steps, parsed_data, request_id, invalid):
+        # type: (Iterable[MigrationStep], dict, str, dict) -> Iterator[tuple]
+        derived = self._derived_values(parsed_data, request_id)
+        if derived is not None and self._derived_executor is not None:
+            derived.prefetch(self._needed_derived(
+                step for step in steps if step.index not in invalid))
+        for step in steps:
+            if step.index in invalid:
+                yield None, invalid[step.index]
+                continue
             try:
-                try:
-                    parsed_data = json.loads(raw_data)
-                except ValueError as ex:
-                    raise MigrationAbortError(str(ex))
-                logger.debug('[MIGRATION::{}] Migration data `{}` parsed correctly'
-                             .format(request.id, self.migration_key))
-
-                # These will keep track of processing status
-                processed_params = []
-                succeeded_params = []
-                failed_params = []
-                skipped_params = []
+                yield self._run_step(step, parsed_data, request_id, derived), None
+            except MigrationParamError as ex:
+                yield None, ex
 
-                # Exclude param for migration_info from process list
-                params = [param for param in request_copy.asset.params
-                          if param.id != self.migration_key]
-
-                for param in params:
-                    # Try to process the param and report success or failure
-                    try:
-                        if param.id in self.transformations:
-                            # Transformation is defined, so apply it
-                            logger.info('[MIGRATION::{}] Running transformation for parameter {}'
-                                        .format(request.id, param.id))
-                            param.value = self.transformations[param.id](parsed_data, request.id)
-                            succeeded_params.append(param.id)
-                        elif param.id in parsed_data:
-                            # Parsed data contains the key, so assign it
-                            if not isinstance(parsed_data[param.id], six.string_types):
-                                if self.serialize:
-                                    parsed_data[param.id] = json.dumps(parsed_data[param.id])
-                                else:
-                                    type_name = type(parsed_data[param.id]).__name__
-                                    raise MigrationParamError(
-                                        'Parameter {} type must be str, but {} was given'
-                                        .format(param.id, type_name))
-                            param.value = parsed_data[param.id]
-                            succeeded_params.append(param.id)
-                        else:
-                            skipped_params.append(param.id)
-                    except MigrationParamError as ex:
-                        logger.error('[MIGRATION::{}] {}'.format(request.id, ex))
-                        failed_params.append(param.id)
-
-                    # Report processed param
-                    processed_params.append(param.id)
-
-                logger.info('[MIGRATION::{}] {} processed, {} succeeded{}, {} failed{}, '
-                            '{} skipped{}.'
-                            .format(
-                                request.id,
-                                len(processed_params),
-                                len(succeeded_params),
-                                self._format_params(succeeded_params),
-                                len(failed_params),
-                                self._format_params(failed_params),
-                                len(skipped_params),
-                                self._format_params(skipped_params)))
-
-                # Raise abort if any params failed
-                if failed_params:
+    def _derived_values(self, parsed_data, request_id):
+        # type: (dict, str) -> Optional[_DerivedValues]
+        return _DerivedValues(self, parsed_data, request_id) if self._derived else None
+
+    def _needed_derived(self, steps):
+        # type: (Iterable[MigrationStep]) -> List[str]
+        # Returns the derived fields needed by the steps, including the ones they depend on
+        names = []  # type: List[str]
+        for step in steps:
+            if step.action == MigrationPlan.TRANSFORM:
+                names.extend(_declared_depends(step.transformation))
+        return _derived_closure(self._derived_depends, names)
+
+    def _derived_keys(self, plan):
+        # type: (MigrationPlan) -> Optional[frozenset]
+        keys = set(plan.keys)
+        for name in self._needed_derived(plan.steps):
+            derived_keys = _declared_keys(self._derived[name])
+            if derived_keys is None:
+                return None
+            keys.update(derived_keys)
+        return frozenset(keys)
+
+    def _validate(self, plan, parsed_data):
+        # type: (MigrationPlan, dict) -> Dict[int, MigrationParamError]
+        # Cheap checks of the migration data, done before running any step. Returns the errors
+        # of the steps that would fail anyway, by param index.
+        if not isinstance(parsed_data, dict):
+            raise MigrationAbortError('Migration data must be an object, but {} was given.'
+                                      .format(type(parsed_data).__name__))
+
+        invalid = {}
+        for step in plan.steps:
+            try:
+                if step.action == MigrationPlan.ASSIGN:
+                    if step.param_id in parsed_data:
+                        self._assign_param(step.param_id, parsed_data)
+                elif isinstance(step.transformation, TransformationSpec):
+                    step.transformation.validate(parsed_data)
+            except MigrationParamError as ex:
+                invalid[step.index] = ex
+        return invalid
+
+    def _steps_to_run(self, plan, invalid):
+        # type: (MigrationPlan, dict) -> Tuple[MigrationStep, ...]
+        if invalid and self.validation == self.FAIL_FAST:
+            # Do not run any transformation, just report the first error
+            first = min(invalid)
+            return tuple(step for step in plan.steps if step.index == first)
+        return plan.steps
+
+    def _collect_outcomes(self, request, steps, outcomes, invalid):
+        # type: (Fulfillment, Iterable[MigrationStep], Iterable[tuple], dict) -> tuple
+        # Reports the (value, error) outcomes of the steps, and stops at the first error if
+        # the policy is to fail fast. Returns the values and the report.
+        values = []  # type: List[Tuple[int, Any]]
+        report = _MigrationReport()
+        for step, (value, error) in zip(steps, outcomes):
+            if value is _NOT_RUN:
+                continue
+            if error is not None:
+                self.param_logger.error('[MIGRATION::%s] %s', request.id, error)
+                report.failed.append(step.param_id)
+                report.errors.append(ParamError(
+                    step.param_id, 'validation' if step.index in invalid else 'processing',
+                    str(error)))
+            elif value is _SKIPPED:
+                report.skipped.append(step.param_id)
+            else:
+                values.append((step.index, value))
+                report.succeeded.append(step.param_id)
+            report.processed.append(step.param_id)
+            if error is not None and self.validation == self.FAIL_FAST:
+                break
+
+        self._finish_migration(request, report)
+        return values, report
+
+    def _abort_migration(self, request, error):
+        # type: (Fulfillment, MigrationAbortError) -> SkipRequest
+        logger.error('[MIGRATION::%s] %s', request.id, error)
+        self._count(request.id, 'requests.failed')
+        from connect.exceptions import SkipRequest
+        skip = SkipRequest('Migration failed.')
+        # The SDK exceptions carry additional information in obj
+        skip.obj = error.errors
+        return skip
+
+    def _migration_succeeded(self, request, checkpoint, values):
+        # type: (Fulfillment, Optional[Tuple[str, str]], List[Tuple[int, Any]]) -> None
+        if checkpoint is not None:
+            self._save_checkpoint(checkpoint, request, values)
+        self._count(request.id, 'requests.migrated')
+
+    @staticmethod
+    def _build_diff(request, values, report):
+        # type: (Fulfillment, List[Tuple[int, Any]], _MigrationReport) -> MigrationDiff
+        params = request.asset.params
+        changes = [ParamChange(params[index].id, params[index].value, value)
+                   for index, value in values if params[index].value != value]
+        return MigrationDiff(request.id, changes, report)
+
+    def _checkpoint_key(self, request):
+        # type: (Fulfillment) -> Optional[Tuple[str, str]]
+        if self._checkpoint_store is None:
+            return None
+        sources = self._migration_sources(request)
+        if len(sources) == 1:
+            return request.id, self._hash(sources[0][1])
+        return request.id, self._hash(json.dumps(sources))
+
+    def _restore_checkpoint(self, checkpoint, request):
+        # type: (Tuple[str, str], Fulfillment) -> Optional[Tuple[list, _MigrationReport]]
+        stored = self._checkpoint_store.get(*checkpoint)
+        if stored is None:
+            return None
+
+        values = []
+        report = _MigrationReport()
+        for index, param in enumerate(request.asset.params):
+            if param.id in stored:
+                values.append((index, stored[param.id]))
+                report.processed.append(param.id)
+                report.succeeded.append(param.id)
+        logger.info('[MIGRATION::%s] Migration result restored from checkpoint.', checkpoint[0])
+        self._count(checkpoint[0], 'requests.restored')
+        return values, report
+
+    def _save_checkpoint(self, checkpoint, request, values):
+        # type: (Tuple[str, str], Fulfillment, List[Tuple[int, Any]]) -> None
+        params = request.asset.params
+        stored = collections.OrderedDict((params[index].id, value) for index, value in values)
+        try:
+            self._checkpoint_store.put(checkpoint[0], checkpoint[1], stored)
+        except _checkpoint_store_errors() as ex:
+            # The migration itself succeeded, it will just run again when resumed
+            logger.warning('[MIGRATION::%s] Unable to save checkpoint: %s', checkpoint[0], ex)
+
+    def _migration_sources(self, request):
+        # type: (Fulfillment) -> List[Tuple[str, str]]
+        # Returns the migration key and the raw data of the migration params with a value
+        sources = []
+        for migration_key in self._migration_keys:
+            param = request.asset.get_param_by_id(migration_key)
+            if param is not None and param.value:
+                sources.append((migration_key, param.value))
+        return sources
+
+    def _parse_migration_data(self, request, plan):
+        # type: (Fulfillment, MigrationPlan) -> dict
+        keys = plan.keys if self.partial_decode else None
+        parsed = []
+        for migration_key, raw_data in self._migration_sources(request):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('[MIGRATION::%s] Migration data `%s`: %s',
+                             request.id, migration_key, self._format_payload(raw_data))
+            with self._time(request.id, 'parse'):
+                parsed_data = self._decode(request.id, raw_data, keys)
+            logger.debug('[MIGRATION::%s] Migration data `%s` parsed correctly',
+                         request.id, migration_key)
+            parsed.append((migration_key, parsed_data))
+        return parsed[0][1] if len(parsed) == 1 else self._merge_migration_data(parsed)
+
+    def _merge_migration_data(self, parsed):
+        # type: (List[Tuple[str, Any]]) -> dict
+        # Parsed objects may be cached, so they are merged into a new one
+        merged = {}  # type: Dict[str, Any]
+        for migration_key, parsed_data in parsed:
+            if not isinstance(parsed_data, dict):
+                raise MigrationAbortError(
+                    'Migration data `{}` must be an object, but {} was given.'
+                    .format(migration_key, type(parsed_data).__name__))
+            if self.merge_policy == self.MERGE_LAST:
+                merged.update(parsed_data)
+                continue
+            if self.merge_policy == self.MERGE_STRICT:
+                duplicated = sorted(key for key in parsed_data if key in merged)
+                if duplicated:
                     raise MigrationAbortError(
-                        'Processing of parameters {} failed, unable to complete migration.'
-                        .format(', '.join(failed_params)))
+                        'Migration data `{}` contains keys found in a previous migration '
+                        'param: {}.'.format(migration_key, ', '.join(duplicated)))
+            for key, value in parsed_data.items():
+                merged.setdefault(key, value)
+        return merged
+
+    def _format_payload(self, raw_data):
+        # type: (str) -> str
+        if self.log_payload == 'truncate' and len(raw_data) > self.log_payload_limit:
+            return '{}... ({} characters)'.format(raw_data[:self.log_payload_limit],
+                                                   len(raw_data))
+        if self.log_payload == 'hash':
+            return 'sha1:{} ({} characters)'.format(self._hash(raw_data), len(raw_data))
+        return raw_data
+
+    @staticmethod
+    def _hash(raw_data):
+        # type: (str) -> str
+        raw_bytes = raw_data.encode('utf-8') if isinstance(raw_data, six.text_type) else raw_data
+        return hashlib.sha1(raw_bytes).hexdigest()
+
+    def _decode(self, request_id, raw_data, keys=None):
+        # type: (str, str, Optional[frozenset]) -> dict
+        if self._parse_cache is None:
+            cache_key = None
+        else:
+            cache_key = (request_id, self._hash(raw_data), keys)
+            parsed_data = self._parse_cache.get(cache_key, _MISSING)
+            if parsed_data is not _MISSING:
+                return parsed_data
+
+        try:
+            parsed_data = None
+            if keys is not None:
+                parsed_data = _decode_object_keys(raw_data, keys)
+            if parsed_data is None:
+                parsed_data = self.decoder(raw_data)
+        except ValueError as ex:
+            raise MigrationAbortError(str(ex))
+
+        if cache_key is not None:
+            self._parse_cache.put(cache_key, parsed_data)
+        return parsed_data
+
+    def _run_step(self, step, parsed_data, request_id, derived=None):
+        # type: (MigrationStep, dict, str, Optional[_DerivedValues]) -> Any
+        if step.action == MigrationPlan.TRANSFORM:
+            # Transformation is defined, so apply it
+            self.param_logger.info('[MIGRATION::%s] Running transformation for parameter %s',
+                                   request_id, step.param_id)
+            if self._observer is None:
+                return self._transform(step, parsed_data, request_id, derived)
+            with self._time(request_id, 'transformation.' + step.param_id):
+                return self._transform(step, parsed_data, request_id, derived)
+        return self._assign_param(step.param_id, parsed_data)
+
+    def _transform(self, step, parsed_data, request_id, derived=None):
+        # type: (MigrationStep, dict, str, Optional[_DerivedValues]) -> Any
+        names = _declared_depends(step.transformation)
+        if names:
+            # Derived fields are computed before the transformation, and are not timed with it
+            kwargs = derived.get(names)
+            return step.transformation(parsed_data, request_id, **kwargs)
+
+        cache_key = self._transformation_cache_key(step.param_id, parsed_data)
+        if cache_key is None:
+            return step.transformation(parsed_data, request_id)
+
+        value = self._transformation_cache.get(cache_key, _MISSING)
+        if value is _MISSING:
+            value = step.transformation(parsed_data, request_id)
+            self._transformation_cache.put(cache_key, value)
+        return value
+
+    def _transformation_cache_key(self, param_id, parsed_data):
+        # type: (str, dict) -> Optional[tuple]
+        if self._transformation_cache is None or param_id not in self._pure_keys \
+                or not isinstance(parsed_data, dict):
+            return None
+
+        keys = self._pure_keys[param_id]
+        values = tuple((type(parsed_data[key]).__name__, parsed_data[key])
+                       if key in parsed_data else None
+                       for key in keys)
+        try:
+            hash(values)
+        except TypeError:
+            # Lists and objects are not hashable, so use their canonical JSON form
+            values = json.dumps([[key in parsed_data, parsed_data.get(key)] for key in keys],
+                                sort_keys=True, default=repr)
+        return param_id, values
+
+    def _assign_param(self, param_id, parsed_data):
+        # type: (str, dict) -> Any
+        if param_id not in parsed_data:
+            return _SKIPPED
+
+        # Parsed data contains the key, so assign it
+        value = parsed_data[param_id]
+        if not isinstance(value, six.string_types):
+            if self.serialize:
+                # The parsed data is not modified, since it may be cached
+                value = self._serialize_value(param_id, value)
+            else:
+                type_name = type(value).__name__
+                raise MigrationParamError(
+                    'Parameter {} type must be str, but {} was given'
+                    .format(param_id, type_name))
+        return value
+
+    def _serialize_value(self, param_id, value):
+        # type: (str, Any) -> str
+        limit = self._max_serialized_size
+        if self._encoder is not None:
+            value = self._encoder(value)
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            too_long = limit is not None and len(value) > limit
+        elif limit is not None and isinstance(value, _JSON_SCALAR_TYPES):
+            # The JSON of a number is short, so the fast C encoder can be used
+            value = self._json_encoder.encode(value)
+            too_long = len(value) > limit
+        elif limit is not None:
+            # Chunks are kept only while they fit, so a huge value is never fully built. This
+            # uses the pure Python encoder, which is several times slower than encode()
+            chunks = []
+            size = 0
+            for chunk in self._json_encoder.iterencode(value):
+                size += len(chunk)
+                if size > limit:
+                    break
+                chunks.append(chunk)
+            value = ''.join(chunks)
+            too_long = size > limit
+        else:
+            return self._json_encoder.encode(value)
+
+        if too_long:
+            raise MigrationParamError(
+                'Parameter {} serialized value is longer than {} characters'
+                .format(param_id, limit))
+        return value
+
+    def _finish_migration(self, request, report):
+        # type: (Fulfillment, _MigrationReport) -> None
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('[MIGRATION::%s] %d processed, %d succeeded%s, %d failed%s, '
+                        '%d skipped%s.',
+                        request.id,
+                        len(report.processed),
+                        len(report.succeeded),
+                        self._format_params(report.succeeded),
+                        len(report.failed),
+                        self._format_params(report.failed),
+                        len(report.skipped),
+                        self._format_params(report.skipped))
+
+        if self._observer is not None:
+            self._observer.count(request.id, 'params.succeeded', len(report.succeeded))
+            self._observer.count(request.id, 'params.failed', len(report.failed))
+            self._observer.count(request.id, 'params.skipped', len(report.skipped))
+
+        # Raise abort if any params failed
+        if report.failed:
+            raise MigrationAbortError(
+                'Processing of parameters {} failed, unable to complete migration.'
+                .format(', '.join(report.failed)), report.errors)
+
+    def _time(self, request_id, name):
+        # type: (str, str) -> Any
+        if self._observer is None:
+            return _NULL_TIMER
+        return _Timer(self._observer, request_id, name)
+
+    def _count(self, request_id, name, value=1):
+        # type: (str, str, int) -> None
+        if self._observer is not None:
+            self._observer.count(request_id, name, value)
+
+    def _get_plan(self, request):
+        # type: (Fulfillment) -> MigrationPlan
+        product_id = request.asset.product.id if request.asset.product else None
+        param_ids = tuple(param.id for param in request.asset.params)
+        plan = self._plans.get((product_id, param_ids))
+        return plan if plan is not None else self.compile_plan(product_id, param_ids)
+
+    def compile_plan(self, product_id, params):
+        """ Compiles the migration plan for the requests of a product, or returns the one
+        already compiled. Plans are compiled automatically when migrating requests, but this can
+        be called at startup to avoid doing it while processing them.
+
+        A plan is only used for requests whose asset params have the same ids, in the same
+        order. Plans are not recompiled if the transformations are modified after creating the
+        handler.
+
+        :param str product_id: Id of the product.
+        :param list[str|Param] params: The asset params, or their ids.
+        :return: The plan for the product.
+        :rtype: MigrationPlan
+        """
+        param_ids = tuple(param if isinstance(param, six.string_types) else param.id
+                          for param in params)
+        plan = self._plans.get((product_id, param_ids))
+        if plan is None:
+            steps = []
+            for index, param_id in enumerate(param_ids):
+                # Exclude param for migration_info from process list
+                if param_id in self._migration_keys:
+                    continue
+                if param_id in self.transformations:
+                    steps.append(MigrationStep(index, param_id, MigrationPlan.TRANSFORM,
+                                               self.transformations[param_id]))
+                elif self.serialize:
+                    steps.append(MigrationStep(index, param_id, MigrationPlan.SERIALIZE, None))
+                else:
+                    steps.append(MigrationStep(index, param_id, MigrationPlan.ASSIGN, None))
+            plan = MigrationPlan(product_id, param_ids, tuple(steps))
+            if plan.keys is not None and self._derived:
+                plan.keys = self._derived_keys(plan)
+            self._plans[(product_id, param_ids)] = plan
+        return plan
+
+    def warmup(self, products=None):
+        """ Prepares the handler to migrate requests, so the first migrations do not pay for
+        it. It is intended to be called at startup of short-lived workers, before they receive
+        any request. It imports the Connect SDK modules that are imported lazily, compiles the
+        plans of the given products and primes the internal caches.
+
+        :param dict[str,list[str|Param]] products: The asset params of each product id, to
+          compile their plans (see :py:meth:`compile_plan`). Default value is ``None``.
+        """
+        from connect.exceptions import SkipRequest  # noqa: F401
+        from connect.logger import logger as sdk_logger  # noqa: F401
+        from connect.models import Asset, Fulfillment, Param
+
+        for cls in (Fulfillment, Asset, Param):
+            _is_plain_class(cls)
+        if any(isinstance(transformation, TransformationSpec) and 'multiply' in transformation.spec
+               for transformation in self.transformations.values()):
+            # Used by migrate_columnar
+            _load_numpy()
+        self.decoder('{}')
+
+        for product_id, params in (products or {}).items():
+            self.compile_plan(product_id, params)
+
+    def migrate_many(self, requests, executor='thread', max_workers=None):
+        """ Call this function to migrate several requests concurrently.
+
+        Failed migrations do not stop the batch, they are reported in the returned object
+        instead. This includes unexpected exceptions raised by transformations, like a
+        ``KeyError``, which are also logged.
+
+        When using a process pool, the handler and the requests are sent to the worker
+        processes, so transformations must be picklable (i.e. module-level functions instead
+        of lambdas). Each worker process gets its own copy of the ``observer``, so the
+        measurements of those migrations are not reported to the observer of the handler, and a
+        warning is logged.
+
+        :param Iterable[Fulfillment] requests: The requests to migrate.
+        :param str|concurrent.futures.Executor executor: ``thread`` to run the migrations in a
+          thread pool, ``process`` to run them in a process pool, or an executor instance to use.
+          An executor instance is not shut down after use. Default value is ``thread``.
+        :param int max_workers: Number of workers of the pool created when ``executor`` is
+          ``thread`` or ``process``. Default value depends on the pool type.
+        :return: The outcome of every request, in the same order as ``requests``.
+        :rtype: MigrationBatchResult
+        """
+        return MigrationBatchResult(list(self.imigrate(requests, executor, max_workers)))
+
+    def migrate_columnar(self, requests):
+        """ Call this function to migrate a large batch of requests, usually of the same
+        product, in columns instead of one request at a time.
+
+        The migration data of every request is parsed first. Then, for the requests with the
+        same params, each :py:class:`TransformationSpec` is applied to all of them at once (see
+        :py:meth:`TransformationSpec.apply_column`), and the results are written back to a
+        copy of each request. Transformation functions and params without transformation are
+        processed for each request as in :py:meth:`migrate`.
+
+        Failed migrations do not stop the batch, and a param that fails only makes its own
+        request fail, exactly like with :py:meth:`migrate`. Unexpected exceptions raised by
+        transformations are reported for their request, as in :py:meth:`migrate_many`.
+
+        :param Iterable[Fulfillment] requests: The requests to migrate.
+        :return: The outcome of every request, in the same order as ``requests``.
+        :rtype: MigrationBatchResult
+        """
+        requests = list(requests)
+        items = [None] * len(requests)  # type: List[Any]
+        groups = collections.OrderedDict()  # type: collections.OrderedDict
+
+        for position, request in enumerate(requests):
+            if not self.needs_migration(request):
+                logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+                self._count(request.id, 'requests.not_needed')
+                items[position] = MigrationBatchItem(request, result=request)
+                continue
+
+            logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                        request.id, request.id)
+            checkpoint = self._checkpoint_key(request)
+            restored = self._restore_checkpoint(checkpoint, request) \
+                if checkpoint is not None else None
+            if restored is not None:
+                items[position] = MigrationBatchItem(
+                    request, result=self._apply_values(request, restored[0]))
+                continue
+
+            plan = self._get_plan(request)
+            try:
+                parsed_data = self._parse_migration_data(request, plan)
+                invalid = self._validate(plan, parsed_data)
+                if invalid and self.validation == self.FAIL_FAST:
+                    # Leave it out of the columns, since it fails anyway
+                    steps = self._steps_to_run(plan, invalid)
+                    self._collect_outcomes(request, steps, self._run_steps(
+                        steps, parsed_data, request.id, invalid), invalid)
             except MigrationAbortError as ex:
-                logger.error('[MIGRATION::{}] {}'.format(request.id, ex))
-                raise SkipRequest('Migration failed.')
+                items[position] = MigrationBatchItem(
+                    request, error=self._abort_migration(request, ex))
+                continue
+            except Exception as ex:
+                items[position] = MigrationBatchItem(
+                    request, error=_unexpected_error(request, ex))
+                continue
+            groups.setdefault(plan, []).append(
+                (position, request, parsed_data, checkpoint, invalid))
+
+        for plan, rows in groups.items():
+            data_list = [row[2] for row in rows]
+            request_ids = [row[1].id for row in rows]
+            derived_list = [self._derived_values(parsed_data, request_id)
+                            for parsed_data, request_id in zip(data_list, request_ids)]
+            columns = [self._run_column(step, data_list, request_ids, derived_list)
+                       for step in plan.steps]
+
+            for row, (position, request, _, checkpoint, invalid) in enumerate(rows):
+                outcomes = [(None, invalid[step.index]) if step.index in invalid else column[row]
+                            for step, column in zip(plan.steps, columns)]
+                unexpected = [error for _, error in outcomes
+                              if error is not None and not isinstance(error, MigrationParamError)]
+                if unexpected:
+                    items[position] = MigrationBatchItem(
+                        request, error=_unexpected_error(request, unexpected[0]))
+                    continue
+                try:
+                    values, _ = self._collect_outcomes(request, plan.steps, outcomes, invalid)
+                except MigrationAbortError as ex:
+                    items[position] = MigrationBatchItem(
+                        request, error=self._abort_migration(request, ex))
+                    continue
+                self._migration_succeeded(request, checkpoint, values)
+                items[position] = MigrationBatchItem(
+                    request, result=self._apply_values(request, values))
 
-            return request_copy
+        return MigrationBatchResult(items)
+
+    def _run_column(self, step, data_list, request_ids, derived_list):
+        # type: (MigrationStep, List[dict], List[str], List[Any]) -> List[tuple]
+        # Returns a (value, error) tuple for each request
+        if step.action == MigrationPlan.TRANSFORM \
+                and isinstance(step.transformation, TransformationSpec):
+            if self.param_logger.isEnabledFor(logging.INFO):
+                for request_id in request_ids:
+                    self.param_logger.info(
+                        '[MIGRATION::%s] Running transformation for parameter %s',
+                        request_id, step.param_id)
+            with self._time(None, 'column.' + step.param_id):
+                return step.transformation.apply_column(data_list)
+
+        outcomes = []
+        for parsed_data, request_id, derived in zip(data_list, request_ids, derived_list):
+            try:
+                outcomes.append((self._run_step(step, parsed_data, request_id, derived), None))
+            except MigrationParamError as ex:
+                outcomes.append((None, ex))
+            except Exception as ex:
+                # Makes only this request fail, with the error instead of a param error
+                outcomes.append((None, ex))
+        return outcomes
+
+    def imigrate(self, requests, executor=None, max_workers=None, window=None):
+        """ Lazy version of :py:meth:`migrate_many`, which yields the outcome of each request in
+        order as soon as it is available. Requests are read from ``requests`` as they are needed,
+        keeping at most ``window`` of them in flight, so it can process streams of any size with
+        bounded memory.
+
+        :param Iterable[Fulfillment] requests: The requests to migrate.
+        :param str|concurrent.futures.Executor|None executor: ``None`` to migrate the requests
+          one by one in the current thread, or any of the values accepted by
+          :py:meth:`migrate_many`. Default value is ``None``.
+        :param int max_workers: Number of workers of the pool created when ``executor`` is
+          ``thread`` or ``process``. Default value depends on the pool type.
+        :param int window: Maximum number of requests in flight when using an executor.
+          Default value is four times ``max_workers``, or 32 if it is not given.
+        :return: The outcome of every request, in the same order as ``requests``.
+        :rtype: Iterator[MigrationBatchItem]
+        """
+        from connect.exceptions import SkipRequest
+        if executor is None:
+            for request in requests:
+                try:
+                    yield MigrationBatchItem(request, result=self.migrate(request))
+                except (SkipRequest, MigrationAbortError) as ex:
+                    yield MigrationBatchItem(request, error=ex)
+                except Exception as ex:
+                    yield MigrationBatchItem(request, error=_unexpected_error(request, ex))
+            return
+
+        with self._open_executor(executor, max_workers) as (pool, func):
+            window = window or (max_workers or 8) * 4
+            pending = collections.deque()  # type: collections.deque
+            requests = iter(requests)
+            while True:
+                # Keep a bounded number of requests in flight, yielding them in order
+                for request in requests:
+                    pending.append((request, pool.submit(func, request)))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+                request, future = pending.popleft()
+                try:
+                    yield MigrationBatchItem(request, result=future.result())
+                except (SkipRequest, MigrationAbortError) as ex:
+                    yield MigrationBatchItem(request, error=ex)
+                except Exception as ex:
+                    yield MigrationBatchItem(request, error=_unexpected_error(request, ex))
+
+    @contextlib.contextmanager
+    def _open_executor(self, executor, max_workers):
+        # type: (Any, Optional[int]) -> Iterator[Tuple[Any, Callable]]
+        if self._observer is not None and self._is_process_executor(executor):
+            logger.warning('[MIGRATION] The observer does not receive the measurements of '
+                           'the migrations run in worker processes.')
+        if not isinstance(executor, six.string_types):
+            yield executor, self.migrate
+            return
+
+        from concurrent import futures
+        if executor == 'thread':
+            pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+            func = self.migrate
+        elif executor == 'process':
+            # The handler is sent once to every worker instead of once per request
+            pool = futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_process_worker,
+                initargs=(self,))
+            func = _migrate_in_process_worker
         else:
-            logger.info('[MIGRATION::{}] Request does not need migration.'
-                        .format(request.id))
-            return request
+            raise ValueError('Unknown executor `{}`, it must be `thread`, `process` '
+                             'or an executor instance.'.format(executor))
+        with pool:
+            yield pool, func
+
+    @staticmethod
+    def _is_process_executor(executor):
+        # type: (Any) -> bool
+        if executor == 'process':
+            return True
+        # An instance of ProcessPoolExecutor can only exist if its module was loaded
+        futures = sys.modules.get('concurrent.futures')
+        return futures is not None and isinstance(executor, futures.ProcessPoolExecutor)
 
     @staticmethod
     def _format_params(params):
         # type: (List[str]) -> str
         return ' (' + ', '.join(params) + ')' if len(params) > 0 else ''
+
+
+def _unexpected_error(request, error):
+    # type: (Fulfillment, Exception) -> Exception
+    # Errors other than the migration ones are reported per request in batches
+    # The error may be reported after leaving the except block, so its traceback is given
+    logger.exception('[MIGRATION::%s] Unexpected error in migration: %s', request.id, error,
+                     exc_info=(type(error), error, getattr(error, '__traceback__', None)))
+    return error
+
+
+def _derived_graph(derived, transformations):
+    # type: (Dict[str, Callable], Dict[str, Callable]) -> Dict[str, Tuple[str, ...]]
+    # Returns the derived fields that every derived field depends on, checking that all of
+    # them are known and that there are no cycles
+    graph = {name: _declared_depends(func) for name, func in derived.items()}
+    required = [(name, 'derived field ' + owner) for owner, names in graph.items()
+                for name in names]
+    required.extend((name, 'parameter ' + param_id)
+                    for param_id, transformation in transformations.items()
+                    for name in _declared_depends(transformation))
+    for name, owner in sorted(required):
+        if name not in graph:
+            raise ValueError('Unknown derived field `{}` required by {}.'.format(name, owner))
+
+    # Depth-first search, where a field found again while visiting its dependencies is a cycle
+    visited = set()  # type: set
+    path = []  # type: List[str]
+
+    def visit(name):
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ValueError('Derived fields depend on each other: {}.'.format(
+                ' -> '.join(cycle)))
+        if name in visited:
+            return
+        path.append(name)
+        for dependency in graph[name]:
+            visit(dependency)
+        path.pop()
+        visited.add(name)
+
+    for name in sorted(graph):
+        visit(name)
+    return graph
+
+
+def _derived_closure(graph, names):
+    # type: (Dict[str, Tuple[str, ...]], Iterable[str]) -> List[str]
+    # Returns the given derived fields and all the ones they depend on, dependencies first
+    ordered = []  # type: List[str]
+    seen = set()  # type: set
+
+    def visit(name):
+        if name not in seen:
+            seen.add(name)
+            for dependency in graph[name]:
+                visit(dependency)
+            ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+class _DerivedValues(object):
+    """ Derived fields of one request, which are computed the first time they are needed. """
+
+    __slots__ = ('_handler', '_parsed_data', '_request_id', '_outcomes')
+
+    def __init__(self, handler, parsed_data, request_id):
+        self._handler = handler  # type: MigrationHandler
+        self._parsed_data = parsed_data  # type: dict
+        self._request_id = request_id  # type: str
+        self._outcomes = {}  # type: Dict[str, Tuple[Any, Optional[MigrationParamError]]]
+
+    def get(self, names):
+        # type: (Iterable[str]) -> Dict[str, Any]
+        # Returns the values of the derived fields, raising the error of any that failed
+        values = {}
+        for name in names:
+            outcome = self._outcomes.get(name)
+            if outcome is None:
+                outcome = self._compute(name)
+            if outcome[1] is not None:
+                raise outcome[1]
+            values[name] = outcome[0]
+        return values
+
+    def prefetch(self, names):
+        # type: (List[str]) -> None
+        # Computes the fields in waves of the ones whose dependencies are already computed
+        graph = self._handler._derived_depends
+        pending = [name for name in names if name not in self._outcomes]
+        while pending:
+            ready = [name for name in pending
+                     if all(dependency in self._outcomes for dependency in graph[name])]
+            futures = [self._handler._derived_executor.submit(self._compute, name)
+                       for name in ready]
+            for future in futures:
+                future.result()
+            pending = [name for name in pending if name not in self._outcomes]
+
+    def _compute(self, name):
+        # type: (str) -> Tuple[Any, Optional[MigrationParamError]]
+        handler = self._handler
+        func = handler._derived[name]
+        try:
+            kwargs = self.get(handler._derived_depends[name])
+            with handler._time(self._request_id, 'derived.' + name):
+                outcome = func(self._parsed_data, self._request_id, **kwargs), None
+        except MigrationParamError as ex:
+            outcome = None, ex
+        self._outcomes[name] = outcome
+        return outcome
+
+
+def _copy_with_values(request, values, copy_on_write):
+    # type: (Fulfillment, Iterable[Tuple[int, Any]], bool) -> Fulfillment
+    # Returns a copy of the request with the new value of the params by their index
+    if not copy_on_write:
+        request_copy = copy.deepcopy(request)
+        params = request_copy.asset.params
+        for index, value in values:
+            params[index].value = value
+        return request_copy
+
+    # Only the path to the params is cloned, params themselves are cloned on write
+    request_copy = _shallow_copy(request)
+    request_copy.asset = _shallow_copy(request.asset)
+    params = request_copy.asset.params = list(request.asset.params)
+    for index, value in values:
+        params[index] = _shallow_copy(params[index])
+        params[index].value = value
+    return request_copy
+
+
+def _shallow_copy(obj):
+    # type: (Any) -> Any
+    """ Same as ``copy.copy``, but much faster for plain objects like the SDK models, which
+    do not customize how they are created, copied or pickled. """
+    cls = obj.__class__
+    plain = _PLAIN_CLASSES.get(cls)
+    if plain is None:
+        plain = _is_plain_class(cls)
+    if not plain:
+        return copy.copy(obj)
+    obj_copy = object.__new__(cls)
+    obj_copy.__dict__.update(obj.__dict__)
+    return obj_copy
+
+
+def _is_plain_class(cls):
+    # type: (type) -> bool
+    plain = _PLAIN_CLASSES.get(cls)
+    if plain is None:
+        plain = _PLAIN_CLASSES[cls] = \
+            cls.__new__ is object.__new__ and cls.__reduce_ex__ is object.__reduce_ex__ \
+            and cls.__reduce__ is object.__reduce__ \
+            and getattr(cls, '__getstate__', None) is getattr(object, '__getstate__', None) \
+            and not hasattr(cls, '__copy__') and not hasattr(cls, '__setstate__') \
+            and not hasattr(cls, '__slots__')
+    return plain
+
+
+# Whether each class can be copied by _shallow_copy
+_PLAIN_CLASSES = {}  # type: Dict[type, bool]
+
+_process_worker_handler = None  # type: Optional[MigrationHandler]
+
+
+def _init_process_worker(handler):
+    # type: (MigrationHandler) -> None
+    global _process_worker_handler
+    _process_worker_handler = handler
+
+
+def _migrate_in_process_worker(request):
+    # type: (Fulfillment) -> Fulfillment
+    return _process_worker_handler.migrate(request)
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket, which limits the rate of an operation while allowing short
+    bursts. The bucket starts full.
+
+    :param float rate: Number of tokens added to the bucket per second.
+    :param int capacity: Maximum number of tokens in the bucket, which is the size of the
+      largest burst. Default value is ``1``.
+    :raises ValueError: Raised if the rate or the capacity are not positive.
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0 or capacity < 1:
+            raise ValueError('Token bucket rate and capacity must be positive.')
+        self._rate = float(rate)
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """
+        :return: Number of tokens added to the bucket per second.
+        :rtype: float
+        """
+        return self._rate
+
+    @property
+    def capacity(self):
+        """
+        :return: Maximum number of tokens in the bucket.
+        :rtype: int
+        """
+        return self._capacity
+
+    def acquire(self):
+        """ Takes a token from the bucket, waiting until there is one.
+
+        :return: The time waited, in seconds.
+        :rtype: float
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = timeit.default_timer()
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+            waited += delay
+
+
+MigrationWorkerStats = collections.namedtuple(
+    'MigrationWorkerStats',
+    ['submitted', 'completed', 'failed', 'queue_depth', 'elapsed', 'throughput'])
+""" Counters returned by :py:meth:`MigrationWorker.stats`. ``elapsed`` is the time in seconds
+since the worker was started, and ``throughput`` the number of completed requests per second. """
+
+# Tells the threads of a MigrationWorker to finish
+_STOP = object()
+
+
+class MigrationWorker(object):
+    """ Migrates the requests put in a bounded queue with a pool of threads, and passes the
+    outcome of every request to a sink, like a function that updates the params in Connect. ::
+
+        def sink(item):
+            if item.succeeded:
+                self.update_parameters(item.result.id, item.result.asset.params)
+
+        with MigrationWorker(handler, sink, max_workers=8, rate=10) as worker:
+            for request in requests:
+                worker.submit(request)
+
+    The calls to the sink are limited to ``rate`` per second, shared by all threads. Threads
+    waiting for the rate limit do not take more requests from the queue, and
+    :py:meth:`submit` blocks while the queue is full, so a slow sink slows down whoever
+    submits the requests, instead of piling up results in memory.
+
+    The worker reports these measurements to its ``metrics``:
+
+    - ``worker.latency``: Time since a request was submitted until its outcome was passed to
+      the sink.
+    - ``worker.throttle``: Time waited for the rate limit before calling the sink.
+    - ``worker.sink``: Call of the sink.
+    - ``worker.succeeded``, ``worker.failed`` and ``worker.sink_errors``: Counts of requests
+      migrated, requests that failed, and calls of the sink that raised an exception, which is
+      logged and ignored.
+
+    :param MigrationHandler handler: Handler used to migrate the requests. It cannot be an
+      ``AsyncMigrationHandler``, whose migrations are coroutines.
+    :param callable sink: Function called with the :py:class:`MigrationBatchItem` of every
+      request, from the threads of the worker.
+    :param int max_workers: Number of threads. Default value is ``4``.
+    :param int queue_size: Maximum number of requests waiting in the queue. Default value is
+      four times ``max_workers``.
+    :param float rate: Maximum number of calls of the sink per second, or ``None`` for no
+      limit. Default value is ``None``.
+    :param int burst: Number of calls of the sink that can be done at once, without waiting
+      for the rate limit. Default value is ``1``.
+    :param MigrationMetrics metrics: Object that receives the measurements of the worker.
+      Default value is a new :py:class:`MigrationMetrics`.
+    """
+
+    def __init__(self, handler, sink, max_workers=4, queue_size=None, rate=None, burst=1,
+                 metrics=None):
+        if getattr(inspect, 'iscoroutinefunction', None) and \
+                inspect.iscoroutinefunction(handler.migrate):
+            raise TypeError('MigrationWorker requires a synchronous handler.')
+        self._handler = handler
+        self._sink = sink
+        self._max_workers = max_workers
+        self._queue = six.moves.queue.Queue(maxsize=queue_size or max_workers * 4)
+        self._bucket = TokenBucket(rate, burst) if rate is not None else None
+        self._metrics = metrics if metrics is not None else MigrationMetrics()
+        self._threads = []  # type: List[threading.Thread]
+        self._started = None  # type: Optional[float]
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+
+    @property
+    def metrics(self):
+        """
+        :return: The object that receives the measurements of the worker.
+        :rtype: MigrationMetrics
+        """
+        return self._metrics
+
+    @property
+    def queue_depth(self):
+        """
+        :return: Number of requests waiting in the queue.
+        :rtype: int
+        """
+        return self._queue.qsize()
+
+    def start(self):
+        """ Starts the threads of the worker. """
+        if self._threads:
+            raise RuntimeError('Migration worker already started.')
+        self._started = timeit.default_timer()
+        for _ in range(self._max_workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, request, timeout=None):
+        """ Puts a request in the queue, waiting while it is full.
+
+        :param Fulfillment request: The request to migrate.
+        :param float timeout: Maximum time to wait, in seconds, or ``None`` to wait as long as
+          needed. Default value is ``None``.
+        :raises queue.Full: Raised if the queue is still full after ``timeout``.
+        """
+        if not self._threads:
+            raise RuntimeError('Migration worker not started.')
+        self._queue.put((request, timeit.default_timer()), timeout=timeout)
+        with self._lock:
+            self._submitted += 1
+
+    def close(self):
+        """ Waits until every submitted request is passed to the sink, and stops the threads.
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+
+    def run(self, requests):
+        """ Starts the worker, submits the given requests and closes it.
+
+        :param Iterable[Fulfillment] requests: The requests to migrate.
+        :return: The counters of the worker.
+        :rtype: MigrationWorkerStats
+        """
+        with self:
+            for request in requests:
+                self.submit(request)
+        return self.stats()
+
+    def stats(self):
+        """
+        :return: The counters of the worker.
+        :rtype: MigrationWorkerStats
+        """
+        elapsed = timeit.default_timer() - self._started if self._started is not None else 0.0
+        with self._lock:
+            submitted, completed, failed = self._submitted, self._completed, self._failed
+        return MigrationWorkerStats(submitted, completed, failed, self.queue_depth, elapsed,
+                                    completed / elapsed if elapsed > 0 else 0.0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        # type: () -> None
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            self._process(*entry)
+
+    def _process(self, request, submitted):
+        # type: (Fulfillment, float) -> None
+        from connect.exceptions import SkipRequest
+        try:
+            item = MigrationBatchItem(request, result=self._handler.migrate(request))
+        except (SkipRequest, MigrationAbortError) as ex:
+            item = MigrationBatchItem(request, error=ex)
+        except Exception as ex:
+            # An unexpected error must not stop the thread
+            item = MigrationBatchItem(request, error=_unexpected_error(request, ex))
+
+        if self._bucket is not None:
+            self._metrics.timing(request.id, 'worker.throttle', self._bucket.acquire())
+        try:
+            with _Timer(self._metrics, request.id, 'worker.sink'):
+                self._sink(item)
+        except Exception as ex:
+            logger.exception('[MIGRATION::%s] Migration sink failed: %s', request.id, ex)
+            self._metrics.count(request.id, 'worker.sink_errors', 1)
+
+        self._metrics.timing(request.id, 'worker.latency', timeit.default_timer() - submitted)
+        self._metrics.count(request.id, 'worker.succeeded' if item.succeeded
+                            else 'worker.failed', 1)
+        with self._lock:
+            self._completed += 1
+            if not item.succeeded:
+                self._failed += 1
+
+
+MigrationStreamStats = collections.namedtuple(
+    'MigrationStreamStats', ['migrated', 'failed', 'not_needed', 'invalid', 'elapsed'])
+""" Counters returned by :py:func:`migrate_jsonl`. ``elapsed`` is the time spent in seconds. """
+
+
+def migrate_jsonl(handler, input_file, output_file, executor=None, max_workers=None):
+    """ Migrates the requests of a JSON Lines stream, with one request in JSON format per line,
+    and writes the outcome of each one in JSON Lines format as soon as it is available. Requests
+    are read as they are needed, so the memory used does not depend on the size of the stream.
+
+    Each output line contains the ``id`` of the request and its ``status``:
+
+    - ``migrated``: ``params`` contains the value of every param except the migration one.
+    - ``failed``: ``error`` contains the error message, and ``errors`` the
+      :py:class:`ParamError` of each param that failed, as objects.
+    - ``not_needed``: The request does not need migration.
+
+    Lines that cannot be parsed into a request are logged and counted as invalid.
+
+    :param MigrationHandler handler: The handler used to migrate the requests.
+    :param file input_file: File object to read the requests from.
+    :param file output_file: File object to write the outcomes to.
+    :param str|concurrent.futures.Executor|None executor: See :py:meth:`MigrationHandler.imigrate`.
+    :param int max_workers: See :py:meth:`MigrationHandler.imigrate`.
+    :return: Number of requests of each status, and time spent.
+    :rtype: MigrationStreamStats
+    """
+    counters = collections.Counter()  # type: collections.Counter
+    started = timeit.default_timer()
+
+    for item in handler.imigrate(_read_jsonl_requests(input_file, counters), executor,
+                                 max_workers):
+        if not item.succeeded:
+            record = {'id': item.request.id, 'status': 'failed', 'error': str(item.error),
+                      'errors': [dict(error._asdict()) for error in item.errors]}
+        elif not handler.needs_migration(item.request):
+            record = {'id': item.request.id, 'status': 'not_needed'}
+        else:
+            record = {
+                'id': item.request.id,
+                'status': 'migrated',
+                'params': collections.OrderedDict(
+                    (param.id, param.value) for param in item.result.asset.params
+                    if param.id not in handler.migration_keys),
+            }
+        counters[record['status']] += 1
+        output_file.write(json.dumps(record, default=str) + '\n')
+
+    return MigrationStreamStats(counters['migrated'], counters['failed'],
+                                counters['not_needed'], counters['invalid'],
+                                timeit.default_timer() - started)
+
+
+def _read_jsonl_requests(input_file, counters):
+    # type: (Iterable[str], collections.Counter) -> Iterator[Fulfillment]
+    from connect.models import Fulfillment
+    for line_number, line in enumerate(input_file, 1):
+        if not line.strip():
+            continue
+        try:
+            yield Fulfillment.deserialize_json(json.loads(line))
+        except (ValueError, TypeError) as ex:
+            logger.error('[MIGRATION] Invalid request in line %d: %s', line_number, ex)
+            counters['invalid'] += 1
+
+
+def main(argv=None):
+    """ Entry point of the command line interface, run with ``python -m connect_migration``.
+
+    :param list[str] argv: Command line arguments. Default value is ``sys.argv[1:]``.
+    :return: Exit status, which is ``1`` if any request failed or was invalid.
+    :rtype: int
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m connect_migration',
+        description='Migrate fulfillment requests offline.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    run_parser = subparsers.add_parser(
+        'run', help='Migrate the requests of a JSON Lines file.')
+    run_parser.add_argument('--input', required=True,
+                            help='JSON Lines file with one request per line, or - for stdin.')
+    run_parser.add_argument('--output', required=True,
+                            help='JSON Lines file to write the results to, or - for stdout.')
+    run_parser.add_argument('--transformations',
+                            help='JSON or YAML file with transformation specifications.')
+    run_parser.add_argument('--migration-key', action='append',
+                            help='Id of the param with the migration data. It can be given '
+                                 'several times if the data is split across several params. '
+                                 'Default is migration_info.')
+    run_parser.add_argument('--merge-policy', choices=['first', 'last', 'strict'],
+                            default='first',
+                            help='Which value is used when a key is found in several migration '
+                                 'params. Default is first.')
+    run_parser.add_argument('--serialize', action='store_true',
+                            help='Serialize non-string values in the migration data.')
+    run_parser.add_argument('--workers', type=int, default=0,
+                            help='Number of parallel workers. Default is 0, which migrates the '
+                                 'requests in the main thread.')
+    run_parser.add_argument('--executor', choices=['thread', 'process'], default='process',
+                            help='Type of worker used when --workers is given.')
+    run_parser.add_argument('--checkpoint',
+                            help='SQLite database where migrated requests are saved, so they '
+                                 'are not migrated again if the command is run again.')
+    args = parser.parse_args(argv)
+
+    handler = MigrationHandler(
+        load_transformations(args.transformations) if args.transformations else None,
+        migration_key=args.migration_key or 'migration_info',
+        merge_policy=args.merge_policy,
+        serialize=args.serialize,
+        copy_on_write=True,
+        checkpoint_store=SQLiteCheckpointStore(args.checkpoint) if args.checkpoint else None)
+
+    with _open_stream(args.input, sys.stdin, 'r') as input_file, \
+            _open_stream(args.output, sys.stdout, 'w') as output_file:
+        stats = migrate_jsonl(handler, input_file, output_file,
+                              executor=args.executor if args.workers > 0 else None,
+                              max_workers=args.workers or None)
+
+    total = stats.migrated + stats.failed + stats.not_needed + stats.invalid
+    sys.stderr.write('{} requests in {:.2f}s ({:.1f} requests/sec): {} migrated, {} failed, '
+                     '{} not needed, {} invalid.\n'
+                     .format(total, stats.elapsed, total / stats.elapsed if stats.elapsed else 0,
+                             stats.migrated, stats.failed, stats.not_needed, stats.invalid))
+    return 1 if stats.failed or stats.invalid else 0
+
+
+@contextlib.contextmanager
+def _open_stream(filename, standard_stream, mode):
+    # type: (str, Any, str) -> Iterator[Any]
+    if filename == '-':
+        yield standard_stream
+    else:
+        with open(filename, mode) as file_handle:
+            yield file_handle
+
+
+if __name__ == '__main__':
+    # Run the imported module, so that pickled objects refer to it instead of to __main__
+    from connect_migration import main as _main
+    sys.exit(_main())
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+""" This module provides the :py:class:`.AsyncMigrationHandler` class, an asyncio version of
+:py:class:`connect_migration.MigrationHandler` which supports coroutine transformations.
+It requires Python 3.5 or later.
+
+Transformations can be plain functions or coroutine functions, and the transformations of
+the different params of a request run concurrently: ::
+
+    async def reseller_id(data, request_id):
+        return await reseller_mapping.lookup(data['resellerId'])
+
+    handler = AsyncMigrationHandler({
+        'email': lambda data, request_id: data['teamAdminEmail'].upper(),
+        'reseller_id': reseller_id,
+    }, max_concurrency=5)
+
+    request = await handler.migrate(request)
+
+"""
+
+import asyncio
+import inspect
+
+from connect_migration import (
+    MigrationAbortError,
+    MigrationBatchItem,
+    MigrationBatchResult,
+    MigratedRequest,
+    MigrationDiff,
+    MigrationHandler,
+    MigrationParamError,
+    MigrationPlan,
+    _MigrationReport,
+    _MISSING,
+    _NOT_RUN,
+    _declared_depends,
+    _unexpected_error,
+    logger,
+)
+
+
+class AsyncMigrationHandler(MigrationHandler):
+    """ Asyncio version of :py:class:`connect_migration.MigrationHandler`.
+
+    It accepts the same arguments, plus the following one:
+
+    :param int max_concurrency: Maximum number of transformations of a request that can run
+      at the same time. ``None`` means no limit. Default value is ``10``.
+    """
+
+    def __init__(self, *args, max_concurrency=10, **kwargs):
+        # max_concurrency is keyword-only to keep the positional arguments of MigrationHandler
+        super(AsyncMigrationHandler, self).__init__(*args, **kwargs)
+        self._max_concurrency = max_concurrency
+
+    @property
+    def max_concurrency(self):
+        """
+        :return: Maximum number of transformations of a request that can run at the same time.
+        :rtype: int|None
+        """
+        return self._max_concurrency
+
+    async def migrate(self, request):
+        """ Call this function to perform migration of one request.
+
+        :param Fulfillment request: The request to migrate.
+        :return: A new request object with the parameter values updated.
+        :rtype: Fulfillment
+        :raises SkipRequest: Raised if migration fails for some reason.
+        """
+        if not self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return request
+
+        logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                    request.id, request.id)
+        with self._time(request.id, 'total'):
+            return await self._migrate_async(request)
+
+    async def migrate_diff(self, request):
+        """ Call this function to perform migration of one request, getting only the params
+        whose values change. See :py:meth:`connect_migration.MigrationHandler.migrate_diff`.
+
+        :param Fulfillment request: The request to migrate.
+        :return: The changed params and the outcome of every param.
+        :rtype: MigrationDiff
+        :raises SkipRequest: Raised if migration fails for some reason.
+        """
+        if not self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return MigrationDiff(request.id, [], _MigrationReport())
+
+        logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                    request.id, request.id)
+        with self._time(request.id, 'total'):
+            values, report = await self._migrate_values_async(request)
+        return self._build_diff(request, values, report)
+
+    async def migrate_records(self, request):
+        """ Call this function to perform migration of one request without copying it. See
+        :py:meth:`connect_migration.MigrationHandler.migrate_records`.
+
+        :param Fulfillment request: The request to migrate.
+        :return: The migrated values.
+        :rtype: MigratedRequest
+        :raises SkipRequest: Raised if migration fails for some reason.
+        """
+        if not self.needs_migration(request):
+            logger.info('[MIGRATION::%s] Request does not need migration.', request.id)
+            self._count(request.id, 'requests.not_needed')
+            return MigratedRequest(request, [], self.copy_on_write)
+
+        logger.info('[MIGRATION::%s] Running migration operations for request %s',
+                    request.id, request.id)
+        with self._time(request.id, 'total'):
+            values, _ = await self._migrate_values_async(request)
+        return MigratedRequest(request, values, self.copy_on_write)
+
+    async def _migrate_async(self, request):
+        values, _ = await self._migrate_values_async(request)
+        return self._apply_values(request, values)
+
+    async def _migrate_values_async(self, request):
+        checkpoint = self._checkpoint_key(request)
+        if checkpoint is not None:
+            restored = self._restore_checkpoint(checkpoint, request)
+            if restored is not None:
+                return restored
+
+        try:
+            plan = self._get_plan(request)
+            parsed_data = self._parse_migration_data(request, plan)
+            invalid = self._validate(plan, parsed_data)
+            steps = self._steps_to_run(plan, invalid)
+
+            semaphore = asyncio.Semaphore(self.max_concurrency) \
+                if self.max_concurrency else None
+            derived = _AsyncDerivedValues(self, parsed_data, request.id)
+            tasks = [asyncio.ensure_future(
+                self._run_step_async(semaphore, step, parsed_data, request.id, invalid, derived))
+                for step in steps]
+            try:
+                if self.validation == self.FAIL_FAST:
+                    await self._wait_fail_fast(tasks)
+                else:
+                    await asyncio.gather(*tasks)
+            finally:
+                # Nothing outlives the migration, even if a step raised an unexpected error
+                await _cancel_tasks(tasks)
+                await derived.cancel()
+            outcomes = [task.result() if not task.cancelled() else (_NOT_RUN, None)
+                        for task in tasks]
+
+            # Report in the same order as the params, like the synchronous handler does
+            values, report = self._collect_outcomes(request, steps, outcomes, invalid)
+        except MigrationAbortError as ex:
+            raise self._abort_migration(request, ex)
+
+        self._migration_succeeded(request, checkpoint, values)
+        return values, report
+
+    async def migrate_many(self, requests, max_requests=None):
+        """ Call this function to migrate several requests concurrently.
+
+        Failed migrations do not stop the batch, they are reported in the returned object
+        instead, including unexpected exceptions raised by transformations.
+
+        :param Iterable[Fulfillment] requests: The requests to migrate.
+        :param int max_requests: Maximum number of requests migrated at the same time, since
+          ``max_concurrency`` only limits the transformations of each request. ``None`` means
+          no limit. Default value is ``None``.
+        :return: The outcome of every request, in the same order as ``requests``.
+        :rtype: MigrationBatchResult
+        """
+        from connect.exceptions import SkipRequest
+        requests = list(requests)
+        semaphore = asyncio.Semaphore(max_requests) if max_requests else None
+
+        async def migrate(request):
+            if semaphore is None:
+                return await self.migrate(request)
+            async with semaphore:
+                return await self.migrate(request)
+
+        outcomes = await asyncio.gather(*[migrate(request) for request in requests],
+                                        return_exceptions=True)
+        items = []
+        for request, outcome in zip(requests, outcomes):
+            if isinstance(outcome, (SkipRequest, MigrationAbortError)):
+                items.append(MigrationBatchItem(request, error=outcome))
+            elif isinstance(outcome, Exception):
+                items.append(MigrationBatchItem(request, error=_unexpected_error(request, outcome)))
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                items.append(MigrationBatchItem(request, result=outcome))
+        return MigrationBatchResult(items)
+
+    def imigrate(self, requests, executor=None, max_workers=None, window=None):
+        """ Not supported, because the migrations of this handler are coroutines. Use
+        :py:meth:`migrate_many` instead.
+
+        :raises TypeError: Always.
+        """
+        raise TypeError('AsyncMigrationHandler does not support imigrate, '
+                        'use migrate_many instead.')
+
+    def migrate_columnar(self, requests):
+        """ Not supported, because the transformations of this handler can be coroutines. Use
+        :py:meth:`migrate_many` instead.
+
+        :raises TypeError: Always.
+        """
+        raise TypeError('AsyncMigrationHandler does not support migrate_columnar, '
+                        'use migrate_many instead.')
+
+    @staticmethod
+    async def _wait_fail_fast(tasks):
+        # Returns as soon as one step fails, so the rest of them are cancelled
+        for future in asyncio.as_completed(tasks):
+            _, error = await future
+            if error is not None:
+                break
+
+    async def _run_step_async(self, semaphore, step, parsed_data, request_id, invalid, derived):
+        # Returns a (value, error) tuple, so one failed param does not cancel the others
+        if step.index in invalid:
+            return None, invalid[step.index]
+        try:
+            if step.action != MigrationPlan.TRANSFORM:
+                return self._assign_param(step.param_id, parsed_data), None
+
+            # Derived fields are computed outside of the semaphore, since they are shared
+            kwargs = await derived.get(_declared_depends(step.transformation))
+            if semaphore is None:
+                return await self._transform_async(step, parsed_data, request_id, kwargs), None
+            async with semaphore:
+                return await self._transform_async(step, parsed_data, request_id, kwargs), None
+        except MigrationParamError as ex:
+            return None, ex
+
+    async def _transform_async(self, step, parsed_data, request_id, kwargs):
+        self.param_logger.info('[MIGRATION::%s] Running transformation for parameter %s',
+                               request_id, step.param_id)
+        if kwargs:
+            with self._time(request_id, 'transformation.' + step.param_id):
+                value = step.transformation(parsed_data, request_id, **kwargs)
+                if inspect.isawaitable(value):
+                    value = await value
+            return value
+
+        cache_key = self._transformation_cache_key(step.param_id, parsed_data)
+        if cache_key is not None:
+            value = self._transformation_cache.get(cache_key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+        with self._time(request_id, 'transformation.' + step.param_id):
+            value = step.transformation(parsed_data, request_id)
+            if inspect.isawaitable(value):
+                value = await value
+
+        if cache_key is not None:
+            self._transformation_cache.put(cache_key, value)
+        return value
+
+
+class _AsyncDerivedValues(object):
+    """ Derived fields of one request, which are computed in a task the first time they are
+    needed, so the ones that do not depend on each other run concurrently. """
+
+    __slots__ = ('_handler', '_parsed_data', '_request_id', '_tasks')
+
+    def __init__(self, handler, parsed_data, request_id):
+        self._handler = handler
+        self._parsed_data = parsed_data
+        self._request_id = request_id
+        self._tasks = {}
+
+    async def get(self, names):
+        # Returns the values of the derived fields, raising the error of any that failed
+        if not names:
+            return {}
+        tasks = []
+        for name in names:
+            if name not in self._tasks:
+                self._tasks[name] = asyncio.ensure_future(self._compute(name))
+            tasks.append(self._tasks[name])
+        values = await asyncio.gather(*tasks)
+        return dict(zip(names, values))
+
+    async def cancel(self):
+        # Stops the derived fields that are still running
+        await _cancel_tasks(list(self._tasks.values()))
+
+    async def _compute(self, name):
+        handler = self._handler
+        kwargs = await self.get(handler._derived_depends[name])
+        with handler._time(self._request_id, 'derived.' + name):
+            value = handler._derived[name](self._parsed_data, self._request_id, **kwargs)
+            if inspect.isawaitable(value):
+                value = await value
+        return value
+
+
+async def _cancel_tasks(tasks):
+    # Cancels the tasks that are not done, and waits for all of them retrieving their errors
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='connect-migration',
     version='1.0',
-    py_modules=['connect_migration'],
+    py_modules=['connect_migration', 'connect_migration_async'],
     url='https://github.com/ingrammicro/connect-python-sdk-migration-framework',
     license='Apache Software License',
     author='Ingram Micro',
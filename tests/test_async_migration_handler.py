@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the Ingram Micro Cloud Blue Connect SDK.
+# Copyright (c) 2019 Ingram Micro. All Rights Reserved.
+
+import asyncio
+import logging
+import os
+
+import pytest
+import six
+from mock import patch, Mock
+from typing import Any, Dict, List, Optional
+
+from connect.exceptions import SkipRequest
+from connect.logger import logger
+from connect.models import Fulfillment
+
+import connect_migration
+import connect_migration_async
+
+
+def _load_str(filename):
+    # type: (str) -> Optional[str]
+    try:
+        filename = os.path.join(
+            os.path.dirname(__file__),
+            'data',
+            filename
+        )
+        with open(filename) as file_handle:
+            return file_handle.read()
+    except IOError:
+        return None
+
+
+def _messages(log_mock):
+    # type: (Mock) -> List[str]
+    return [args[0] % args[1:] for args, _ in log_mock.call_args_list]
+
+
+@pytest.fixture(autouse=True)
+def debug_logging():
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    yield
+    logger.setLevel(level)
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_properties():
+    # type: () -> None
+    handler = connect_migration_async.AsyncMigrationHandler(serialize=True)
+    assert isinstance(handler, connect_migration.MigrationHandler)
+    assert handler.max_concurrency == 10
+    assert handler.migration_key == 'migration_info'
+    assert handler.serialize
+
+
+def test_positional_arguments():
+    # type: () -> None
+    handler = connect_migration_async.AsyncMigrationHandler({}, 'legacy_data', True)
+    assert handler.migration_key == 'legacy_data'
+    assert handler.serialize
+    assert handler.max_concurrency == 10
+
+
+@patch('connect_migration_async.logger.info')
+def test_no_migration(info_mock):
+    # type: (Mock) -> None
+    requests = Fulfillment.deserialize(_load_str('response.json'))
+
+    handler = connect_migration_async.AsyncMigrationHandler()
+    request = _run(handler.migrate(requests[0]))
+    assert _messages(info_mock) == ['[MIGRATION::PR-5852-1608-0000] '
+                                    'Request does not need migration.']
+    assert request == requests[0]
+
+
+@patch('connect_migration_async.logger.info')
+def test_migration_transform(info_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    async def team_id(data, _):
+        await asyncio.sleep(0)
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({
+        'email': lambda data, request_id: data['teamAdminEmail'].upper(),
+        'team_id': team_id,
+        'num_licensed_users': lambda data, request_id: int(data['licNumber']) * 10
+    })
+    request_out = _run(handler.migrate(request))
+
+    assert request_out != request
+    assert request_out.asset.get_param_by_id('email').value == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert request_out.asset.get_param_by_id('num_licensed_users').value == 100
+    assert request_out.asset.get_param_by_id('team_id').value == 'DBTID:AADAQQ_'\
+                                                                 'W53NMDQBIPM_X123456PUZPCM2BI'
+    assert request_out.asset.get_param_by_id('team_name').value == ''
+    assert request.asset.get_param_by_id('team_id').value == ''
+
+    assert info_mock.call_count == 5
+    assert _messages(info_mock)[0] == (
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678')
+    assert _messages(info_mock)[-1] == (
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 3 succeeded '
+        '(email, num_licensed_users, team_id), 0 failed, 2 skipped (reseller_id, team_name).')
+
+
+def test_migration_concurrency_limit():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    running = []
+    peak = []
+
+    async def lookup(data, _):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return 'value'
+
+    transformations = {param_id: lookup for param_id
+                       in ('email', 'num_licensed_users', 'reseller_id', 'team_id', 'team_name')}
+
+    handler = connect_migration_async.AsyncMigrationHandler(transformations, max_concurrency=2)
+    _run(handler.migrate(request))
+    assert max(peak) == 2
+
+    handler = connect_migration_async.AsyncMigrationHandler(transformations,
+                                                            max_concurrency=None)
+    del peak[:]
+    _run(handler.migrate(request))
+    assert max(peak) == 5
+
+
+@patch('connect_migration_async.logger.error')
+@patch('connect_migration_async.logger.info')
+def test_migration_transform_manual_fail(info_mock, error_mock):
+    # type: (Mock, Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration_async.AsyncMigrationHandler({
+        'email': _raise_error,
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    })
+    with pytest.raises(SkipRequest):
+        _run(handler.migrate(request))
+
+    assert _messages(info_mock)[-1] == (
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 1 succeeded (team_id), 1 failed (email), '
+        '3 skipped (num_licensed_users, reseller_id, team_name).')
+    assert _messages(error_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Manual fail.',
+        '[MIGRATION::PR-7001-1234-5678] Processing of parameters email failed, '
+        'unable to complete migration.'
+    ]
+
+
+def test_migration_wrong_info():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.invalid.json'))
+
+    handler = connect_migration_async.AsyncMigrationHandler()
+    with pytest.raises(SkipRequest):
+        _run(handler.migrate(request))
+
+
+def test_migration_observer():
+    # type: () -> None
+    metrics = connect_migration.MigrationMetrics()
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    async def team_id(data, _):
+        await asyncio.sleep(0)
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({'team_id': team_id},
+                                                            observer=metrics)
+    _run(handler.migrate(request))
+
+    assert sorted(metrics.summary()) == ['copy', 'parse', 'total', 'transformation.team_id']
+    assert metrics.counters['requests.migrated'] == 1
+    assert metrics.counters['params.succeeded'] == 1
+
+
+def test_migration_transformation_cache():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    calls = []
+
+    @connect_migration.pure('teamId')
+    async def team_id(data, _):
+        calls.append(1)
+        await asyncio.sleep(0)
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({'team_id': team_id},
+                                                            transformation_cache_size=10)
+    _run(handler.migrate(request))
+    request_out = _run(handler.migrate(request))
+
+    assert len(calls) == 1
+    assert handler.transformation_cache_info().hits == 1
+    assert request_out.asset.get_param_by_id('team_id').value == 'DBTID:AADAQQ_'\
+                                                                 'W53NMDQBIPM_X123456PUZPCM2BI'
+
+
+def test_migration_checkpoint(tmpdir):
+    # type: (Any) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    store = connect_migration.SQLiteCheckpointStore(str(tmpdir.join('checkpoints.db')))
+    calls = []
+
+    async def team_id(data, _):
+        calls.append(1)
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({'team_id': team_id},
+                                                            checkpoint_store=store)
+    _run(handler.migrate(request))
+    request_out = _run(handler.migrate(request))
+
+    assert len(calls) == 1
+    assert request_out.asset.get_param_by_id('team_id').value == 'DBTID:AADAQQ_'\
+                                                                 'W53NMDQBIPM_X123456PUZPCM2BI'
+
+
+def test_migration_diff():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    async def team_id(data, _):
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({'team_id': team_id})
+    diff = _run(handler.migrate_diff(request))
+
+    assert diff.changes == [connect_migration.ParamChange(
+        'team_id', '', 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI')]
+    assert diff.skipped == ('email', 'num_licensed_users', 'reseller_id', 'team_name')
+
+    diff = _run(handler.migrate_diff(Fulfillment.deserialize(_load_str('response.json'))[0]))
+    assert diff.changes == []
+
+
+def test_migration_records():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    async def team_id(data, _):
+        return data['teamId'].upper()
+
+    handler = connect_migration_async.AsyncMigrationHandler({'team_id': team_id})
+    migrated = _run(handler.migrate_records(request))
+
+    assert migrated.changes == [connect_migration.ParamChange(
+        'team_id', '', 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI')]
+    assert migrated.to_request().asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+    assert request.asset.get_param_by_id('team_id').value == ''
+
+
+def test_migration_fail_fast():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    finished = []
+
+    async def slow(data, _):
+        await asyncio.sleep(1)
+        finished.append(1)
+        return 'value'
+
+    handler = connect_migration_async.AsyncMigrationHandler(
+        {'email': slow, 'team_id': _raise_error, 'team_name': slow}, validation='fail_fast')
+    with pytest.raises(SkipRequest) as error:
+        _run(handler.migrate(request))
+
+    assert finished == []
+    assert error.value.obj == (
+        connect_migration.ParamError('team_id', 'processing', 'Manual fail.'),)
+
+
+@pytest.mark.parametrize('validation', ['collect_all', 'fail_fast'])
+def test_migration_unexpected_error(validation):
+    # type: (str) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    finished = []
+
+    async def slow(data, _):
+        await asyncio.sleep(0.05)
+        finished.append('transformation')
+        return 'value'
+
+    async def slow_derived(data, _):
+        await asyncio.sleep(0.05)
+        finished.append('derived')
+        return 'value'
+
+    async def missing_key(data, _):
+        await asyncio.sleep(0)
+        return data['missingKey']
+
+    async def migrate():
+        with pytest.raises(KeyError):
+            await handler.migrate(request)
+        # Give the other steps time to finish, if they were left running
+        await asyncio.sleep(0.1)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    handler = connect_migration_async.AsyncMigrationHandler({
+        'email': slow,
+        'team_id': missing_key,
+        'team_name': connect_migration.depends('slow')(
+            lambda data, request_id, slow: slow),
+    }, derived={'slow': slow_derived}, validation=validation)
+    pending = _run(migrate())
+
+    # The rest of steps and derived fields are cancelled when one fails unexpectedly
+    assert finished == []
+    assert pending == []
+
+
+def test_migration_validation():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+
+    handler = connect_migration_async.AsyncMigrationHandler()
+    with pytest.raises(SkipRequest) as error:
+        _run(handler.migrate(request))
+    assert [param_error.stage for param_error in error.value.obj] == ['validation']
+
+
+def test_derived_fields():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    events = []
+
+    def lookup(name):
+        async def derived(data, _):
+            events.append('start ' + name)
+            await asyncio.sleep(0.01)
+            events.append('end ' + name)
+            return data[name]
+        return derived
+
+    @connect_migration.depends('teamId', 'teamName')
+    async def team_name(data, _, teamId, teamName):
+        return '{} ({})'.format(teamName, teamId)
+
+    handler = connect_migration_async.AsyncMigrationHandler(
+        {
+            'team_name': team_name,
+            'team_id': connect_migration.depends('teamId')(
+                lambda data, request_id, teamId: teamId.upper()),
+        },
+        derived={'teamId': lookup('teamId'), 'teamName': lookup('teamName')})
+    request_out = _run(handler.migrate(request))
+
+    assert request_out.asset.get_param_by_id('team_name').value == \
+        'Migration Team (dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI)'
+    assert request_out.asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+    # Computed once each, and concurrently
+    assert sorted(events[:2]) == ['start teamId', 'start teamName']
+    assert len(events) == 4
+
+
+def test_migrate_many():
+    # type: () -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.invalid.json')),
+        Fulfillment.deserialize(_load_str('response.json'))[0],
+    ]
+
+    handler = connect_migration_async.AsyncMigrationHandler({
+        'email': _raise_error,
+        'team_id': lambda data, request_id: data['teamId'],
+    })
+    requests.append(Fulfillment.deserialize(_load_str('request.migrate.direct.success.json')))
+    with patch('connect_migration.logger.exception'):
+        result = _run(handler.migrate_many(requests))
+
+    assert isinstance(result, connect_migration.MigrationBatchResult)
+    assert [item.succeeded for item in result] == [False, False, True, False]
+    assert isinstance(result[0].error, SkipRequest)
+    # Unexpected errors are reported for their request only
+    assert isinstance(result[3].error, KeyError)
+    assert result[2].result is requests[2]
+
+
+def test_migrate_many_max_requests():
+    # type: () -> None
+    requests = [Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+                for _ in range(4)]
+    running = []
+    peak = []
+
+    async def email(data, _):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return data['teamAdminEmail']
+
+    handler = connect_migration_async.AsyncMigrationHandler({'email': email})
+    result = _run(handler.migrate_many(requests, max_requests=2))
+
+    assert [item.succeeded for item in result] == [True] * 4
+    assert max(peak) == 2
+
+
+def test_sync_batches_not_supported():
+    # type: () -> None
+    requests = [Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))]
+    handler = connect_migration_async.AsyncMigrationHandler({'email': _raise_error})
+
+    with pytest.raises(TypeError):
+        handler.imigrate(requests)
+    with pytest.raises(TypeError):
+        handler.migrate_columnar(requests)
+    with pytest.raises(TypeError):
+        connect_migration.migrate_jsonl(handler, six.StringIO(), six.StringIO())
+    with pytest.raises(TypeError):
+        connect_migration.MigrationWorker(handler, lambda item: None)
+
+
+async def _raise_error(_, __):
+    # type: (Dict[str, str], str) -> None
+    raise connect_migration.MigrationParamError('Manual fail.')
@@ -3,15 +3,20 @@
 # This file is part of the Ingram Micro Cloud Blue Connect SDK.
 # Copyright (c) 2019 Ingram Micro. All Rights Reserved.
 
+import json
+import logging
 import os
+import sqlite3
+import threading
 
 import pytest
-from mock import patch, Mock, call
-from typing import Dict, Optional
+from mock import patch, Mock
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import six
 
 from connect.exceptions import SkipRequest
+from connect.logger import logger
 from connect.models import Fulfillment
 
 import connect_migration
@@ -31,6 +36,19 @@ def _load_str(filename):
         return None
 
 
+def _messages(log_mock):
+    # type: (Mock) -> List[str]
+    return [args[0] % args[1:] for args, _ in log_mock.call_args_list]
+
+
+@pytest.fixture(autouse=True)
+def debug_logging():
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    yield
+    logger.setLevel(level)
+
+
 def test_properties():
     # type: () -> None
     handler = connect_migration.MigrationHandler()
@@ -38,9 +56,13 @@ def test_properties():
     assert isinstance(handler.transformations, dict)
     assert isinstance(handler.migration_key, str)
     assert isinstance(handler.serialize, bool)
+    assert isinstance(handler.copy_on_write, bool)
     assert len(handler.transformations) == 0
     assert handler.migration_key == 'migration_info'
     assert not handler.serialize
+    assert not handler.copy_on_write
+    assert handler.decoder is json.loads
+    assert handler.parse_cache_info() is None
 
 
 def test_needs_migration():
@@ -72,8 +94,8 @@ def test_no_migration(info_mock):
 
     handler = connect_migration.MigrationHandler()
     request = handler.migrate(requests[0])
-    info_mock.assert_called_once_with('[MIGRATION::PR-5852-1608-0000] '
-                                      'Request does not need migration.')
+    assert _messages(info_mock) == ['[MIGRATION::PR-5852-1608-0000] '
+                                    'Request does not need migration.']
     assert request == requests[0]
 
 
@@ -88,23 +110,23 @@ def test_migration_skip_all(info_mock, debug_mock):
     request_out = handler.migrate(request)
 
     assert info_mock.call_count == 2
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
-             'PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 0 succeeded, 0 failed, 5 skipped '
-             '(email, num_licensed_users, reseller_id, team_id, team_name).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 0 succeeded, 0 failed, 5 skipped '
+        '(email, num_licensed_users, reseller_id, team_id, team_name).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"teamAdminEmail":"example.migration@mailinator.com",'
-             '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
-             '"resellerId":["3ONEYO1234"],'
-             '"teamName":"Migration Team",'
-             '"licNumber":"10"}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"teamAdminEmail":"example.migration@mailinator.com",'
+        '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
+        '"resellerId":["3ONEYO1234"],'
+        '"teamName":"Migration Team",'
+        '"licNumber":"10"}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
     assert request_out != request
     assert request_out.id == 'PR-7001-1234-5678'
@@ -128,21 +150,22 @@ def test_migration_wrong_info(info_mock, debug_mock, error_mock):
         handler.migrate(request)
 
     assert info_mock.call_count == 1
-    info_mock.assert_called_with('[MIGRATION::PR-7001-1234-5678] Running migration operations '
-                                 'for request PR-7001-1234-5678')
+    assert _messages(info_mock) == ['[MIGRATION::PR-7001-1234-5678] Running migration operations '
+                                    'for request PR-7001-1234-5678']
 
     assert debug_mock.call_count == 1
-    debug_mock.assert_called_with('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: '
-                                  '"teamAdminEmail":"example.migration@mailinator.com",'
-                                  '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
-                                  '"resellerId":["3ONEYO1234"],'
-                                  '"teamName":"Migration Team",'
-                                  '"licNumber":"10"}')
+    assert _messages(debug_mock) == ['[MIGRATION::PR-7001-1234-5678] Migration data '
+                                     '`migration_info`: '
+                                     '"teamAdminEmail":"example.migration@mailinator.com",'
+                                     '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
+                                     '"resellerId":["3ONEYO1234"],'
+                                     '"teamName":"Migration Team",'
+                                     '"licNumber":"10"}']
 
     assert error_mock.call_count == 1
     # The following assertion fails on macOS, so it has been disabled for now
-    # error_mock.assert_called_with('[MIGRATION::PR-7001-1234-5678] Extra data: '
-    #                              'line 1 column 17 - line 1 column 179 (char 16 - 178)')
+    # assert _messages(error_mock) == ['[MIGRATION::PR-7001-1234-5678] Extra data: '
+    #                                  'line 1 column 17 - line 1 column 179 (char 16 - 178)']
 
 
 @patch('connect_migration.logger.debug')
@@ -167,22 +190,22 @@ def test_migration_direct(info_mock, debug_mock):
     assert request_out.asset.get_param_by_id('team_name').value == 'Migration Team'
 
     assert info_mock.call_count == 2
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
-             'PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 4 succeeded '
-             '(email, num_licensed_users, team_id, team_name), 0 failed, 1 skipped (reseller_id).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 4 succeeded '
+        '(email, num_licensed_users, team_id, team_name), 0 failed, 1 skipped (reseller_id).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"email":"example.migration@mailinator.com",'
-             '"team_id":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
-             '"team_name":"Migration Team",'
-             '"num_licensed_users":"10"}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"email":"example.migration@mailinator.com",'
+        '"team_id":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
+        '"team_name":"Migration Team",'
+        '"num_licensed_users":"10"}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
 
 @patch('connect_migration.logger.error')
@@ -198,28 +221,103 @@ def test_migration_direct_no_serialize(info_mock, debug_mock, error_mock):
         handler.migrate(request)
 
     assert info_mock.call_count == 2
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations '
-             'for request PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 1 succeeded (email), '
-             '1 failed (team_name), 3 skipped (num_licensed_users, reseller_id, team_id).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations '
+        'for request PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 1 succeeded (email), '
+        '1 failed (team_name), 3 skipped (num_licensed_users, reseller_id, team_id).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"email":"example.migration@mailinator.com",'
-             '"team_name":["Some name"]}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"email":"example.migration@mailinator.com",'
+        '"team_name":["Some name"]}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
     assert error_mock.call_count == 2
-    error_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Parameter team_name type must be str, '
-             'but list was given'),
-        call('[MIGRATION::PR-7001-1234-5678] Processing of parameters team_name failed, '
-             'unable to complete migration.')
-    ])
+    assert _messages(error_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Parameter team_name type must be str, '
+        'but list was given',
+        '[MIGRATION::PR-7001-1234-5678] Processing of parameters team_name failed, '
+        'unable to complete migration.'
+    ]
+
+
+def test_migration_serialize_encoder():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+    request.asset.get_param_by_id('migration_info').value = json.dumps({
+        'team_name': {'name': 'Some name', 'aliases': ['a', 'b']}})
+    parsed = []
+
+    def decoder(raw_data):
+        parsed.append(json.loads(raw_data))
+        return parsed[-1]
+
+    handler = connect_migration.MigrationHandler(serialize=True, compact_serialization=True,
+                                                 decoder=decoder)
+    request_out = handler.migrate(request)
+    assert request_out.asset.get_param_by_id('team_name').value == \
+        '{"name":"Some name","aliases":["a","b"]}'
+    # The parsed data is not modified
+    assert parsed[0]['team_name'] == {'name': 'Some name', 'aliases': ['a', 'b']}
+
+    def encoder(value):
+        return json.dumps(value, sort_keys=True).encode('utf-8')
+
+    handler = connect_migration.MigrationHandler(serialize=True, encoder=encoder)
+    assert handler.encoder is encoder
+    request_out = handler.migrate(request)
+    assert request_out.asset.get_param_by_id('team_name').value == \
+        '{"aliases": ["a", "b"], "name": "Some name"}'
+
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(encoder=encoder, compact_serialization=True)
+
+
+@pytest.mark.parametrize('encoder', [None, json.dumps])
+def test_migration_serialize_max_size(encoder):
+    # type: (Optional[Callable]) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+    request.asset.get_param_by_id('migration_info').value = json.dumps({
+        'team_name': ['Some name'] * 1000})
+
+    handler = connect_migration.MigrationHandler(serialize=True, encoder=encoder,
+                                                 max_serialized_size=1000)
+    assert handler.max_serialized_size == 1000
+    with patch('connect_migration.logger.error') as error_mock:
+        with pytest.raises(SkipRequest) as error:
+            handler.migrate(request)
+    assert _messages(error_mock)[0] == ('[MIGRATION::PR-7001-1234-5678] Parameter team_name '
+                                        'serialized value is longer than 1000 characters')
+    assert error.value.obj[0].param_id == 'team_name'
+
+    request.asset.get_param_by_id('migration_info').value = json.dumps({
+        'team_name': ['Some name'] * 10})
+    request_out = handler.migrate(request)
+    assert json.loads(request_out.asset.get_param_by_id('team_name').value) == \
+        ['Some name'] * 10
+
+
+def test_migration_serialize_max_size_number():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+    handler = connect_migration.MigrationHandler(serialize=True, max_serialized_size=3)
+
+    # Numbers are encoded at once by the C encoder, instead of in chunks
+    with patch.object(json.JSONEncoder, 'iterencode', autospec=True,
+                      side_effect=json.JSONEncoder.iterencode) as iterencode_mock:
+        request.asset.get_param_by_id('migration_info').value = json.dumps({'team_name': 12345})
+        with patch('connect_migration.logger.error'):
+            with pytest.raises(SkipRequest):
+                handler.migrate(request)
+
+        request.asset.get_param_by_id('migration_info').value = json.dumps({'team_name': 123})
+        request_out = handler.migrate(request)
+    assert request_out.asset.get_param_by_id('team_name').value == '123'
+    assert all(call[1] == {'_one_shot': True} for call in iterencode_mock.call_args_list)
 
 
 @patch('connect_migration.logger.debug')
@@ -242,20 +340,20 @@ def test_migration_direct_serialize(info_mock, debug_mock):
     assert team_name == '["Some name"]'
 
     assert info_mock.call_count == 2
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
-             'PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 2 succeeded '
-             '(email, team_name), 0 failed, 3 skipped (num_licensed_users, reseller_id, team_id).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 2 succeeded '
+        '(email, team_name), 0 failed, 3 skipped (num_licensed_users, reseller_id, team_id).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"email":"example.migration@mailinator.com",'
-             '"team_name":["Some name"]}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"email":"example.migration@mailinator.com",'
+        '"team_name":["Some name"]}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
 
 @patch('connect_migration.logger.debug')
@@ -285,27 +383,27 @@ def test_migration_transform(info_mock, debug_mock):
     assert request_out.asset.get_param_by_id('team_name').value == 'MIGRATION TEAM'
 
     assert info_mock.call_count == 6
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
-             'PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] Running transformation for parameter email'),
-        call('[MIGRATION::PR-7001-1234-5678] Running transformation for parameter '
-             'num_licensed_users'),
-        call('[MIGRATION::PR-7001-1234-5678] Running transformation for parameter team_id'),
-        call('[MIGRATION::PR-7001-1234-5678] Running transformation for parameter team_name'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 4 succeeded '
-             '(email, num_licensed_users, team_id, team_name), 0 failed, 1 skipped (reseller_id).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter email',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter '
+        'num_licensed_users',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter team_id',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter team_name',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 4 succeeded '
+        '(email, num_licensed_users, team_id, team_name), 0 failed, 1 skipped (reseller_id).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"teamAdminEmail":"example.migration@mailinator.com",'
-             '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
-             '"teamName":"Migration Team",'
-             '"licNumber":"10"}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"teamAdminEmail":"example.migration@mailinator.com",'
+        '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
+        '"teamName":"Migration Team",'
+        '"licNumber":"10"}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
 
 @patch('connect_migration.logger.error')
@@ -323,31 +421,1733 @@ def test_migration_transform_manual_fail(info_mock, debug_mock, error_mock):
         handler.migrate(request)
 
     assert info_mock.call_count == 3
-    info_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
-             'PR-7001-1234-5678'),
-        call('[MIGRATION::PR-7001-1234-5678] Running transformation for parameter email'),
-        call('[MIGRATION::PR-7001-1234-5678] 5 processed, 0 succeeded, 1 failed (email), '
-             '4 skipped (num_licensed_users, reseller_id, team_id, team_name).')
-    ])
+    assert _messages(info_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Running migration operations for request '
+        'PR-7001-1234-5678',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter email',
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 0 succeeded, 1 failed (email), '
+        '4 skipped (num_licensed_users, reseller_id, team_id, team_name).'
+    ]
 
     assert debug_mock.call_count == 2
-    debug_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
-             '"teamAdminEmail":"example.migration@mailinator.com",'
-             '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
-             '"teamName":"Migration Team",'
-             '"licNumber":"10"}'),
-        call('[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly')
-    ])
+    assert _messages(debug_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info`: {'
+        '"teamAdminEmail":"example.migration@mailinator.com",'
+        '"teamId":"dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI",'
+        '"teamName":"Migration Team",'
+        '"licNumber":"10"}',
+        '[MIGRATION::PR-7001-1234-5678] Migration data `migration_info` parsed correctly'
+    ]
 
     assert error_mock.call_count == 2
-    error_mock.assert_has_calls([
-        call('[MIGRATION::PR-7001-1234-5678] Manual fail.'),
-        call('[MIGRATION::PR-7001-1234-5678] Processing of parameters email failed, '
-             'unable to complete migration.')
+    assert _messages(error_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Manual fail.',
+        '[MIGRATION::PR-7001-1234-5678] Processing of parameters email failed, '
+        'unable to complete migration.'
+    ]
+
+
+def test_migration_copy_on_write():
+    # type: () -> None
+    response = _load_str('request.migrate.transformation.json')
+    request = Fulfillment.deserialize(response)
+    original_values = [(param.id, param.value) for param in request.asset.params]
+
+    handler = connect_migration.MigrationHandler({
+        'email': lambda data, request_id: data['teamAdminEmail'].upper(),
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    }, copy_on_write=True)
+    request_out = handler.migrate(request)
+
+    # The original request has not been modified
+    assert [(param.id, param.value) for param in request.asset.params] == original_values
+
+    # Changed params are cloned
+    assert request_out.asset.get_param_by_id('email').value == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert request_out.asset.get_param_by_id('team_id').value == 'DBTID:AADAQQ_'\
+                                                                 'W53NMDQBIPM_X123456PUZPCM2BI'
+    assert request_out.asset.get_param_by_id('email') is not request.asset.get_param_by_id('email')
+
+    # Everything else is shared
+    assert request_out is not request
+    assert request_out.asset is not request.asset
+    assert request_out.asset.params is not request.asset.params
+    assert request_out.asset.items is request.asset.items
+    assert request_out.asset.product is request.asset.product
+    assert request_out.marketplace is request.marketplace
+    assert request_out.asset.get_param_by_id('team_name') \
+        is request.asset.get_param_by_id('team_name')
+    assert request_out.asset.get_param_by_id('migration_info') \
+        is request.asset.get_param_by_id('migration_info')
+
+
+def test_migration_diff():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    transformations = {
+        'email': _upper_email,
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+        'team_name': lambda data, request_id: '',
+        'reseller_id': _raise_error,
+    }
+    with pytest.raises(SkipRequest):
+        connect_migration.MigrationHandler(transformations).migrate_diff(request)
+
+    del transformations['reseller_id']
+    diff = connect_migration.MigrationHandler(transformations).migrate_diff(request)
+
+    assert isinstance(diff, connect_migration.MigrationDiff)
+    assert diff.request_id == 'PR-7001-1234-5678'
+    assert diff.changes == [
+        connect_migration.ParamChange(
+            'email', '', 'EXAMPLE.MIGRATION@MAILINATOR.COM'),
+        connect_migration.ParamChange(
+            'team_id', '', 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'),
+    ]
+    assert len(diff) == 2
+    assert diff.as_dict() == {'email': 'EXAMPLE.MIGRATION@MAILINATOR.COM',
+                              'team_id': 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'}
+    assert [(param.id, param.value) for param in diff.params] == list(diff.as_dict().items())
+
+    # Unchanged values are reported as succeeded, but are not changes
+    assert diff.succeeded == ('email', 'team_id', 'team_name')
+    assert diff.skipped == ('num_licensed_users', 'reseller_id')
+    assert diff.failed == ()
+    assert diff.processed == ('email', 'num_licensed_users', 'reseller_id', 'team_id',
+                              'team_name')
+    assert request.asset.get_param_by_id('email').value == ''
+
+
+@pytest.mark.parametrize('copy_on_write', [False, True])
+def test_migration_records(copy_on_write):
+    # type: (bool) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration.MigrationHandler({
+        'email': _upper_email,
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    }, copy_on_write=copy_on_write)
+    migrated = handler.migrate_records(request)
+
+    assert isinstance(migrated, connect_migration.MigratedRequest)
+    assert migrated.request is request
+    assert len(migrated) == len(request.asset.params)
+    assert all(record.param is param for record, param in zip(migrated, request.asset.params))
+    assert not hasattr(migrated.records[0], '__dict__')
+    assert migrated.changes == [
+        connect_migration.ParamChange('email', '', 'EXAMPLE.MIGRATION@MAILINATOR.COM'),
+        connect_migration.ParamChange('team_id', '', 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'),
+    ]
+    assert [(param.id, param.value) for param in migrated.params] == [
+        (change.id, change.new) for change in migrated.changes]
+    assert request.asset.get_param_by_id('email').value == ''
+
+    # Materializes the same request as migrate
+    request_out = migrated.to_request()
+    expected = handler.migrate(request)
+    assert [(param.id, param.value) for param in request_out.asset.params] == \
+        [(param.id, param.value) for param in expected.asset.params]
+    assert (request_out.asset.get_param_by_id('team_name')
+            is request.asset.get_param_by_id('team_name')) == copy_on_write
+    assert request.asset.get_param_by_id('email').value == ''
+
+    not_needed = Fulfillment.deserialize(_load_str('response.json'))[0]
+    assert handler.migrate_records(not_needed).changes == []
+
+
+def test_migration_diff_not_needed():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('response.json'))[0]
+
+    diff = connect_migration.MigrationHandler().migrate_diff(request)
+    assert diff.request_id == 'PR-5852-1608-0000'
+    assert diff.changes == []
+    assert diff.processed == ()
+
+
+def test_migration_diff_checkpoint(tmpdir):
+    # type: (Any) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    store = connect_migration.FileCheckpointStore(str(tmpdir.join('checkpoints.jsonl')))
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email},
+                                                 checkpoint_store=store)
+    first = handler.migrate_diff(request)
+    second = handler.migrate_diff(request)
+
+    assert first.changes == second.changes
+    assert second.succeeded == ('email',)
+
+
+@patch('connect_migration.logger.info')
+def test_migration_fail_fast(info_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    team_id = Mock(return_value='value')
+
+    handler = connect_migration.MigrationHandler({
+        'email': _raise_error,
+        'team_id': team_id,
+    }, validation='fail_fast')
+    assert handler.validation == connect_migration.MigrationHandler.FAIL_FAST
+    with pytest.raises(SkipRequest) as error:
+        handler.migrate(request)
+
+    team_id.assert_not_called()
+    assert error.value.obj == (connect_migration.ParamError('email', 'processing', 'Manual fail.'),)
+    assert _messages(info_mock)[-1] == \
+        '[MIGRATION::PR-7001-1234-5678] 1 processed, 0 succeeded, 1 failed (email), 0 skipped.'
+
+
+def test_migration_collect_all_errors():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration.MigrationHandler({
+        'email': _raise_error,
+        'team_id': _raise_error,
+        'team_name': {'source': 'teamName'},
+    })
+    assert handler.validation == 'collect_all'
+    item = handler.migrate_many([request])[0]
+
+    assert not item.succeeded
+    assert item.errors == (
+        connect_migration.ParamError('email', 'processing', 'Manual fail.'),
+        connect_migration.ParamError('team_id', 'processing', 'Manual fail.'),
+    )
+
+    # Errors are kept when the exception is sent back from a worker process
+    import pickle
+    assert pickle.loads(pickle.dumps(item.error)).obj == item.errors
+
+
+@pytest.mark.parametrize('validation', ['collect_all', 'fail_fast'])
+def test_migration_validation(validation):
+    # type: (str) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+    team_id = Mock(return_value='value')
+
+    handler = connect_migration.MigrationHandler({
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int'},
+        'reseller_id': {'source': 'resellerId', 'default': ''},
+        'team_id': team_id,
+    }, validation=validation)
+    with pytest.raises(SkipRequest) as error:
+        handler.migrate(request)
+
+    errors = [
+        connect_migration.ParamError(
+            'num_licensed_users', 'validation',
+            'Value `licNumber` not found in migration data.'),
+        connect_migration.ParamError(
+            'team_name', 'validation', 'Parameter team_name type must be str, but list was given'),
+    ]
+    if validation == 'fail_fast':
+        # No transformation runs if the validation fails
+        assert team_id.call_count == 0
+        assert list(error.value.obj) == errors[:1]
+    else:
+        assert team_id.call_count == 1
+        assert list(error.value.obj) == errors
+
+
+def test_migration_validation_not_object():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+    request.asset.get_param_by_id('migration_info').value = '["email"]'
+
+    with patch('connect_migration.logger.error') as error_mock:
+        with pytest.raises(SkipRequest):
+            connect_migration.MigrationHandler().migrate(request)
+    assert _messages(error_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Migration data must be an object, but list was given.']
+
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(validation='lazy')
+
+
+def test_migration_decoder():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+    decoder = Mock(side_effect=json.loads)
+
+    handler = connect_migration.MigrationHandler(decoder=decoder)
+    request_out = handler.migrate(request)
+
+    assert handler.decoder is decoder
+    decoder.assert_called_once_with(request.asset.get_param_by_id('migration_info').value)
+    assert request_out.asset.get_param_by_id('email').value == 'example.migration@mailinator.com'
+
+
+@patch('connect_migration.logger.error')
+def test_migration_decoder_error(error_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+
+    handler = connect_migration.MigrationHandler(decoder=Mock(side_effect=ValueError('Bad JSON')))
+    with pytest.raises(SkipRequest):
+        handler.migrate(request)
+    assert _messages(error_mock) == ['[MIGRATION::PR-7001-1234-5678] Bad JSON']
+
+
+def test_migration_parse_cache():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json'))
+    decoder = Mock(side_effect=json.loads)
+
+    handler = connect_migration.MigrationHandler(serialize=True, decoder=decoder,
+                                                 parse_cache_size=1)
+    first = handler.migrate(request)
+    second = handler.migrate(request)
+
+    assert decoder.call_count == 1
+    assert handler.parse_cache_info() == connect_migration.CacheInfo(
+        hits=1, misses=1, maxsize=1, currsize=1)
+    assert first.asset.get_param_by_id('team_name').value == '["Some name"]'
+    assert second.asset.get_param_by_id('team_name').value == '["Some name"]'
+
+    # Different migration data is parsed again, and evicts the previous one
+    other = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+    handler.migrate(other)
+    handler.migrate(request)
+    assert decoder.call_count == 3
+    assert handler.parse_cache_info().currsize == 1
+
+
+@pytest.mark.parametrize('raw_data', [
+    '{}',
+    ' { "a" : 1 , "b" : [1, 2, {"c": "]}"}], "c": {"d": {"e": [[]]}}, "e": null } ',
+    '{"a": "x\\"}{[", "b": "\\u00e9\\\\", "c": -1.5e3, "d": true, "e": false}',
+    '{"b": {"a": 1}, "a": {"b": "\\""}, "c": [], "d": {}, "a": 2}',
+    u'{"\u00e9": "\u00e9", "a": ["\\"", "]"], "c": "}"}',
+])
+def test_decode_object_keys(raw_data):
+    # type: (str) -> None
+    keys = frozenset(['a', 'e', u'\u00e9', 'missing'])
+    expected = {key: value for key, value in json.loads(raw_data).items() if key in keys}
+    assert connect_migration._decode_object_keys(raw_data, keys) == expected
+
+
+@pytest.mark.parametrize('raw_data', [
+    '{', '{"a": 1', '{"a" 1}', '{"a": 1,}', '{"a": 1} x', '{a: 1}', '{"b": [1}',
+    '{"b": "x}', '{"b": }', '{"a": 1 "b": 2}',
+])
+def test_decode_object_keys_invalid(raw_data):
+    # type: (str) -> None
+    with pytest.raises(ValueError):
+        connect_migration._decode_object_keys(raw_data, frozenset(['a']))
+
+
+def test_decode_object_keys_not_object():
+    # type: () -> None
+    assert connect_migration._decode_object_keys(' [1, 2]', frozenset(['a'])) is None
+    assert connect_migration._decode_object_keys('"a"', frozenset(['a'])) is None
+    assert connect_migration._decode_object_keys('', frozenset(['a'])) is None
+
+
+def test_migration_partial_decode():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    data = json.loads(request.asset.get_param_by_id('migration_info').value)
+    seen_keys = []
+
+    @connect_migration.reads('teamId')
+    def team_id(data, _):
+        seen_keys.extend(data)
+        return data['teamId'].upper()
+
+    handler = connect_migration.MigrationHandler({
+        'team_id': team_id,
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int'},
+    }, partial_decode=True)
+    assert handler.partial_decode
+    plan = handler.compile_plan(None, [param.id for param in request.asset.params])
+    assert plan.keys == frozenset(['email', 'licNumber', 'reseller_id', 'teamId', 'team_name'])
+
+    with patch('connect_migration.json.loads') as loads_mock:
+        request_out = handler.migrate(request)
+    loads_mock.assert_not_called()
+    # Keys not needed by any param, like teamName, are not decoded
+    assert sorted(seen_keys) == ['licNumber', 'teamId']
+    assert request_out.asset.get_param_by_id('team_id').value == \
+        data['teamId'].upper()
+    assert request_out.asset.get_param_by_id('num_licensed_users').value == 10
+
+
+def test_migration_partial_decode_full():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    seen_keys = []
+
+    def team_id(data, _):
+        seen_keys.extend(data)
+        return data['teamId'].upper()
+
+    handler = connect_migration.MigrationHandler({'team_id': team_id}, partial_decode=True)
+    handler.migrate(request)
+    assert handler.compile_plan(None, ['team_id']).keys is None
+    assert 'teamAdminEmail' in seen_keys
+
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(partial_decode=True, decoder=json.loads)
+
+
+def test_migration_partial_decode_invalid():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.invalid.json'))
+
+    handler = connect_migration.MigrationHandler(partial_decode=True)
+    with pytest.raises(SkipRequest):
+        handler.migrate(request)
+
+
+@patch('connect_migration.MigrationHandler._format_params')
+@patch('connect_migration.MigrationHandler._format_payload')
+def test_migration_logging_disabled(format_payload_mock, format_params_mock):
+    # type: (Mock, Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+
+    logger.setLevel(logging.WARNING)
+    handler = connect_migration.MigrationHandler()
+    request_out = handler.migrate(request)
+
+    assert request_out.asset.get_param_by_id('email').value == 'example.migration@mailinator.com'
+    format_payload_mock.assert_not_called()
+    format_params_mock.assert_not_called()
+
+
+@patch('connect_migration.logger.debug')
+def test_migration_log_payload_truncate(debug_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+
+    handler = connect_migration.MigrationHandler(log_payload='truncate', log_payload_limit=10)
+    handler.migrate(request)
+
+    assert handler.log_payload == 'truncate'
+    assert handler.log_payload_limit == 10
+    assert _messages(debug_mock)[0] == '[MIGRATION::PR-7001-1234-5678] Migration data ' \
+                                       '`migration_info`: {"email":"... (153 characters)'
+
+
+@patch('connect_migration.logger.debug')
+def test_migration_log_payload_hash(debug_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.direct.success.json'))
+
+    handler = connect_migration.MigrationHandler(log_payload='hash')
+    handler.migrate(request)
+
+    assert _messages(debug_mock)[0] == '[MIGRATION::PR-7001-1234-5678] Migration data ' \
+                                       '`migration_info`: ' \
+                                       'sha1:1246c5b98ea68a64d67ed16a00da2ee9ca0a2c29 ' \
+                                       '(153 characters)'
+
+
+def test_migration_log_payload_unknown():
+    # type: () -> None
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(log_payload='zip')
+
+
+@patch('connect_migration.logger.error')
+@patch('connect_migration.logger.info')
+def test_migration_param_logger(info_mock, error_mock):
+    # type: (Mock, Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    param_logger = Mock()
+
+    handler = connect_migration.MigrationHandler({
+        'email': _raise_error,
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    }, param_logger=param_logger)
+    with pytest.raises(SkipRequest):
+        handler.migrate(request)
+
+    assert handler.param_logger is param_logger
+    assert _messages(param_logger.info) == [
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter email',
+        '[MIGRATION::PR-7001-1234-5678] Running transformation for parameter team_id',
+    ]
+    assert _messages(param_logger.error) == ['[MIGRATION::PR-7001-1234-5678] Manual fail.']
+    assert info_mock.call_count == 2
+    assert _messages(error_mock) == [
+        '[MIGRATION::PR-7001-1234-5678] Processing of parameters email failed, '
+        'unable to complete migration.'
+    ]
+
+
+def _split_migration_data(request, billing):
+    # type: (Fulfillment, Optional[str]) -> Fulfillment
+    # Moves the reseller_id param to a second migration param, migration_billing
+    param = request.asset.get_param_by_id('reseller_id')
+    param.id = 'migration_billing'
+    param.value = billing
+    return request
+
+
+@pytest.mark.parametrize('merge_policy', ['first', 'last', 'strict'])
+def test_migration_multiple_keys(merge_policy):
+    # type: (str) -> None
+    request = _split_migration_data(
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        json.dumps({'licNumber': '20', 'resellerId': 'RES-1', 'team_name': 'Billing'}))
+
+    handler = connect_migration.MigrationHandler({
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int'},
+        'email': {'source': 'resellerId'},
+    }, migration_key=['migration_info', 'migration_billing'], merge_policy=merge_policy)
+    assert handler.migration_key == 'migration_info'
+    assert handler.migration_keys == ('migration_info', 'migration_billing')
+    assert handler.merge_policy == merge_policy
+
+    if merge_policy == 'strict':
+        with patch('connect_migration.logger.error') as error_mock:
+            with pytest.raises(SkipRequest):
+                handler.migrate(request)
+        assert _messages(error_mock) == [
+            '[MIGRATION::PR-7001-1234-5678] Migration data `migration_billing` contains keys '
+            'found in a previous migration param: licNumber.']
+        return
+
+    diff = handler.migrate_diff(request)
+    assert diff.as_dict() == {
+        'email': 'RES-1',
+        'num_licensed_users': 10 if merge_policy == 'first' else 20,
+        'team_name': 'Billing',
+    }
+    # None of the migration params is processed
+    assert diff.processed == ('email', 'num_licensed_users', 'team_id', 'team_name')
+
+
+def test_migration_multiple_keys_sources():
+    # type: () -> None
+    request = _split_migration_data(
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')), '')
+    handler = connect_migration.MigrationHandler(
+        {'team_id': {'source': 'teamId'}}, migration_key=['migration_billing', 'migration_info'])
+
+    # A migration param without value is ignored
+    assert handler.needs_migration(request)
+    assert handler.migrate_diff(request).as_dict() == {
+        'team_id': 'dbtid:AADaQq_w53nMDQbIPM_X123456PuzpcM2BI'}
+
+    request.asset.get_param_by_id('migration_info').value = ''
+    assert not handler.needs_migration(request)
+    request.asset.get_param_by_id('migration_billing').value = '["not", "an", "object"]'
+    with pytest.raises(SkipRequest):
+        handler.migrate(request)
+
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(migration_key=[])
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(merge_policy='any')
+    # Keys left out by partial decoding could not be checked for duplicates
+    with pytest.raises(ValueError):
+        connect_migration.MigrationHandler(
+            migration_key=['migration_info', 'migration_billing'], merge_policy='strict',
+            partial_decode=True)
+    assert connect_migration.MigrationHandler(merge_policy='strict', partial_decode=True)
+
+
+def test_migration_multiple_keys_checkpoint(tmpdir):
+    # type: (Any) -> None
+    request = _split_migration_data(
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        json.dumps({'resellerId': 'RES-1'}))
+    store = connect_migration.FileCheckpointStore(str(tmpdir.join('checkpoints.jsonl')))
+    handler = connect_migration.MigrationHandler(
+        {'email': {'source': 'resellerId'}},
+        migration_key=['migration_info', 'migration_billing'], checkpoint_store=store)
+
+    assert handler.migrate(request).asset.get_param_by_id('email').value == 'RES-1'
+
+    # The result is invalidated when the data of any migration param changes
+    request.asset.get_param_by_id('migration_billing').value = json.dumps({'resellerId': 'RES-2'})
+    assert handler.migrate(request).asset.get_param_by_id('email').value == 'RES-2'
+
+
+def test_compile_plan():
+    # type: () -> None
+    handler = connect_migration.MigrationHandler({'email': _upper_email}, serialize=True)
+    plan = handler.compile_plan('PRD-123-456-7889',
+                                ['email', 'migration_info', 'team_id'])
+
+    assert isinstance(plan, connect_migration.MigrationPlan)
+    assert plan.product_id == 'PRD-123-456-7889'
+    assert plan.param_ids == ('email', 'migration_info', 'team_id')
+    assert plan.steps == (
+        connect_migration.MigrationStep(0, 'email', connect_migration.MigrationPlan.TRANSFORM,
+                                        _upper_email),
+        connect_migration.MigrationStep(2, 'team_id', connect_migration.MigrationPlan.SERIALIZE,
+                                        None),
+    )
+
+    # Plans are cached
+    assert handler.compile_plan('PRD-123-456-7889', ('email', 'migration_info', 'team_id')) \
+        is plan
+    assert handler.compile_plan('PRD-000-000-0000', ('email', 'migration_info', 'team_id')) \
+        is not plan
+
+    handler = connect_migration.MigrationHandler()
+    plan = handler.compile_plan('PRD-123-456-7889', ['email'])
+    assert plan.steps[0].action == connect_migration.MigrationPlan.ASSIGN
+
+
+def test_migration_plan_reused():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+    plan = handler.compile_plan('PRD-123-456-7889', request.asset.params)
+    assert plan.param_ids == ('email', 'num_licensed_users', 'reseller_id', 'team_id',
+                              'team_name', 'migration_info')
+
+    with patch.object(handler, 'compile_plan') as compile_plan_mock:
+        first = handler.migrate(request)
+        second = handler.migrate(request)
+    compile_plan_mock.assert_not_called()
+
+    for request_out in (first, second):
+        assert request_out.asset.get_param_by_id('email').value \
+            == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+
+
+def test_warmup():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration.MigrationHandler({
+        'email': _upper_email,
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+    })
+    handler.warmup({'PRD-123-456-7889': request.asset.params})
+
+    with patch.object(handler, 'compile_plan') as compile_plan_mock:
+        request_out = handler.migrate(request)
+    compile_plan_mock.assert_not_called()
+    assert request_out.asset.get_param_by_id('num_licensed_users').value == 100
+
+
+def test_lazy_sdk_import():
+    # type: () -> None
+    # The Connect SDK is imported only when it is needed, so it needs a new interpreter
+    import subprocess
+    import sys
+    script = (
+        'import sys\n'
+        'import connect_migration\n'
+        'handler = connect_migration.MigrationHandler({"email": {"source": "email"}})\n'
+        'print(any(name.startswith("connect.") for name in sys.modules))\n'
+        'handler.warmup()\n'
+        'print("connect.models" in sys.modules)\n'
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.decode('utf-8').split() == ['False', 'True']
+
+
+def test_lazy_logger():
+    # type: () -> None
+    lazy_logger = connect_migration._LazyLogger()
+    assert lazy_logger.name == logger.name
+    assert lazy_logger._logger is logger
+    with patch('connect.logger.logger', None):
+        # The SDK logger is not looked up again once resolved
+        assert lazy_logger.getEffectiveLevel() == logger.getEffectiveLevel()
+
+
+def _derived_transformations(calls):
+    # type: (List[str]) -> Tuple[dict, dict]
+    @connect_migration.reads('teamId', 'teamName')
+    def team(data, _):
+        calls.append('team')
+        return {'id': data['teamId'].upper(), 'name': data['teamName'].upper()}
+
+    @connect_migration.reads('teamAdminEmail')
+    def admin(data, _):
+        calls.append('admin')
+        return data['teamAdminEmail'].lower()
+
+    @connect_migration.reads()
+    @connect_migration.depends('team', 'admin')
+    def summary(data, _, team, admin):
+        calls.append('summary')
+        return '{} <{}>'.format(team['name'], admin)
+
+    # They only read derived fields
+    transformations = {
+        'team_id': connect_migration.reads()(connect_migration.depends('team')(
+            lambda data, request_id, team: team['id'])),
+        'team_name': connect_migration.reads()(connect_migration.depends('summary')(
+            lambda data, request_id, summary: summary)),
+        'email': connect_migration.reads()(connect_migration.depends('admin')(
+            lambda data, request_id, admin: admin)),
+    }
+    return transformations, {'team': team, 'admin': admin, 'summary': summary}
+
+
+def test_derived_fields():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    metrics = connect_migration.MigrationMetrics()
+    calls = []  # type: List[str]
+
+    transformations, derived = _derived_transformations(calls)
+    handler = connect_migration.MigrationHandler(transformations, derived=derived,
+                                                 observer=metrics, partial_decode=True)
+    assert handler.derived == derived
+    diff = handler.migrate_diff(request)
+
+    assert diff.as_dict() == {
+        'email': 'example.migration@mailinator.com',
+        'team_id': 'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI',
+        'team_name': 'MIGRATION TEAM <example.migration@mailinator.com>',
+    }
+    # Every derived field is computed once, after the ones it depends on
+    assert sorted(calls) == ['admin', 'summary', 'team']
+    assert calls.index('summary') == 2
+    assert {'derived.admin', 'derived.summary', 'derived.team'} <= set(metrics.summary())
+
+    # Keys read by derived fields are decoded
+    plan = handler.compile_plan('PRD-123-456-7889', request.asset.params)
+    assert plan.keys == {'num_licensed_users', 'reseller_id', 'teamAdminEmail', 'teamId',
+                         'teamName'}
+
+    # Derived fields are computed for every request
+    del calls[:]
+    result = handler.migrate_columnar([request, request])
+    assert [item.succeeded for item in result] == [True, True]
+    assert sorted(calls) == ['admin', 'admin', 'summary', 'summary', 'team', 'team']
+
+
+def test_derived_fields_executor():
+    # type: () -> None
+    from concurrent.futures import ThreadPoolExecutor
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wait(name):
+        def derived(data, request_id):
+            # Only passes if both independent fields run at the same time
+            barrier.wait()
+            return name
+        return derived
+
+    transformations = {
+        'team_id': connect_migration.depends('first', 'second')(
+            lambda data, request_id, first, second: first + second),
+    }
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        handler = connect_migration.MigrationHandler(
+            transformations, derived={'first': wait('a'), 'second': wait('b')},
+            derived_executor=executor)
+        request_out = handler.migrate(request)
+
+    assert request_out.asset.get_param_by_id('team_id').value == 'ab'
+
+
+def _upper_team_id(data, request_id):
+    # type: (Dict[str, str], str) -> str
+    return data['teamId'].upper()
+
+
+@connect_migration.depends('upper_team_id')
+def _team_id(data, request_id, upper_team_id):
+    # type: (Dict[str, str], str, str) -> str
+    return upper_team_id
+
+
+def test_derived_fields_executor_pickle():
+    # type: () -> None
+    import pickle
+    from concurrent.futures import ThreadPoolExecutor
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        handler = connect_migration.MigrationHandler(
+            {'team_id': _team_id}, derived={'upper_team_id': _upper_team_id},
+            derived_executor=executor)
+        copy = pickle.loads(pickle.dumps(handler))
+
+    # The executor is left out, so the copy computes the derived fields in order
+    assert handler._derived_executor is executor
+    assert copy._derived_executor is None
+    request_out = copy.migrate(request)
+    assert request_out.asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+
+
+def test_derived_fields_errors():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    transformations = {
+        'team_id': connect_migration.depends('team')(lambda data, request_id, team: team),
+        'team_name': connect_migration.depends('team')(lambda data, request_id, team: team),
+        'email': _upper_email,
+    }
+    handler = connect_migration.MigrationHandler(transformations, derived={
+        'team': connect_migration.depends('lookup')(lambda data, request_id, lookup: lookup),
+        'lookup': _raise_error,
+    })
+    item = handler.migrate_many([request])[0]
+    assert item.errors == (
+        connect_migration.ParamError('team_id', 'processing', 'Manual fail.'),
+        connect_migration.ParamError('team_name', 'processing', 'Manual fail.'),
+    )
+
+    with pytest.raises(ValueError) as error:
+        connect_migration.MigrationHandler(transformations)
+    assert str(error.value) == 'Unknown derived field `team` required by parameter team_id.'
+
+    cyclic = {
+        'a': connect_migration.depends('b')(lambda data, request_id, b: b),
+        'b': connect_migration.depends('c')(lambda data, request_id, c: c),
+        'c': connect_migration.depends('a')(lambda data, request_id, a: a),
+    }
+    with pytest.raises(ValueError) as error:
+        connect_migration.MigrationHandler(derived=cyclic)
+    assert str(error.value) == 'Derived fields depend on each other: a -> b -> c -> a.'
+
+
+def test_transformation_spec():
+    # type: () -> None
+    data = {
+        'teamId': 'dbtid:abc',
+        'licNumber': ' 10 ',
+        'resellerId': ['3ONEYO1234', '3ONEYO5678'],
+        'team': {'admin': {'email': 'Admin@Example.com'}, 'active': 'yes'},
+        'plan': 'std',
+    }
+    spec = connect_migration.TransformationSpec
+
+    assert spec({'source': 'teamId', 'case': 'upper'})(data, 'PR-1') == 'DBTID:ABC'
+    assert spec({'source': 'licNumber', 'strip': True, 'cast': 'int', 'multiply': 10})(data) \
+        == 100
+    assert spec({'source': 'licNumber', 'cast': 'float'})(data) == 10.0
+    assert spec({'source': 'resellerId', 'join': ','})(data) == '3ONEYO1234,3ONEYO5678'
+    assert spec({'source': 'resellerId.1'})(data) == '3ONEYO5678'
+    assert spec({'source': 'resellerId', 'cast': 'json'})(data) \
+        == '["3ONEYO1234", "3ONEYO5678"]'
+    assert spec({'source': 'team.admin.email', 'case': 'lower'})(data) == 'admin@example.com'
+    assert spec({'source': 'team.active', 'cast': 'bool'})(data) is True
+    assert spec({'source': 'plan', 'map': {'std': 'Standard'}})(data) == 'Standard'
+    assert spec({'source': 'plan', 'map': {'adv': 'Advanced'}})(data) == 'std'
+    assert spec({'source': ['plan', 'teamId'], 'join': '/'})(data) == 'std/dbtid:abc'
+    assert spec({'source': ['plan', 'teamId']})(data) == ['std', 'dbtid:abc']
+    assert spec({'source': 'missing.key', 'default': 'none'})(data) == 'none'
+    assert spec({'source': ['plan', 'team.admin.email']}).keys == ('plan', 'team')
+
+
+def test_transformation_spec_errors():
+    # type: () -> None
+    spec = connect_migration.TransformationSpec
+    data = {'teamId': 'dbtid:abc', 'resellerId': ['3ONEYO1234']}
+
+    with pytest.raises(connect_migration.MigrationParamError):
+        spec({'source': 'missing'})(data)
+    with pytest.raises(connect_migration.MigrationParamError):
+        spec({'source': 'resellerId.3'})(data)
+    with pytest.raises(connect_migration.MigrationParamError):
+        spec({'source': 'teamId', 'cast': 'int'})(data)
+    with pytest.raises(connect_migration.MigrationParamError):
+        spec({'source': 'teamId', 'multiply': 2})(data)
+    with pytest.raises(connect_migration.MigrationParamError):
+        spec({'source': 'n', 'cast': 'int'})({'n': 1e400})
+
+    with pytest.raises(ValueError):
+        spec({'case': 'upper'})
+    with pytest.raises(ValueError):
+        spec({'source': 'teamId', 'reverse': True})
+    with pytest.raises(ValueError):
+        spec({'source': 'teamId', 'case': 'snake'})
+    with pytest.raises(ValueError):
+        spec({'source': 'teamId', 'cast': 'date'})
+
+
+def test_transformation_spec_pickle():
+    # type: () -> None
+    import pickle
+
+    transformation = connect_migration.TransformationSpec({'source': 'teamId', 'case': 'upper'})
+    copy = pickle.loads(pickle.dumps(transformation))
+    assert copy.spec == transformation.spec
+    assert copy({'teamId': 'abc'}, 'PR-1') == 'ABC'
+
+
+_COLUMN_DATA = [
+    {'count': '7', 'name': ' Migration Team ', 'tags': ['a', 1], 'ratio': 0.5},
+    {'count': 3, 'name': 'other', 'tags': 'b', 'ratio': 2},
+    {'count': 'x', 'name': 7, 'tags': [], 'ratio': True},
+    {'count': True, 'name': None, 'ratio': '1'},
+    {},
+    {'count': 2 ** 62, 'name': u'\u00e9t\u00e9', 'tags': [None], 'ratio': 1e300},
+]
+
+
+@pytest.mark.parametrize('spec', [
+    {'source': 'count', 'cast': 'int', 'multiply': 10},
+    {'source': 'count', 'multiply': 4},
+    {'source': 'ratio', 'multiply': 1.5},
+    {'source': 'ratio', 'cast': 'float', 'multiply': 2, 'default': -1},
+    {'source': 'name', 'strip': True, 'case': 'upper'},
+    {'source': 'name', 'case': 'title', 'map': {'Other': 'Another'}, 'default': ''},
+    {'source': ['name', 'count'], 'join': '-', 'cast': 'json'},
+    {'source': 'tags', 'join': ',', 'case': 'capitalize', 'cast': 'bool'},
+    {'source': 'tags.0', 'cast': 'str'},
+])
+@pytest.mark.parametrize('rows', [1, 100])
+@pytest.mark.parametrize('numpy', [True, False])
+def test_transformation_spec_apply_column(spec, rows, numpy):
+    # type: (Dict[str, Any], int, bool) -> None
+    transformation = connect_migration.TransformationSpec(spec)
+    data_list = (_COLUMN_DATA * rows)[:max(rows, len(_COLUMN_DATA))]
+
+    expected = []
+    for data in data_list:
+        try:
+            expected.append((transformation(data), None))
+        except connect_migration.MigrationParamError as ex:
+            expected.append((None, str(ex)))
+
+    with patch('connect_migration._numpy', None if numpy else False):
+        outcomes = transformation.apply_column(data_list)
+    assert [(value, str(error) if error else None) for value, error in outcomes] == expected
+    assert [type(value) for value, _ in outcomes] == [type(value) for value, _ in expected]
+
+
+def test_multiply_column_numpy():
+    # type: () -> None
+    numpy = pytest.importorskip('numpy')
+    column = list(range(100))
+
+    with patch('numpy.array', wraps=numpy.array) as array_mock:
+        assert connect_migration._multiply_column(column, 3) == [value * 3 for value in column]
+        assert array_mock.call_count == 1
+
+        # Values that would overflow, mixed types and short columns are multiplied in Python
+        array_mock.reset_mock()
+        assert connect_migration._multiply_column(column + [2 ** 62], 4)[-1] == 2 ** 64
+        assert connect_migration._multiply_column(column + [0.5], 2)[-2:] == [198, 1.0]
+        assert connect_migration._multiply_column([1, 2], 2) == [2, 4]
+        array_mock.assert_not_called()
+
+
+@pytest.mark.parametrize('validation', ['collect_all', 'fail_fast'])
+def test_migrate_columnar(validation):
+    # type: (str) -> None
+    template = json.loads(_load_str('request.migrate.transformation.json'))
+    requests = []
+    for number, lic_number in enumerate(['10', 'bad', '2', None]):
+        data = json.loads(template['asset']['params'][-1]['value'])
+        data['licNumber'] = lic_number
+        template['id'] = 'PR-7001-1234-{:04d}'.format(number)
+        template['asset']['params'][-1]['value'] = json.dumps(data)
+        requests.append(Fulfillment.deserialize_json(template))
+    requests.insert(1, Fulfillment.deserialize(_load_str('request.migrate.invalid.json')))
+    requests.append(Fulfillment.deserialize(_load_str('response.json'))[0])
+
+    handler = connect_migration.MigrationHandler({
+        'email': _upper_email,
+        'team_id': {'source': 'teamId', 'case': 'upper'},
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+    }, copy_on_write=True, validation=validation)
+
+    with patch('connect_migration.logger.error') as error_mock:
+        result = handler.migrate_columnar(requests)
+    with patch('connect_migration.logger.error') as expected_error_mock:
+        expected = handler.migrate_many(requests, executor=None)
+
+    assert isinstance(result, connect_migration.MigrationBatchResult)
+    assert [item.succeeded for item in result] == [True, False, False, True, False, True]
+    assert result.results[5] is requests[5]
+    for item, expected_item in zip(result, expected):
+        assert item.request is expected_item.request
+        assert type(item.error) is type(expected_item.error)
+        if item.result is not None:
+            assert [(param.id, param.value) for param in item.result.asset.params] == \
+                [(param.id, param.value) for param in expected_item.result.asset.params]
+    assert result[3].result.asset.get_param_by_id('num_licensed_users').value == 20
+    assert result[3].result.asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+    assert sorted(_messages(error_mock)) == sorted(_messages(expected_error_mock))
+    assert [item.errors for item in result] == [item.errors for item in expected]
+    assert requests[0].asset.get_param_by_id('email').value == ''
+
+
+@pytest.mark.parametrize('validation', ['collect_all', 'fail_fast'])
+def test_migrate_columnar_unexpected_error(validation):
+    # type: (str) -> None
+    template = json.loads(_load_str('request.migrate.transformation.json'))
+    requests = [Fulfillment.deserialize_json(template)]
+    data = json.loads(template['asset']['params'][-1]['value'])
+    del data['teamAdminEmail']
+    template['id'] = 'PR-7001-1234-0001'
+    template['asset']['params'][-1]['value'] = json.dumps(data)
+    requests.append(Fulfillment.deserialize_json(template))
+
+    handler = connect_migration.MigrationHandler({
+        'email': lambda data, request_id: data['teamAdminEmail'].upper(),
+        'team_id': {'source': 'teamId', 'case': 'upper'},
+    }, validation=validation)
+    with patch('connect_migration.logger.exception') as exception_mock:
+        result = handler.migrate_columnar(requests)
+    with patch('connect_migration.logger.exception'):
+        expected = handler.migrate_many(requests, executor=None)
+
+    # The error of one request does not discard the rest of the batch
+    assert [item.succeeded for item in result] == [True, False]
+    assert isinstance(result[1].error, KeyError)
+    assert [type(item.error) for item in result] == [type(item.error) for item in expected]
+    assert result[0].result.asset.get_param_by_id('email').value == \
+        'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert exception_mock.call_count == 1
+
+    # Also when parsing the data of a request fails unexpectedly
+    def decoder(raw_data):
+        # type: (str) -> Any
+        if 'teamAdminEmail' not in raw_data:
+            raise RuntimeError('Unexpected data.')
+        return json.loads(raw_data)
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email}, decoder=decoder,
+                                                 validation=validation)
+    with patch('connect_migration.logger.exception'):
+        result = handler.migrate_columnar(requests)
+    assert [item.succeeded for item in result] == [True, False]
+    assert isinstance(result[1].error, RuntimeError)
+
+
+def test_migrate_columnar_overflow():
+    # type: () -> None
+    template = json.loads(_load_str('request.migrate.transformation.json'))
+    requests = []
+    for number, lic_number in enumerate([10, 1e400, 2]):
+        data = json.loads(template['asset']['params'][-1]['value'])
+        data['licNumber'] = lic_number
+        template['id'] = 'PR-7001-1234-{:04d}'.format(number)
+        template['asset']['params'][-1]['value'] = json.dumps(data)
+        requests.append(Fulfillment.deserialize_json(template))
+
+    handler = connect_migration.MigrationHandler({
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+    }, copy_on_write=True)
+    with patch('connect_migration.logger.error'):
+        result = handler.migrate_columnar(requests)
+
+    # Only the request with the infinite value fails
+    assert [item.succeeded for item in result] == [True, False, True]
+    assert isinstance(result[1].error, SkipRequest)
+    assert [item.result.asset.get_param_by_id('num_licensed_users').value
+            for item in (result[0], result[2])] == [100, 20]
+
+
+def test_migrate_columnar_observer(tmpdir):
+    # type: (Any) -> None
+    metrics = connect_migration.MigrationMetrics()
+    store = connect_migration.FileCheckpointStore(str(tmpdir.join('checkpoints.jsonl')))
+    requests = [Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))]
+
+    handler = connect_migration.MigrationHandler(
+        {'team_id': {'source': 'teamId', 'case': 'upper'}}, observer=metrics,
+        checkpoint_store=store)
+    handler.migrate_columnar(requests)
+    result = handler.migrate_columnar(requests)
+
+    assert metrics.summary()['column.team_id']['count'] == 1
+    assert metrics.counters['requests.migrated'] == 1
+    assert metrics.counters['requests.restored'] == 1
+    assert result[0].result.asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+
+
+@patch('connect_migration.logger.info')
+def test_migration_transform_spec(info_mock):
+    # type: (Mock) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+
+    handler = connect_migration.MigrationHandler({
+        'email': {'source': 'teamAdminEmail', 'case': 'upper'},
+        'team_id': {'source': 'teamId', 'case': 'upper'},
+        'team_name': lambda data, request_id: data['teamName'].upper(),
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+    })
+    request_out = handler.migrate(request)
+
+    assert isinstance(handler.transformations['email'], connect_migration.TransformationSpec)
+    assert request_out.asset.get_param_by_id('email').value == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert request_out.asset.get_param_by_id('num_licensed_users').value == 100
+    assert request_out.asset.get_param_by_id('team_id').value == 'DBTID:AADAQQ_'\
+                                                                 'W53NMDQBIPM_X123456PUZPCM2BI'
+    assert request_out.asset.get_param_by_id('team_name').value == 'MIGRATION TEAM'
+    assert _messages(info_mock)[-1] == \
+        '[MIGRATION::PR-7001-1234-5678] 5 processed, 4 succeeded ' \
+        '(email, num_licensed_users, team_id, team_name), 0 failed, 1 skipped (reseller_id).'
+
+
+def test_load_transformations(tmpdir):
+    # type: (Any) -> None
+    filename = tmpdir.join('transformations.json')
+    filename.write(json.dumps({
+        'email': {'source': 'teamAdminEmail', 'case': 'upper'},
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int', 'multiply': 10},
+    }))
+
+    transformations = connect_migration.load_transformations(str(filename))
+    assert sorted(transformations) == ['email', 'num_licensed_users']
+    assert transformations['num_licensed_users']({'licNumber': '10'}, 'PR-1') == 100
+
+    filename.write('[]')
+    with pytest.raises(ValueError):
+        connect_migration.load_transformations(str(filename))
+
+
+def test_load_transformations_yaml(tmpdir):
+    # type: (Any) -> None
+    pytest.importorskip('yaml')
+    filename = tmpdir.join('transformations.yaml')
+    filename.write('email:\n'
+                   '  source: teamAdminEmail\n'
+                   '  case: upper\n')
+
+    transformations = connect_migration.load_transformations(str(filename))
+    assert transformations['email']({'teamAdminEmail': 'a@b.com'}, 'PR-1') == 'A@B.COM'
+
+
+def test_migration_transformation_cache():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    team_id = Mock(side_effect=lambda data, _: str(data['teamId']).upper())
+    email = Mock(side_effect=_upper_email)
+
+    handler = connect_migration.MigrationHandler({
+        'team_id': connect_migration.pure('teamId')(team_id),
+        'email': email,
+        'num_licensed_users': {'source': 'licNumber', 'cast': 'int'},
+    }, transformation_cache_size=10)
+    first = handler.migrate(request)
+    second = handler.migrate(request)
+
+    # Only pure transformations are cached
+    assert team_id.call_count == 1
+    assert email.call_count == 2
+    assert handler.transformation_cache_info() == connect_migration.CacheInfo(
+        hits=2, misses=2, maxsize=10, currsize=2)
+    assert first.asset.get_param_by_id('team_id').value == \
+        second.asset.get_param_by_id('team_id').value == \
+        'DBTID:AADAQQ_W53NMDQBIPM_X123456PUZPCM2BI'
+    assert second.asset.get_param_by_id('num_licensed_users').value == 10
+
+    # Values of the same key with different types are cached separately
+    handler._run_step(handler.compile_plan(None, ['team_id']).steps[0], {'teamId': 1}, 'PR-1')
+    assert handler.transformation_cache_info().misses == 3
+
+
+def test_migration_transformation_cache_unhashable():
+    # type: () -> None
+    transformation = Mock(return_value='value')
+    handler = connect_migration.MigrationHandler(
+        {'team_id': connect_migration.pure('teams')(transformation)},
+        transformation_cache_size=10)
+    step = handler.compile_plan(None, ['team_id']).steps[0]
+
+    assert handler._run_step(step, {'teams': ['a', {'b': 1}]}, 'PR-1') == 'value'
+    assert handler._run_step(step, {'teams': ['a', {'b': 1}]}, 'PR-2') == 'value'
+    assert handler._run_step(step, {}, 'PR-3') == 'value'
+    assert transformation.call_count == 2
+
+
+def test_migration_transformation_cache_errors():
+    # type: () -> None
+    transformation = Mock(side_effect=connect_migration.MigrationParamError('Manual fail.'))
+    handler = connect_migration.MigrationHandler(
+        {'team_id': connect_migration.pure('teamId')(transformation)},
+        transformation_cache_size=10)
+    step = handler.compile_plan(None, ['team_id']).steps[0]
+
+    for _ in range(2):
+        with pytest.raises(connect_migration.MigrationParamError):
+            handler._run_step(step, {'teamId': 'abc'}, 'PR-1')
+    assert transformation.call_count == 2
+    assert handler.transformation_cache_info().currsize == 0
+
+
+@patch('connect_migration.timeit.default_timer')
+def test_migration_transformation_cache_ttl(timer_mock):
+    # type: (Mock) -> None
+    transformation = Mock(return_value='value')
+    handler = connect_migration.MigrationHandler(
+        {'team_id': connect_migration.pure('teamId')(transformation)},
+        transformation_cache_size=10, transformation_cache_ttl=60)
+    step = handler.compile_plan(None, ['team_id']).steps[0]
+
+    timer_mock.return_value = 1000.0
+    handler._run_step(step, {'teamId': 'abc'}, 'PR-1')
+    timer_mock.return_value = 1059.0
+    handler._run_step(step, {'teamId': 'abc'}, 'PR-2')
+    assert transformation.call_count == 1
+
+    timer_mock.return_value = 1060.0
+    handler._run_step(step, {'teamId': 'abc'}, 'PR-3')
+    assert transformation.call_count == 2
+
+
+def test_pure_without_keys():
+    # type: () -> None
+    with pytest.raises(ValueError):
+        connect_migration.pure()
+    assert connect_migration.MigrationHandler().transformation_cache_info() is None
+
+
+def test_migration_observer():
+    # type: () -> None
+    observer = Mock(spec=connect_migration.MigrationObserver)
+    handler = connect_migration.MigrationHandler({
+        'email': _upper_email,
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    }, observer=observer)
+    assert handler.observer is observer
+
+    handler.migrate(Fulfillment.deserialize(_load_str('request.migrate.transformation.json')))
+    timings = [args[1] for args, _ in observer.timing.call_args_list]
+    assert timings == ['parse', 'transformation.email', 'transformation.team_id', 'copy', 'total']
+    assert all(args[0] == 'PR-7001-1234-5678' and args[2] >= 0
+               for args, _ in observer.timing.call_args_list)
+    assert [args[1:] for args, _ in observer.count.call_args_list] == [
+        ('params.succeeded', 2),
+        ('params.failed', 0),
+        ('params.skipped', 3),
+        ('requests.migrated', 1),
+    ]
+
+    observer.reset_mock()
+    handler.migrate(Fulfillment.deserialize(_load_str('response.json'))[0])
+    observer.timing.assert_not_called()
+    observer.count.assert_called_once_with('PR-5852-1608-0000', 'requests.not_needed', 1)
+
+    observer.reset_mock()
+    with pytest.raises(SkipRequest):
+        handler.migrate(Fulfillment.deserialize(_load_str('request.migrate.invalid.json')))
+    # The request is not copied if the migration fails
+    assert [args[1] for args, _ in observer.timing.call_args_list] == ['parse', 'total']
+    observer.count.assert_called_once_with('PR-7001-1234-5678', 'requests.failed', 1)
+
+
+def test_migration_metrics():
+    # type: () -> None
+    metrics = connect_migration.MigrationMetrics(max_samples=100)
+    handler = connect_migration.MigrationHandler({'email': _upper_email}, observer=metrics)
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    for _ in range(3):
+        handler.migrate(request)
+
+    assert metrics.counters == {
+        'params.succeeded': 3,
+        'params.failed': 0,
+        'params.skipped': 12,
+        'requests.migrated': 3,
+    }
+    summary = metrics.summary()
+    assert sorted(summary) == ['copy', 'parse', 'total', 'transformation.email']
+    assert summary['total']['count'] == 3
+    assert summary['total']['min'] <= summary['total']['p50'] <= summary['total']['max']
+    assert summary['total']['total'] >= summary['copy']['total']
+
+    metrics.reset()
+    assert metrics.counters == {}
+    assert metrics.summary() == {}
+    assert metrics.percentile('total', 50) is None
+
+
+def test_migration_metrics_pickle():
+    # type: () -> None
+    import pickle
+    metrics = connect_migration.MigrationMetrics(max_samples=2)
+    for seconds in (1.0, 2.0, 3.0):
+        metrics.timing('PR-1', 'parse', seconds)
+    metrics.count('PR-1', 'requests.migrated', 1)
+
+    copy = pickle.loads(pickle.dumps(metrics))
+    assert copy.summary() == metrics.summary()
+    assert copy.counters == {'requests.migrated': 1}
+    copy.timing('PR-2', 'parse', 4.0)
+    assert copy.percentile('parse', 0) == 3.0
+    assert metrics.summary()['parse']['count'] == 3
+
+
+def test_migration_metrics_percentiles():
+    # type: () -> None
+    metrics = connect_migration.MigrationMetrics(max_samples=100)
+    for value in range(1, 201):
+        metrics.timing('PR-1', 'parse', float(value))
+
+    # Only the most recent samples are used for percentiles, but count and total are exact
+    assert metrics.percentile('parse', 0) == 101.0
+    assert metrics.percentile('parse', 50) == 150.0
+    assert metrics.percentile('parse', 99) == 199.0
+    assert metrics.percentile('parse', 100) == 200.0
+    summary = metrics.summary()['parse']
+    assert summary['count'] == 200
+    assert summary['total'] == sum(range(1, 201))
+    assert summary['mean'] == 100.5
+
+
+def test_migrate_many_thread():
+    # type: () -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.invalid.json')),
+        Fulfillment.deserialize(_load_str('response.json'))[0],
+        Fulfillment.deserialize(_load_str('request.migrate.direct.notserialized.json')),
+    ]
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+    result = handler.migrate_many(requests, max_workers=2)
+
+    assert isinstance(result, connect_migration.MigrationBatchResult)
+    assert len(result) == 4
+    assert [item.request for item in result] == requests
+    assert [item.succeeded for item in result] == [True, False, True, False]
+    assert len(result.succeeded) == 2
+    assert len(result.failed) == 2
+    assert all(isinstance(item.error, SkipRequest) for item in result.failed)
+    assert result.results[0].asset.get_param_by_id('email').value \
+        == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert result.results[1] is None
+    assert result.results[2] is requests[2]
+    assert result.results[3] is None
+
+
+@pytest.mark.parametrize('executor', [None, 'thread'])
+def test_migrate_many_unexpected_error(executor):
+    # type: (Optional[str]) -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.direct.success.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+    ]
+
+    handler = connect_migration.MigrationHandler({
+        'team_id': lambda data, request_id: data['teamId'].upper(),
+    })
+    with patch('connect_migration.logger.exception') as exception_mock:
+        result = list(handler.imigrate(requests, executor=executor))
+
+    # The error of one request does not discard the rest of the batch
+    assert [item.succeeded for item in result] == [False, True]
+    assert isinstance(result[0].error, KeyError)
+    assert exception_mock.call_count == 1
+
+
+def test_migrate_many_process():
+    # type: () -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.invalid.json')),
+    ]
+
+    handler = connect_migration.MigrationHandler({
+        'email': _upper_email,
+        'team_name': {'source': 'teamName', 'case': 'upper'},
+    })
+    result = handler.migrate_many(requests, executor='process', max_workers=2)
+
+    assert [item.succeeded for item in result] == [True, False]
+    assert result[0].result.asset.get_param_by_id('email').value \
+        == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert result[0].result.asset.get_param_by_id('team_name').value == 'MIGRATION TEAM'
+    assert isinstance(result[1].error, SkipRequest)
+
+
+@pytest.mark.parametrize('executor', ['process', 'instance'])
+def test_migrate_many_process_observer(executor):
+    # type: (str) -> None
+    from concurrent.futures import ProcessPoolExecutor
+    requests = [Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))]
+    metrics = connect_migration.MigrationMetrics()
+    handler = connect_migration.MigrationHandler({'email': _upper_email}, observer=metrics)
+
+    with patch('connect_migration.logger.warning') as warning_mock:
+        if executor == 'instance':
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = handler.migrate_many(requests, executor=pool)
+        else:
+            result = handler.migrate_many(requests, executor=executor, max_workers=1)
+
+    # The measurements stay in the worker processes
+    assert [item.succeeded for item in result] == [True]
+    assert metrics.counters == {}
+    assert _messages(warning_mock) == [
+        '[MIGRATION] The observer does not receive the measurements of the migrations run in '
+        'worker processes.']
+
+
+def _checkpoint_stores(tmpdir):
+    # type: (Any) -> List[connect_migration.MigrationCheckpointStore]
+    return [connect_migration.SQLiteCheckpointStore(str(tmpdir.join('checkpoints.db'))),
+            connect_migration.FileCheckpointStore(str(tmpdir.join('checkpoints.jsonl')))]
+
+
+@pytest.mark.parametrize('store_index', [0, 1])
+def test_migration_checkpoint(tmpdir, store_index):
+    # type: (Any, int) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    store = _checkpoint_stores(tmpdir)[store_index]
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email},
+                                                 checkpoint_store=store)
+    assert handler.checkpoint_store is store
+    handler.migrate(request)
+
+    # The result is restored by a new process without running the transformations
+    store = _checkpoint_stores(tmpdir)[store_index]
+    email = Mock(side_effect=_upper_email)
+    metrics = connect_migration.MigrationMetrics()
+    handler = connect_migration.MigrationHandler({'email': email}, checkpoint_store=store,
+                                                 observer=metrics)
+    request_out = handler.migrate(request)
+
+    assert email.call_count == 0
+    assert metrics.counters['requests.restored'] == 1
+    assert request_out.asset.get_param_by_id('email').value == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert request_out.asset.get_param_by_id('team_name').value == ''
+    assert request.asset.get_param_by_id('email').value == ''
+
+    # A request whose migration data has changed is migrated again
+    param = request.asset.get_param_by_id('migration_info')
+    param.value = param.value.replace('Migration Team', 'Other Team')
+    handler.migrate(request)
+    assert email.call_count == 1
+
+
+def test_migration_checkpoint_failed(tmpdir):
+    # type: (Any) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    store = connect_migration.FileCheckpointStore(str(tmpdir.join('checkpoints.jsonl')))
+
+    handler = connect_migration.MigrationHandler({'email': _raise_error},
+                                                 checkpoint_store=store)
+    with pytest.raises(SkipRequest):
+        handler.migrate(request)
+    assert not tmpdir.join('checkpoints.jsonl').exists()
+
+
+@pytest.mark.parametrize('error', [IOError('Disk full.'), sqlite3.OperationalError('Locked.')])
+def test_migration_checkpoint_save_error(error):
+    # type: (Exception) -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    store = Mock(spec=connect_migration.MigrationCheckpointStore)
+    store.get.return_value = None
+    store.put.side_effect = error
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email},
+                                                 checkpoint_store=store)
+    with patch('connect_migration.logger.warning') as warning_mock:
+        request_out = handler.migrate(request)
+
+    # The migration does not fail because its checkpoint could not be saved
+    assert request_out.asset.get_param_by_id('email').value == \
+        'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert store.put.call_count == 1
+    assert warning_mock.call_count == 1
+
+
+@patch('connect_migration.logger.warning')
+def test_file_checkpoint_store_truncated(warning_mock, tmpdir):
+    # type: (Mock, Any) -> None
+    filename = tmpdir.join('checkpoints.jsonl')
+    filename.write('{"request_id": "PR-1", "payload_hash": "abc", "params": {"email": "A"}}\n'
+                   '{"request_id": "PR-2", "pay\n'
+                   '{"request_id": "PR-3", "payload_hash": "abc", "params": {"email": "C"}}\n'
+                   '{"request_id": "PR-4"')
+    store = connect_migration.FileCheckpointStore(str(filename))
+
+    assert store.get('PR-1', 'abc') == {'email': 'A'}
+    assert store.get('PR-3', 'abc') == {'email': 'C'}
+    assert store.get('PR-3', 'def') is None
+    assert warning_mock.call_count == 1
+
+    # Lines appended by other processes are read when needed
+    filename.write(', "payload_hash": "abc", "params": {}}\n', mode='a')
+    assert store.get('PR-4', 'abc') == {}
+
+
+@pytest.mark.parametrize('store_index', [0, 1])
+def test_migration_checkpoint_process(tmpdir, store_index):
+    # type: (Any, int) -> None
+    data = json.loads(_load_str('request.migrate.transformation.json'))
+    requests = []
+    for number in range(20):
+        data['id'] = 'PR-7001-1234-{:04d}'.format(number)
+        requests.append(Fulfillment.deserialize_json(data))
+
+    handler = connect_migration.MigrationHandler(
+        {'email': _upper_email}, checkpoint_store=_checkpoint_stores(tmpdir)[store_index])
+    result = handler.migrate_many(requests, executor='process', max_workers=4)
+    assert all(item.succeeded for item in result)
+
+    store = _checkpoint_stores(tmpdir)[store_index]
+    payload_hash = connect_migration.MigrationHandler._hash(
+        requests[0].asset.get_param_by_id('migration_info').value)
+    for request in requests:
+        assert store.get(request.id, payload_hash)['email'] == \
+            'EXAMPLE.MIGRATION@MAILINATOR.COM'
+
+
+def test_migrate_many_executor_instance():
+    # type: () -> None
+    from concurrent.futures import ThreadPoolExecutor
+
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        result = handler.migrate_many([request] * 3, executor=executor)
+        assert result.results[0].asset.get_param_by_id('email').value \
+            == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+        assert len(result.succeeded) == 3
+
+        # The executor is still usable
+        assert executor.submit(lambda: 1).result() == 1
+
+
+def test_migrate_many_unknown_executor():
+    # type: () -> None
+    handler = connect_migration.MigrationHandler()
+    with pytest.raises(ValueError):
+        handler.migrate_many([], executor='fiber')
+
+
+def test_imigrate():
+    # type: () -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.invalid.json')),
+    ]
+    consumed = []
+
+    def produce():
+        for request in requests:
+            consumed.append(request)
+            yield request
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+
+    # Requests are consumed as results are needed
+    items = handler.imigrate(produce())
+    assert next(items).succeeded
+    assert len(consumed) == 1
+    assert not next(items).succeeded
+    assert len(consumed) == 2
+
+    items = list(handler.imigrate(produce(), executor='thread', max_workers=1, window=1))
+    assert [item.succeeded for item in items] == [True, False]
+
+
+class _FakeSink(object):
+    """ Sink that keeps the items it receives, optionally waiting for an event. """
+
+    def __init__(self, release=None, fail=False):
+        self.items = []  # type: List[Any]
+        self.entered = threading.Event()
+        self.release = release
+        self.fail = fail
+
+    def __call__(self, item):
+        self.entered.set()
+        if self.release is not None:
+            self.release.wait(5)
+        self.items.append(item)
+        if self.fail:
+            raise RuntimeError('Sink failed.')
+
+
+def test_migration_worker():
+    # type: () -> None
+    requests = [
+        Fulfillment.deserialize(_load_str('request.migrate.transformation.json')),
+        Fulfillment.deserialize(_load_str('request.migrate.invalid.json')),
+        Fulfillment.deserialize(_load_str('response.json'))[0],
+    ]
+    sink = _FakeSink()
+
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+    worker = connect_migration.MigrationWorker(handler, sink, max_workers=2)
+    stats = worker.run(requests)
+
+    assert stats.submitted == 3
+    assert stats.completed == 3
+    assert stats.failed == 1
+    assert stats.queue_depth == 0
+    assert stats.throughput > 0
+    assert sorted((item.request is requests[1], item.succeeded) for item in sink.items) == [
+        (False, True), (False, True), (True, False)]
+    assert worker.metrics.counters == {'worker.succeeded': 2, 'worker.failed': 1}
+    assert worker.metrics.summary()['worker.latency']['count'] == 3
+
+
+def test_migration_worker_rate_limit():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    sink = _FakeSink()
+
+    worker = connect_migration.MigrationWorker(
+        connect_migration.MigrationHandler(), sink, max_workers=4, rate=50, burst=2)
+    stats = worker.run([request] * 6)
+
+    # Two calls are done at once, and the rest wait for a token every 20 ms
+    assert len(sink.items) == 6
+    assert stats.elapsed >= 0.07
+    assert worker.metrics.summary()['worker.throttle']['max'] > 0
+
+    with pytest.raises(ValueError):
+        connect_migration.TokenBucket(0)
+
+
+def test_migration_worker_back_pressure():
+    # type: () -> None
+    from six.moves import queue
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    release = threading.Event()
+    sink = _FakeSink(release)
+
+    worker = connect_migration.MigrationWorker(
+        connect_migration.MigrationHandler(), sink, max_workers=1, queue_size=1)
+    with pytest.raises(RuntimeError):
+        worker.submit(request)
+    with worker:
+        worker.submit(request)
+        assert sink.entered.wait(5)
+
+        # The only thread is busy in the sink, so the queue fills up
+        worker.submit(request)
+        assert worker.queue_depth == 1
+        with pytest.raises(queue.Full):
+            worker.submit(request, timeout=0.01)
+        release.set()
+
+    assert len(sink.items) == 2
+    assert worker.stats().submitted == 2
+
+
+def test_migration_worker_sink_error():
+    # type: () -> None
+    request = Fulfillment.deserialize(_load_str('request.migrate.transformation.json'))
+    sink = _FakeSink(fail=True)
+
+    worker = connect_migration.MigrationWorker(connect_migration.MigrationHandler(), sink)
+    with patch('connect_migration.logger.exception') as exception_mock:
+        stats = worker.run([request, request])
+
+    assert stats.completed == 2
+    assert worker.metrics.counters['worker.sink_errors'] == 2
+    assert exception_mock.call_count == 2
+
+
+def _write_jsonl(tmpdir):
+    # type: (Any) -> Any
+    filename = tmpdir.join('requests.jsonl')
+    lines = [
+        json.dumps(json.loads(_load_str('request.migrate.transformation.json'))),
+        json.dumps(json.loads(_load_str('request.migrate.invalid.json'))),
+        '',
+        json.dumps(json.loads(_load_str('response.json'))[0]),
+        '{not json',
+    ]
+    filename.write('\n'.join(lines) + '\n')
+    return filename
+
+
+def test_migrate_jsonl(tmpdir):
+    # type: (Any) -> None
+    output = six.StringIO()
+    handler = connect_migration.MigrationHandler({'email': _upper_email})
+    with open(str(_write_jsonl(tmpdir))) as input_file:
+        stats = connect_migration.migrate_jsonl(handler, input_file, output)
+
+    assert stats[:4] == (1, 1, 1, 1)
+    assert stats.elapsed > 0
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert records == [
+        {
+            'id': 'PR-7001-1234-5678',
+            'status': 'migrated',
+            'params': {
+                'email': 'EXAMPLE.MIGRATION@MAILINATOR.COM',
+                'num_licensed_users': '',
+                'reseller_id': '',
+                'team_id': '',
+                'team_name': '',
+            },
+        },
+        {'id': 'PR-7001-1234-5678', 'status': 'failed', 'error': 'Migration failed.',
+         'errors': []},
+        {'id': 'PR-5852-1608-0000', 'status': 'not_needed'},
+    ]
+
+    # The errors of the params that failed are written too
+    output = six.StringIO()
+    handler = connect_migration.MigrationHandler({'email': _raise_error})
+    with open(str(_write_jsonl(tmpdir))) as input_file:
+        connect_migration.migrate_jsonl(handler, input_file, output)
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert records[0]['status'] == 'failed'
+    assert records[0]['errors'] == [
+        {'param_id': 'email', 'stage': 'processing', 'message': 'Manual fail.'},
+    ]
+
+
+def test_main(tmpdir, capsys):
+    # type: (Any, Any) -> None
+    transformations = tmpdir.join('transformations.json')
+    transformations.write(json.dumps({'email': {'source': 'teamAdminEmail', 'case': 'upper'}}))
+    output = tmpdir.join('results.jsonl')
+
+    status = connect_migration.main([
+        'run',
+        '--input', str(_write_jsonl(tmpdir)),
+        '--output', str(output),
+        '--transformations', str(transformations),
+        '--workers', '2',
+        '--checkpoint', str(tmpdir.join('checkpoints.db')),
     ])
 
+    assert status == 1
+    assert tmpdir.join('checkpoints.db').exists()
+    records = [json.loads(line) for line in output.readlines()]
+    assert [record['status'] for record in records] == ['migrated', 'failed', 'not_needed']
+    assert records[0]['params']['email'] == 'EXAMPLE.MIGRATION@MAILINATOR.COM'
+    assert '4 requests in ' in capsys.readouterr().err
+
+
+def test_main_module(tmpdir):
+    # type: (Any) -> None
+    import subprocess
+    import sys
+
+    filename = tmpdir.join('requests.jsonl')
+    filename.write(json.dumps(json.loads(_load_str('request.migrate.direct.success.json'))))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'connect_migration', 'run', '--input', str(filename),
+         '--output', '-'],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    out, err = process.communicate()
+
+    assert process.returncode == 0
+    assert json.loads(out.decode('utf-8'))['params']['team_name'] == 'Migration Team'
+    assert b'1 requests in ' in err
+
+
+def _upper_email(data, _):
+    # type: (Dict[str, str], str) -> str
+    if 'teamAdminEmail' not in data:
+        raise connect_migration.MigrationParamError('Missing teamAdminEmail.')
+    return data['teamAdminEmail'].upper()
+
 
 def _raise_error(_, __):
     # type: (Dict[str, str], str) -> None